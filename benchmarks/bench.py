@@ -0,0 +1,372 @@
+#!/usr/bin/python3
+
+"""Timeline benchmark suite
+
+Runs the timeline operations against synthetic RPM and Debian trees and reports
+wall time, throughput and peak RSS per case. Results can be stored as a baseline
+and later runs compared against it to catch regressions:
+
+    python3 -m benchmarks.bench --save-baseline
+    python3 -m benchmarks.bench --packages 20000 --rotation-sizes 90,365
+    python3 -m benchmarks.bench --baseline benchmarks/baseline.json --tolerance 0.25
+
+The memory_cycles cases run thousands of snapshot cycles (rotation, links,
+metadata) on the in-memory file system backend, without any snapshot I/O.
+
+Every case runs in a freshly spawned process so the peak RSS values are not
+polluted by earlier cases. The work directory must allow hard-linking between
+the synthetic source and the timeline destination (i.e. a single device).
+"""
+
+import argparse
+import collections
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks import synthetic
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+def _timeline_module():
+    """Import the timeline module with console logging turned down"""
+
+    from timeline import timeline
+    logging.getLogger('Timeline').setLevel(logging.WARNING)
+    return timeline
+
+
+def _timed_timeline_class():
+    """Return a Timeline subclass which accumulates the time spent per stage"""
+
+    timeline = _timeline_module()
+
+    class TimedTimeline(timeline.Timeline):
+        # class attribute, so it does not end up in the pickled state
+        timings = collections.defaultdict(float)
+
+        def rotate_snapshots(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return super().rotate_snapshots(*args, **kwargs)
+            finally:
+                self.timings['rotate_snapshots'] += time.perf_counter() - start
+
+        def _snapshot_validate(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return super()._snapshot_validate(*args, **kwargs)
+            finally:
+                self.timings['validate'] += time.perf_counter() - start
+
+        def _snapshot_generate_diff_report(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return super()._snapshot_generate_diff_report(*args, **kwargs)
+            finally:
+                self.timings['diff_report'] += time.perf_counter() - start
+
+    return TimedTimeline
+
+
+def _new_timeline(workdir, args, kind, max_snapshots=90, diff=False, links=True):
+    """Generate a synthetic source and an empty timeline for it"""
+
+    cls = _timed_timeline_class()
+    repo = synthetic.generate(
+        kind, os.path.join(workdir, f'{kind}.src'),
+        packages=args.packages, depth=args.depth, size=args.file_size, seed=args.seed)
+
+    t = cls(f'bench-{kind}', repo.root, os.path.join(workdir, f'{kind}.timeline'))
+    t._debug = True  # sub-second snapshot names
+    t.set_max_snapshots(max_snapshots)
+    if diff:
+        t._diff_log_path = os.path.join(workdir, 'diff')
+    t._pipeline = 'inline'  # timed in this process, no background runners
+    t.save()
+    if links:
+        t.create_snapshot()
+        t.create_link('upstream', max_offset=1)
+        t.create_link('downstream')
+        for i in (3, 7, 14, 21, 30, 60, 90, 180, 365):
+            if max_snapshots >= i:
+                t.create_link(f'offset{i:03}', max_offset=i)
+    return cls, repo, t
+
+
+def _fill(t, repo, count, args):
+    """Take snapshots until the timeline holds count snapshots"""
+
+    while len(t._lsnapshots) < count:
+        if args.sync_every and len(t._lsnapshots) % args.sync_every == 0:
+            repo.sync(added=args.sync_added, removed=args.sync_removed)
+        t.create_snapshot()
+
+
+def case_create_snapshot(workdir, args, kind):
+    """create_snapshot (hard-link copy + metadata copy) incl. rotation"""
+
+    _, repo, t = _new_timeline(workdir, args, kind)
+    entries = repo.file_count()
+    start = time.perf_counter()
+    for _ in range(args.rounds):
+        t.create_snapshot()
+    elapsed = time.perf_counter() - start
+    return {'seconds': elapsed, 'ops': args.rounds, 'items': entries * args.rounds, 'unit': 'entries'}
+
+
+def case_rotate(workdir, args, kind, max_snapshots):
+    """rotate_snapshots on a full timeline, one snapshot and its links per round"""
+
+    cls, repo, t = _new_timeline(workdir, args, kind, max_snapshots=max_snapshots)
+    _fill(t, repo, max_snapshots, args)
+    cls.timings.clear()
+    for _ in range(args.rounds):
+        repo.sync(added=args.sync_added, removed=args.sync_removed)
+        t.create_snapshot()
+    return {'seconds': cls.timings['rotate_snapshots'], 'ops': args.rounds,
+            'items': args.rounds, 'unit': 'rotations'}
+
+
+def case_diff_report(workdir, args, kind):
+    """_snapshot_generate_diff_report between two synced snapshots"""
+
+    cls, repo, t = _new_timeline(workdir, args, kind, diff=True)
+    cls.timings.clear()
+    for _ in range(args.rounds):
+        repo.sync(added=args.sync_added, removed=args.sync_removed)
+        t.create_snapshot()
+    return {'seconds': cls.timings['diff_report'], 'ops': args.rounds,
+            'items': repo.file_count() * args.rounds, 'unit': 'entries'}
+
+
+def case_validate(workdir, args, kind):
+    """_snapshot_validate (repository metadata checks) of new snapshots"""
+
+    cls, repo, t = _new_timeline(workdir, args, kind)
+    cls.timings.clear()
+    for _ in range(args.rounds):
+        repo.sync(added=args.sync_added, removed=args.sync_removed)
+        t.create_snapshot()
+    return {'seconds': cls.timings['validate'], 'ops': args.rounds,
+            'items': sum(t._snapshots[s].validation['checked_bytes'] for s in t._lsnapshots[-args.rounds:]),
+            'unit': 'bytes'}
+
+
+def case_consistency_check(workdir, args, kind):
+    """consistency_check on a timeline with the largest rotation size"""
+
+    _, repo, t = _new_timeline(workdir, args, kind, max_snapshots=args.check_snapshots)
+    _fill(t, repo, args.check_snapshots, args)
+    start = time.perf_counter()
+    for _ in range(args.rounds):
+        t.consistency_check()
+    elapsed = time.perf_counter() - start
+    return {'seconds': elapsed, 'ops': args.rounds,
+            'items': (len(t._lsnapshots) + len(t._links)) * args.rounds, 'unit': 'objects'}
+
+
+def case_load(workdir, args, kind):
+    """Timeline.load of a timeline with the largest rotation size"""
+
+    cls, repo, t = _new_timeline(workdir, args, kind, max_snapshots=args.check_snapshots)
+    _fill(t, repo, args.check_snapshots, args)
+    loads = args.rounds * 10
+    start = time.perf_counter()
+    for _ in range(loads):
+        cls.load(t._destination)
+    elapsed = time.perf_counter() - start
+    return {'seconds': elapsed, 'ops': loads, 'items': loads, 'unit': 'loads'}
+
+
+def case_memory_cycles(workdir, args, kind):
+    """create_snapshot cycles incl. rotation and links on the memory file system backend (no snapshot I/O)"""
+
+    cls = _timed_timeline_class()
+    from timeline import filesystem
+    repo = synthetic.generate(
+        kind, os.path.join(workdir, f'{kind}.src'),
+        packages=args.packages, depth=args.depth, size=args.file_size, seed=args.seed)
+    fs = filesystem.MemoryFileSystem()
+    fs.import_tree(repo.root, repo.root)
+    files = fs.find(repo.root, ['*'], filesystem.FILE)
+    rng = random.Random(args.seed)
+
+    t = cls(f'bench-{kind}', repo.root, os.path.join(workdir, f'{kind}.timeline'), backend=fs)
+    t._debug = True  # sub-second snapshot names
+    t._validate_metadata = False
+    t._pipeline = 'inline'
+    t.save()
+    t.create_snapshot()
+    t.create_link('upstream', max_offset=1)
+    t.create_link('downstream')
+    for i in (3, 7, 14, 21, 30, 60, 90):
+        t.create_link(f'offset{i:03}', max_offset=i)
+
+    start = time.perf_counter()
+    for cycle in range(args.memory_cycles):
+        if args.sync_every and cycle % args.sync_every == 0:
+            # a simulated sync: removed files are replaced by new ones in the same directories
+            for path in rng.sample(files, min(args.sync_removed, len(files))):
+                fs.remove(path)
+                files.remove(path)
+            for n in range(args.sync_added):
+                path = os.path.join(os.path.dirname(rng.choice(files)), f'sync-{cycle}-{n}.pkg')
+                fs.write_file(path, args.file_size)
+                files.append(path)
+        t.create_snapshot()
+    elapsed = time.perf_counter() - start
+    return {'seconds': elapsed, 'ops': args.memory_cycles, 'items': args.memory_cycles, 'unit': 'cycles'}
+
+
+def _cases(args):
+    """Return the list of (case name, function, extra arguments) to run"""
+
+    cases = []
+    for kind in args.kinds:
+        cases.append((f'create_snapshot[{kind}]', case_create_snapshot, (kind,)))
+        cases.append((f'diff_report[{kind}]', case_diff_report, (kind,)))
+        cases.append((f'validate[{kind}]', case_validate, (kind,)))
+        for size in args.rotation_sizes:
+            cases.append((f'rotate_snapshots[{kind},{size}]', case_rotate, (kind, size)))
+        cases.append((f'consistency_check[{kind}]', case_consistency_check, (kind,)))
+        cases.append((f'load[{kind}]', case_load, (kind,)))
+        if args.memory_cycles:
+            cases.append((f'memory_cycles[{kind}]', case_memory_cycles, (kind,)))
+    return [c for c in cases if not args.only or any(o in c[0] for o in args.only)]
+
+
+def _run_case(queue, func, workdir, args, extra):
+    """Child process entry point, reports the result through the queue"""
+
+    try:
+        result = func(workdir, args, *extra)
+        result['peak_rss_kb'] = max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        )
+        queue.put(result)
+    except Exception as e:
+        queue.put({'error': repr(e)})
+        raise
+
+
+def run(args):
+    """Run all selected cases and return {case name: result}"""
+
+    ctx = multiprocessing.get_context('spawn')
+    results = {}
+    for name, func, extra in _cases(args):
+        workdir = tempfile.mkdtemp(prefix='timeline-bench.', dir=args.workdir)
+        queue = ctx.Queue()
+        proc = ctx.Process(target=_run_case, args=(queue, func, workdir, args, extra))
+        proc.start()
+        result = queue.get()
+        proc.join()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        if 'error' not in result:
+            result['per_op'] = result['seconds'] / result['ops'] if result['ops'] else 0.0
+            result['throughput'] = result['items'] / result['seconds'] if result['seconds'] else 0.0
+        results[name] = result
+        _print_result(name, result)
+    return results
+
+
+def _print_result(name, result):
+    if 'error' in result:
+        print(f'{name:<40} ERROR {result["error"]}')
+        return
+    print(f'{name:<40} {result["seconds"]:>10.3f}s {result["per_op"] * 1000:>10.2f}ms/op '
+          f'{result["throughput"]:>12.1f} {result["unit"]}/s {result["peak_rss_kb"] / 1024:>8.1f}MiB')
+
+
+def compare(results, baseline, tolerance):
+    """Compare results to a baseline, return the list of regressed case names"""
+
+    regressions = []
+    print()
+    print(f'{"case":<40} {"baseline":>10} {"current":>10} {"change":>8}')
+    for name, result in results.items():
+        old = baseline.get(name)
+        if not old or 'error' in result or 'error' in old:
+            continue
+        change = (result['per_op'] - old['per_op']) / old['per_op'] if old['per_op'] else 0.0
+        flag = ''
+        if change > tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f'{name:<40} {old["per_op"] * 1000:>8.2f}ms {result["per_op"] * 1000:>8.2f}ms '
+              f'{change * 100:>+7.1f}%{flag}')
+    return regressions
+
+
+def _int_list(value):
+    return [int(i) for i in value.split(',') if i]
+
+
+def setup_argparse():
+    """Setup argument parsing"""
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--kinds', type=lambda v: v.split(','), default=['rpm', 'deb'],
+                        help='comma-separated repository kinds [default=rpm,deb]')
+    parser.add_argument('--packages', type=int, default=2000, help='package files per repository')
+    parser.add_argument('--depth', type=int, default=0, help='extra directory levels below package directories')
+    parser.add_argument('--file-size', type=int, default=256, help='size of each package file in bytes')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the synthetic trees')
+    parser.add_argument('--rounds', type=int, default=5, help='measured repetitions per case')
+    parser.add_argument('--rotation-sizes', type=_int_list, default=[90, 180, 365],
+                        help='comma-separated max_snapshots values for the rotation cases')
+    parser.add_argument('--check-snapshots', type=int, default=90,
+                        help='snapshots held by the timeline for consistency_check and load')
+    parser.add_argument('--sync-every', type=int, default=10,
+                        help='simulate a mirror sync every N snapshots while filling timelines')
+    parser.add_argument('--sync-added', type=int, default=10, help='packages added per simulated sync')
+    parser.add_argument('--sync-removed', type=int, default=5, help='packages removed per simulated sync')
+    parser.add_argument('--memory-cycles', type=int, default=2000,
+                        help='snapshots taken on the memory file system backend, 0 to skip [default=%(default)s]')
+    parser.add_argument('--only', action='append', help='only run cases containing this string')
+    parser.add_argument('--workdir', default=None, help='directory for the synthetic trees')
+    parser.add_argument('--keep', action='store_true', help='keep the generated trees')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline file [default=%(default)s]')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.20,
+                        help='allowed per-op slowdown before a case counts as regression [default=%(default)s]')
+    return parser.parse_args()
+
+
+def main():
+    args = setup_argparse()
+    results = run(args)
+
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+        print(f'\nbaseline written to [{args.baseline}]')
+        return 0
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
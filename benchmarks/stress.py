@@ -0,0 +1,341 @@
+#!/usr/bin/python3
+
+"""Concurrency stress and fault-injection harness
+
+Runs many concurrent mrepo operations (create-snapshot, update-link,
+create-link, delete-link, delete-snapshot, config --max-snapshots) against
+synthetic timelines from several worker processes, the way cron jobs and
+operators do on a production mirror:
+
+    python3 -m benchmarks.stress
+    python3 -m benchmarks.stress --workers 16 --duration 120 --timelines 2
+    python3 -m benchmarks.stress --kill create_snapshot=0.2 --kill _save_state=0.05 --no-lock
+
+Every operation runs as a separate `mrepo --no-daemon` process. With --kill
+METHOD=PROBABILITY, a call of that Timeline method starts a timer which kills
+the process with SIGKILL at a random point during the call. With --lock (the
+default) every operation holds the timeline lock file (the one used by
+`create-snapshot --lock`), and the time spent waiting for it is reported.
+
+Afterwards the invariants of every timeline are checked: the metadata must
+load, snapshots and links must agree with each other and with the file
+system (consistency_check in dry-run mode), and consistency_check must be
+able to repair whatever it found. The report lists throughput, latency and
+lock wait times per operation and the violated invariants; the exit status
+is non-zero if a timeline could not be repaired.
+"""
+
+import argparse
+import collections
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import lockfile
+
+from benchmarks import synthetic
+
+# default maximum delay (seconds) of an injected kill after entering the method
+KILL_DELAYS = {'create_snapshot': 0.5, 'rotate_snapshots': 0.1, '_save_state': 0.005}
+
+# operation -> weight
+OPERATIONS = {
+    'create-snapshot': 4,
+    'update-link': 3,
+    'create-link': 1,
+    'delete-link': 1,
+    'delete-snapshot': 1,
+    'config-max-snapshots': 1,
+}
+
+
+def _inject(cls, name, probability, max_delay, rng):
+    """wrap cls.name: with the given probability the process is killed at a random point of the call"""
+
+    original = getattr(cls, name)
+
+    @functools.wraps(original)
+    def wrapper(self, *args, **kwargs):
+        timer = None
+        if rng.random() < probability:
+            timer = threading.Timer(rng.uniform(0, max_delay), os.kill, (os.getpid(), signal.SIGKILL))
+            timer.daemon = True
+            timer.start()
+        try:
+            return original(self, *args, **kwargs)
+        finally:
+            if timer:
+                timer.cancel()
+
+    setattr(cls, name, wrapper)
+
+
+def _child(argv):
+    """entry point of a single operation: install the fault hooks and run the command line interface"""
+
+    from timeline import cli, timeline
+    logging.getLogger('Timeline').setLevel(logging.WARNING)
+
+    # sub-second snapshot names, operations follow each other quickly
+    timeline.Timeline._debug = True
+
+    rng = random.Random()
+    for name, (probability, max_delay) in json.loads(os.environ.get('STRESS_FAULTS', '{}')).items():
+        _inject(timeline.Timeline, name, probability, max_delay, rng)
+
+    sys.argv = ['mrepo', '--no-daemon'] + argv
+    cli.main()
+
+
+def _command(path, rng):
+    """pick a random operation and its arguments from the current (possibly stale) state"""
+
+    from timeline import timeline
+
+    operation = rng.choices(list(OPERATIONS), weights=list(OPERATIONS.values()))[0]
+    try:
+        state = timeline.Timeline.read_metadata(path)
+    except Exception:
+        return 'create-snapshot', ['create-snapshot', path]
+    snapshots = state.get('_lsnapshots', [])
+    links = sorted(state.get('_links', {}))
+
+    if operation == 'update-link' and links and snapshots:
+        return operation, ['update-link', os.path.join(path, rng.choice(links)), '--snapshot', rng.choice(snapshots)]
+    if operation == 'create-link' and snapshots:
+        link = f'stress{rng.randrange(20):02d}'
+        return operation, ['create-link', os.path.join(path, link), '--snapshot', rng.choice(snapshots),
+                           '--max-offset', str(rng.choice((0, 0, 3, 5)))]
+    if operation == 'delete-link' and links:
+        return operation, ['delete-link', os.path.join(path, rng.choice(links))]
+    if operation == 'delete-snapshot' and len(snapshots) > 2:
+        return operation, ['delete-snapshot', os.path.join(path, rng.choice(snapshots[:-1]))]
+    if operation == 'config-max-snapshots':
+        return operation, ['config', path, '--max-snapshots', str(rng.randrange(3, 12))]
+    return 'create-snapshot', ['create-snapshot', path]
+
+
+def _acquire(lock, timeout, poll=0.01):
+    """acquire the lock file, polling more often than lockfile does (timeout/10), False on timeout"""
+
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            lock.acquire(timeout=0)
+            return True
+        except lockfile.AlreadyLocked:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(poll)
+
+
+def _worker(worker_id, paths, args, faults, results):
+    """run random operations until the deadline, report (operation, status, seconds, lock wait) tuples"""
+
+    rng = random.Random(args.seed * 1000 + worker_id)
+    env = dict(os.environ, STRESS_FAULTS=json.dumps(faults))
+    deadline = time.monotonic() + args.duration
+    records = []
+    while time.monotonic() < deadline:
+        path = rng.choice(paths)
+        operation, argv = _command(path, rng)
+
+        lock = lockfile.FileLock(os.path.join(path, '.lock')) if args.lock else None
+        wait_start = time.monotonic()
+        if lock and not _acquire(lock, args.lock_timeout):
+            records.append((operation, 'lock-timeout', 0.0, time.monotonic() - wait_start))
+            continue
+        start = time.monotonic()
+        try:
+            proc = subprocess.run([sys.executable, '-m', 'benchmarks.stress', '--child'] + argv,
+                                  env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        finally:
+            if lock:
+                lock.release()
+        if proc.returncode == -signal.SIGKILL:
+            status = 'killed'
+        elif proc.returncode:
+            status = 'failed'
+        else:
+            status = 'ok'
+        records.append((operation, status, time.monotonic() - start, start - wait_start))
+    results.put(records)
+
+
+def _setup(workdir, args):
+    """generate the synthetic sources and timelines, returns the timeline paths"""
+
+    from timeline import timeline
+    logging.getLogger('Timeline').setLevel(logging.WARNING)
+
+    paths = []
+    for n in range(args.timelines):
+        kind = args.kinds[n % len(args.kinds)]
+        repo = synthetic.generate(kind, os.path.join(workdir, f'{kind}{n}.src'),
+                                  packages=args.packages, seed=args.seed + n)
+        t = timeline.Timeline(f'stress-{kind}{n}', repo.root, os.path.join(workdir, f'{kind}{n}.timeline'))
+        t._debug = True
+        t.set_max_snapshots(args.max_snapshots)
+        t.save()
+        for _ in range(3):
+            t.create_snapshot()
+        t.create_link('upstream', max_offset=1)
+        t.create_link('downstream')
+        t.create_link('offset003', max_offset=3)
+        paths.append(t._destination)
+    return paths
+
+
+def check(path):
+    """check the invariants of a timeline, repair it, returns (violations, repaired)"""
+
+    from timeline import timeline
+    logging.getLogger('Timeline').setLevel(logging.ERROR)
+
+    violations = []
+    try:
+        t = timeline.Timeline.load(path)
+    except Exception as e:
+        return [f'metadata cannot be loaded: {e!r}'], False
+
+    for name, link in t._links.items():
+        if link.snapshot not in t._snapshots:
+            violations.append(f'link [{name}] points to unknown snapshot [{link.snapshot}]')
+        elif name not in t._snapshots[link.snapshot].links:
+            violations.append(f'link [{name}] missing in the links of snapshot [{link.snapshot}]')
+    for name, snapshot in t._snapshots.items():
+        for link in snapshot.links:
+            if link not in t._links or t._links[link].snapshot != name:
+                violations.append(f'snapshot [{name}] lists link [{link}] which points elsewhere')
+    if sorted(t._lsnapshots) != sorted(t._snapshots):
+        violations.append('snapshot list and snapshot metadata differ')
+
+    try:
+        plan = t.consistency_check(dry_run=True)
+        violations += plan.describe()
+        t.consistency_check()
+        repaired = not timeline.Timeline.load(path).consistency_check(dry_run=True)
+    except Exception as e:
+        violations.append(f'consistency check failed: {e!r}')
+        repaired = False
+    return violations, repaired
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+def report(records, elapsed, checks):
+    """print throughput/latency/lock wait per operation and the invariant check results"""
+
+    per_operation = collections.defaultdict(list)
+    for record in records:
+        per_operation[record[0]].append(record)
+
+    print(f'{"operation":<22} {"ops":>6} {"ok":>6} {"failed":>6} {"killed":>6} {"ops/s":>8} '
+          f'{"mean":>8} {"p95":>8} {"lock wait":>10} {"max wait":>9}')
+    for operation, rows in sorted(per_operation.items()):
+        counts = collections.Counter(r[1] for r in rows)
+        durations = [r[2] for r in rows if r[1] != 'lock-timeout']
+        waits = [r[3] for r in rows]
+        print(f'{operation:<22} {len(rows):>6} {counts["ok"]:>6} {counts["failed"] + counts["lock-timeout"]:>6} '
+              f'{counts["killed"]:>6} {len(rows) / elapsed:>8.2f} '
+              f'{statistics.mean(durations) if durations else 0:>7.3f}s {_percentile(durations, 0.95):>7.3f}s '
+              f'{statistics.mean(waits):>9.3f}s {max(waits):>8.3f}s')
+    total_wait = sum(r[3] for r in records)
+    print(f'\n{len(records)} operations in {elapsed:.1f}s ({len(records) / elapsed:.2f} ops/s), '
+          f'{total_wait:.1f}s waiting for locks')
+
+    print()
+    for path, (violations, repaired) in sorted(checks.items()):
+        state = 'consistent' if not violations else ('repaired' if repaired else 'NOT REPAIRABLE')
+        print(f'{path}: {state}')
+        for violation in violations:
+            print(f'    {violation}')
+
+
+def _fault(value):
+    name, _, probability = value.partition('=')
+    if name not in KILL_DELAYS:
+        raise argparse.ArgumentTypeError(f'faults can be injected into {", ".join(sorted(KILL_DELAYS))}')
+    return name, float(probability or 0.1)
+
+
+def setup_argparse():
+    """Setup argument parsing"""
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--workers', type=int, default=8, help='concurrent worker processes [default=%(default)s]')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run [default=%(default)s]')
+    parser.add_argument('--timelines', type=int, default=2, help='number of timelines [default=%(default)s]')
+    parser.add_argument('--kinds', type=lambda v: v.split(','), default=['rpm', 'deb'],
+                        help='comma-separated repository kinds [default=rpm,deb]')
+    parser.add_argument('--packages', type=int, default=500, help='package files per repository')
+    parser.add_argument('--max-snapshots', type=int, default=8, help='max_snapshots of the timelines')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the trees and the operations')
+    parser.add_argument('--kill', type=_fault, action='append', default=[], metavar='METHOD=PROBABILITY',
+                        help='kill the operation at a random point of METHOD with PROBABILITY per call\n'
+                             f'(METHOD: {", ".join(sorted(KILL_DELAYS))})')
+    parser.add_argument('--kill-delay', type=float, default=None,
+                        help='maximum delay of a kill after entering the method [default: per method]')
+    parser.add_argument('--no-lock', dest='lock', action='store_false',
+                        help='run the operations without holding the timeline lock')
+    parser.add_argument('--lock-timeout', type=float, default=60, help='seconds to wait for the timeline lock')
+    parser.add_argument('--workdir', default=None, help='directory for the synthetic trees')
+    parser.add_argument('--keep', action='store_true', help='keep the generated trees')
+    parser.add_argument('--child', nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = setup_argparse()
+    if args.child is not None:
+        return _child(args.child)
+
+    faults = {name: (probability, args.kill_delay or KILL_DELAYS[name]) for name, probability in args.kill}
+    workdir = tempfile.mkdtemp(prefix='timeline-stress.', dir=args.workdir)
+    try:
+        paths = _setup(workdir, args)
+        print(f'{args.workers} workers, {len(paths)} timelines, {args.duration:.0f}s, '
+              f'locking {"on" if args.lock else "off"}, faults: {faults or "none"}\n')
+
+        ctx = multiprocessing.get_context('spawn')
+        results = ctx.Queue()
+        workers = [ctx.Process(target=_worker, args=(n, paths, args, faults, results)) for n in range(args.workers)]
+        start = time.monotonic()
+        for worker in workers:
+            worker.start()
+        records = []
+        for _ in workers:
+            records += results.get()
+        for worker in workers:
+            worker.join()
+        elapsed = time.monotonic() - start
+
+        # locks of killed operations are released by the workers, leftovers come from killed workers
+        for path in paths:
+            lockfile.FileLock(os.path.join(path, '.lock')).break_lock()
+        checks = {path: check(path) for path in paths}
+        report(records, elapsed, checks)
+        return 0 if all(repaired for _, repaired in checks.values()) else 1
+    finally:
+        if args.keep:
+            print(f'\ntrees kept in [{workdir}]')
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
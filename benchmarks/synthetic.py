@@ -0,0 +1,264 @@
+"""Synthetic repository trees for benchmarking
+
+The generated trees mimic the layout of real RPM (``repodata``, ``Packages/``)
+and Debian (``dists/*/binary-*``, ``pool/``) mirrors closely enough for the
+timeline code paths to behave as they do on a production mirror: package files
+are hard-linked, metadata directories/files match the default copy rules and
+the metadata itself carries valid sizes and checksums.
+"""
+
+import gzip
+import hashlib
+import os
+import random
+import time
+
+
+def _write(path, data):
+    """Write bytes to path, creating parent directories as needed"""
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as fh:
+        fh.write(data)
+
+
+def _replace(path, data):
+    """Replace path with a new inode holding data, like a mirror sync would"""
+
+    tmp_path = f'{path}.tmp'
+    _write(tmp_path, data)
+    os.replace(tmp_path, path)
+
+
+def _payload(rng, size):
+    """Return size pseudo-random bytes"""
+
+    return rng.getrandbits(8 * size).to_bytes(size, 'little') if size else b''
+
+
+def _nested(depth, rng):
+    """Return a relative directory which is depth levels deep"""
+
+    return os.path.join('', *[f'd{rng.randrange(4)}' for _ in range(depth)])
+
+
+class SyntheticRepository:
+    """Base class for generated repositories
+
+    ARGUMENTS:
+
+        root:       directory in which the repository is created
+        packages:   number of package files
+        depth:      number of extra directory levels below the package directories
+        size:       size of each package file in bytes
+        seed:       seed for the pseudo-random generator
+    """
+
+    kind = None
+
+    def __init__(self, root, packages=1000, depth=0, size=256, seed=0):
+        self.root = os.path.normpath(root)
+        self.packages = packages
+        self.depth = depth
+        self.size = size
+        self.generation = 0
+        self._rng = random.Random(seed)
+        # package file name -> relative path below the repository root
+        self._pkgs = {}
+        # relative path -> sha256 of the package file
+        self._sums = {}
+        self._counter = 0
+
+    def generate(self):
+        """Create the initial tree"""
+
+        for _ in range(self.packages):
+            self._add_package()
+        self.write_metadata()
+        return self
+
+    def sync(self, added=10, removed=5, inplace=0):
+        """Simulate one mirror run
+
+        Adds and removes package files, regenerates the metadata (new inodes)
+        and optionally rewrites <inplace> existing package files in place, which
+        is what a misconfigured sync tool would do to hard-linked snapshots.
+        """
+
+        self.generation += 1
+        for name in self._rng.sample(sorted(self._pkgs), min(removed, len(self._pkgs))):
+            relpath = self._pkgs.pop(name)
+            self._sums.pop(relpath, None)
+            os.unlink(os.path.join(self.root, relpath))
+        for _ in range(added):
+            self._add_package()
+        for name in self._rng.sample(sorted(self._pkgs), min(inplace, len(self._pkgs))):
+            with open(os.path.join(self.root, self._pkgs[name]), 'r+b') as fh:
+                fh.write(_payload(self._rng, self.size))
+            self._sums.pop(self._pkgs[name], None)
+        self.write_metadata()
+
+    def file_count(self):
+        """Return the number of files and directories below root"""
+
+        count = 0
+        for _, dirs, files in os.walk(self.root):
+            count += len(dirs) + len(files)
+        return count
+
+    def _next_name(self):
+        self._counter += 1
+        return f'pkg{self._counter:07d}'
+
+    def _add_package(self):
+        raise NotImplementedError
+
+    def write_metadata(self):
+        raise NotImplementedError
+
+    def _package_checksum(self, relpath):
+        if relpath not in self._sums:
+            with open(os.path.join(self.root, relpath), 'rb') as fh:
+                self._sums[relpath] = hashlib.sha256(fh.read()).hexdigest()
+        return self._sums[relpath]
+
+
+class RpmRepository(SyntheticRepository):
+    """Yum/dnf style repository with ``Packages/<letter>/`` and ``repodata/``"""
+
+    kind = 'rpm'
+
+    def _add_package(self):
+        name = self._next_name()
+        filename = f'{name}-1.{self.generation}-1.el9.x86_64.rpm'
+        relpath = os.path.join('Packages', name[-1], _nested(self.depth, self._rng), filename)
+        _write(os.path.join(self.root, relpath), _payload(self._rng, self.size))
+        self._pkgs[filename] = relpath
+
+    def write_metadata(self):
+        repodata = os.path.join(self.root, 'repodata')
+        os.makedirs(repodata, exist_ok=True)
+
+        entries = []
+        for filename, relpath in sorted(self._pkgs.items()):
+            name, version, release = filename[:-len('.x86_64.rpm')].rsplit('-', 2)
+            entries.append(
+                '<package type="rpm">'
+                f'<name>{name}</name><arch>x86_64</arch>'
+                f'<version epoch="0" ver="{version}" rel="{release}"/>'
+                f'<checksum type="sha256" pkgid="YES">{self._package_checksum(relpath)}</checksum>'
+                f'<location href="{relpath}"/>'
+                '</package>'
+            )
+        primary = (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<metadata xmlns="http://linux.duke.edu/metadata/common" '
+            'xmlns:rpm="http://linux.duke.edu/metadata/rpm" '
+            f'packages="{len(entries)}">\n' + '\n'.join(entries) + '\n</metadata>\n'
+        ).encode()
+
+        data = {
+            'primary': gzip.compress(primary, mtime=0),
+            'filelists': gzip.compress(b'<filelists/>\n', mtime=0),
+            'other': gzip.compress(b'<otherdata/>\n', mtime=0),
+        }
+
+        # checksum-prefixed file names, the old ones are removed like createrepo does
+        for old in os.listdir(repodata):
+            os.unlink(os.path.join(repodata, old))
+
+        repomd = ['<?xml version="1.0" encoding="UTF-8"?>',
+                  '<repomd xmlns="http://linux.duke.edu/metadata/repo">',
+                  f'  <revision>{int(time.time())}</revision>']
+        for mdtype, blob in data.items():
+            checksum = hashlib.sha256(blob).hexdigest()
+            href = f'repodata/{checksum}-{mdtype}.xml.gz'
+            _write(os.path.join(self.root, href), blob)
+            repomd.append(
+                f'  <data type="{mdtype}">'
+                f'<checksum type="sha256">{checksum}</checksum>'
+                f'<location href="{href}"/>'
+                f'<size>{len(blob)}</size>'
+                '</data>'
+            )
+        repomd.append('</repomd>')
+        _replace(os.path.join(repodata, 'repomd.xml'), ('\n'.join(repomd) + '\n').encode())
+
+
+class DebianRepository(SyntheticRepository):
+    """Debian/Ubuntu style repository with ``dists/`` and ``pool/``"""
+
+    kind = 'deb'
+    suites = ('stable', 'stable-updates')
+    components = ('main', 'contrib')
+    architectures = ('amd64', 'arm64')
+
+    def _add_package(self):
+        name = self._next_name()
+        component = self.components[self._counter % len(self.components)]
+        arch = self.architectures[self._counter // len(self.components) % len(self.architectures)]
+        filename = f'{name}_1.{self.generation}-1_{arch}.deb'
+        relpath = os.path.join('pool', component, name[-1], _nested(self.depth, self._rng), name, filename)
+        _write(os.path.join(self.root, relpath), _payload(self._rng, self.size))
+        self._pkgs[filename] = relpath
+
+    def write_metadata(self):
+        for suite in self.suites:
+            suite_path = os.path.join(self.root, 'dists', suite)
+            indices = {}
+            for component in self.components:
+                for arch in self.architectures:
+                    stanzas = []
+                    for filename, relpath in sorted(self._pkgs.items()):
+                        name, version, pkg_arch = filename[:-len('.deb')].split('_')
+                        if pkg_arch != arch or f'/{component}/' not in f'/{relpath}':
+                            continue
+                        stanzas.append(
+                            f'Package: {name}\nVersion: {version}\nArchitecture: {arch}\n'
+                            f'Filename: {relpath}\nSize: {self.size}\n'
+                            f'SHA256: {self._package_checksum(relpath)}\n'
+                        )
+                    packages = '\n'.join(stanzas).encode()
+                    binary = f'{component}/binary-{arch}'
+                    indices[f'{binary}/Packages'] = packages
+                    indices[f'{binary}/Packages.gz'] = gzip.compress(packages, mtime=0)
+                    indices[f'{binary}/Release'] = (
+                        f'Archive: {suite}\nComponent: {component}\nArchitecture: {arch}\n'
+                    ).encode()
+
+            for relpath, blob in indices.items():
+                _replace(os.path.join(suite_path, relpath), blob)
+                by_hash = os.path.join(suite_path, os.path.dirname(relpath), 'by-hash', 'SHA256',
+                                       hashlib.sha256(blob).hexdigest())
+                if not os.path.exists(by_hash):
+                    _write(by_hash, blob)
+
+            release = [f'Suite: {suite}', f'Codename: {suite}',
+                       f'Date: {time.strftime("%a, %d %b %Y %H:%M:%S UTC", time.gmtime())}',
+                       f'Architectures: {" ".join(self.architectures)}',
+                       f'Components: {" ".join(self.components)}',
+                       'Acquire-By-Hash: yes']
+            for field, algorithm in (('MD5Sum', 'md5'), ('SHA256', 'sha256')):
+                release.append(f'{field}:')
+                for relpath, blob in sorted(indices.items()):
+                    digest = hashlib.new(algorithm, blob).hexdigest()
+                    release.append(f' {digest} {len(blob):>16} {relpath}')
+            release = ('\n'.join(release) + '\n').encode()
+            _replace(os.path.join(suite_path, 'Release'), release)
+            _replace(os.path.join(suite_path, 'InRelease'),
+                     b'-----BEGIN PGP SIGNED MESSAGE-----\nHash: SHA256\n\n' + release +
+                     b'-----BEGIN PGP SIGNATURE-----\n\nc3ludGhldGlj\n-----END PGP SIGNATURE-----\n')
+            _replace(os.path.join(suite_path, 'Release.gpg'),
+                     b'-----BEGIN PGP SIGNATURE-----\n\nc3ludGhldGlj\n-----END PGP SIGNATURE-----\n')
+
+
+REPOSITORY_TYPES = {
+    'rpm': RpmRepository,
+    'deb': DebianRepository,
+}
+
+
+def generate(kind, root, **kwargs):
+    """Generate a synthetic repository of the given kind ('rpm' or 'deb') below root"""
+
+    return REPOSITORY_TYPES[kind](root, **kwargs).generate()
@@ -0,0 +1,32 @@
+import logging
+
+import pytest
+
+from benchmarks import synthetic
+from timeline import timeline
+
+logging.getLogger('Timeline').setLevel(logging.WARNING)
+
+
+@pytest.fixture
+def make_timeline(tmp_path):
+    """Return a function creating a timeline of a small synthetic repository (see benchmarks.synthetic)
+
+            the function returns (repository, timeline), snapshots get sub-second names. the repository
+            is imported into an in-memory backend (see timeline.filesystem.MemoryFileSystem)
+    """
+
+    def make(kind='rpm', packages=20, max_snapshots=90, backend=None, **options):
+        repo = synthetic.generate(kind, str(tmp_path / f'{kind}.src'), packages=packages, size=64)
+        if backend is not None and not backend.on_disk:
+            backend.import_tree(repo.root, repo.root)
+        t = timeline.Timeline(f'test-{kind}', repo.root, str(tmp_path / f'{kind}.timeline'), backend=backend)
+        t._debug = True
+        t._pipeline = 'inline'
+        t.set_max_snapshots(max_snapshots)
+        for name, value in options.items():
+            setattr(t, f'_{name}', value)
+        t.save()
+        return repo, t
+
+    return make
@@ -0,0 +1,55 @@
+import sqlite3
+
+from timeline import catalog
+
+
+def test_schema_is_created_once(tmp_path):
+    path = str(tmp_path / 'catalog.sqlite')
+    db = catalog.connect(path)
+    assert db.execute('PRAGMA user_version').fetchone()[0] == catalog.SCHEMA_VERSION
+    assert db.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    db.execute('DROP INDEX links_past_max_offset')
+    db.close()
+
+    # an existing catalog is opened as it is
+    db = catalog.connect(path)
+    assert not db.execute("SELECT name FROM sqlite_master WHERE name = 'links_past_max_offset'").fetchall()
+    db.close()
+
+
+def test_catalog_without_version_is_upgraded(tmp_path):
+    path = str(tmp_path / 'catalog.sqlite')
+    # created by the first version, which ran the schema on every connection
+    db = sqlite3.connect(path)
+    db.executescript(catalog._SCHEMA)
+    db.execute("INSERT INTO timelines (path, name) VALUES ('/srv/repo', 'repo')")
+    db.commit()
+    db.close()
+
+    db = catalog.connect(path)
+    assert db.execute('PRAGMA user_version').fetchone()[0] == catalog.SCHEMA_VERSION
+    assert db.execute('SELECT path, name FROM timelines').fetchall() == [('/srv/repo', 'repo')]
+    db.close()
+
+
+def test_catalog_is_updated_once_per_operation(make_timeline, tmp_path, monkeypatch):
+    path = str(tmp_path / 'catalog.sqlite')
+    repo, t = make_timeline(catalog_path=path)
+    updates = []
+    update = catalog.update
+    monkeypatch.setattr(catalog, 'update', lambda *args: updates.append(update(*args)))
+
+    for _ in range(3):
+        t.create_snapshot()
+    assert len(updates) == 3
+    t.create_link('upstream', max_offset=1)
+    t.create_link('pinned', t._lsnapshots[0])
+    assert len(updates) == 5
+    t.save()
+    assert len(updates) == 6
+
+    columns, rows = catalog.query(path, 'links')
+    assert rows == [(t._destination, 'pinned', t._lsnapshots[0], 3, 0),
+                    (t._destination, 'upstream', t._lsnapshots[-1], 1, 1)]
+    columns, rows = catalog.query(path, 'SELECT snapshots, newest FROM timelines')
+    assert rows == [(3, t._lsnapshots[-1])]
@@ -0,0 +1,70 @@
+import os
+
+from timeline import checksums
+
+
+def _package(repo, n=0):
+    return os.path.join(repo.root, sorted(repo._pkgs.values())[n])
+
+
+def test_verify_detects_in_place_modification(make_timeline):
+    repo, t = make_timeline()
+    t.create_snapshot()
+    t.record_checksums()
+    first = t._lsnapshots[-1]
+    t.create_snapshot()
+    t.record_checksums()
+    assert t.verify_snapshots() == {}
+
+    # a file rewritten in place changes in the source and in every snapshot holding it
+    path = _package(repo)
+    relpath = os.path.relpath(path, repo.root)
+    expected = checksums.hash_file(path)
+    with open(path, 'r+b') as fh:
+        fh.write(b'tampered')
+    drifted = t.verify_snapshots()
+    assert sorted(drifted) == sorted(t._lsnapshots)
+    for files in drifted.values():
+        assert files == [(relpath, expected, checksums.hash_file(path))]
+    assert list(t.verify_snapshots([first])) == [first]
+
+
+def test_verify_ignores_replaced_files_and_reports_missing_ones(make_timeline):
+    repo, t = make_timeline()
+    t.create_snapshot()
+    t.record_checksums()
+    snapshot = t._lsnapshots[-1]
+
+    # the mirror replaces files (new inode), the snapshot keeps the old one
+    repo.sync(added=2, removed=2)
+    assert t.verify_snapshots() == {}
+
+    path = os.path.join(t._snapshots[snapshot].path, 'repodata', 'repomd.xml')
+    os.remove(path)
+    drifted = t.verify_snapshots()
+    assert [(p, a) for p, _, a in drifted[snapshot]] == [('repodata/repomd.xml', None)]
+
+
+def test_record_hashes_every_inode_once(make_timeline, tmp_path):
+    repo, t = make_timeline()
+    t.create_snapshot()
+    t.record_checksums()
+    t.create_snapshot()
+
+    cache = checksums.ChecksumCache(os.path.join(t._checksums_path, 'cache.sqlite'))
+    try:
+        files, hashed, _ = checksums.record(t._snapshots[t._lsnapshots[-1]].path, str(tmp_path / 'manifest.gz'),
+                                            cache, t._lsnapshots[-1])
+    finally:
+        cache.close()
+    # only the files copied into the new snapshot (repomd.xml) have new inodes
+    previous, latest = (t._snapshots[s].path for s in t._lsnapshots)
+    repodata = os.listdir(os.path.join(latest, 'repodata'))
+    copied = [n for n in repodata if os.stat(os.path.join(latest, 'repodata', n)).st_ino
+              != os.stat(os.path.join(previous, 'repodata', n)).st_ino]
+    assert copied == ['repomd.xml']
+    assert files == len(repo._pkgs) + len(repodata)
+    assert hashed == 1
+    assert sorted(p for p, _ in checksums.read_manifest(str(tmp_path / 'manifest.gz'))) == sorted(
+        os.path.relpath(os.path.join(d, f), t._snapshots[t._lsnapshots[-1]].path)
+        for d, _, fs in os.walk(t._snapshots[t._lsnapshots[-1]].path) for f in fs)
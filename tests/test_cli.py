@@ -0,0 +1,58 @@
+import os
+import sys
+
+import pytest
+
+from timeline import cli
+from timeline import timeline
+
+
+def _mrepo(monkeypatch, *argv):
+    monkeypatch.setattr(sys, 'argv', ['mrepo', '--no-daemon'] + list(argv))
+    options = cli.setup_argparse()
+    options.func(options)
+
+
+def _files(t):
+    return {name: os.stat(os.path.join(t._destination, name)).st_mtime_ns
+            for name in (t._datafile_ext, t._cfgfile_ext)}
+
+
+@pytest.fixture
+def full_timeline(make_timeline):
+    _, t = make_timeline(max_snapshots=5)
+    for _ in range(5):
+        t.create_snapshot()
+    t.create_link('upstream', max_offset=1)
+    return t
+
+
+def test_config_dry_run_changes_nothing(monkeypatch, capsys, full_timeline):
+    t = full_timeline
+    os.mkdir(os.path.join(t._destination, '2001.01.01-000000'))
+    before = _files(t)
+
+    _mrepo(monkeypatch, 'config', t._destination, '--max-snapshots=3', '--consistency-check', '--dry-run')
+    assert capsys.readouterr().out
+    assert _files(t) == before
+    loaded = timeline.Timeline.load(t._destination)
+    assert loaded.get_max_snapshots() == 5
+    assert loaded._lsnapshots == t._lsnapshots
+    assert os.path.isdir(os.path.join(t._destination, '2001.01.01-000000'))
+
+
+def test_config_dry_run_rejects_freeze(monkeypatch, full_timeline):
+    t = full_timeline
+    for option in ('--freeze', '--unfreeze'):
+        with pytest.raises(Exception, match='--dry-run'):
+            _mrepo(monkeypatch, 'config', t._destination, option, '--dry-run')
+    assert not timeline.Timeline.load(t._destination)._frozen
+
+
+def test_config_applies_without_dry_run(monkeypatch, full_timeline):
+    t = full_timeline
+    _mrepo(monkeypatch, 'config', t._destination, '--max-snapshots=3', '--freeze')
+    loaded = timeline.Timeline.load(t._destination)
+    assert loaded.get_max_snapshots() == 3
+    assert len(loaded._lsnapshots) == 3
+    assert loaded._frozen
@@ -0,0 +1,138 @@
+import os
+import shutil
+
+import pytest
+
+from timeline import filesystem
+from timeline import timeline
+
+
+def _snapshots(make_timeline, count=3):
+    repo, t = make_timeline()
+    for _ in range(count):
+        t.create_snapshot()
+    return t
+
+
+def test_broken_and_missing_links_are_deleted(make_timeline):
+    t = _snapshots(make_timeline)
+    first, second, third = t._lsnapshots
+    t.create_link('broken', first)
+    t.create_link('missing', second)
+    t.create_link('upstream', third, max_offset=1)
+    shutil.rmtree(t._snapshots[first].path)
+    os.remove(t._links['missing'].path)
+
+    plan = t.consistency_check()
+    assert plan.drop_snapshots == [first]
+    assert sorted(plan.drop_links) == ['broken', 'missing']
+    assert plan.relink == {}
+    assert sorted(t._links) == ['upstream']
+    assert t._snapshots[second].links == []
+    assert not os.path.lexists(os.path.join(t._destination, 'broken'))
+    assert not os.path.lexists(os.path.join(t._destination, 'missing'))
+    assert not t.consistency_check(dry_run=True)
+
+
+def test_links_to_other_targets_are_left_alone(make_timeline):
+    t = _snapshots(make_timeline)
+    first, second, third = t._lsnapshots
+    t.create_link('pinned', first)
+    path = t._links['pinned'].path
+    os.remove(path)
+    os.symlink(third, path)
+
+    assert not t.consistency_check()
+    assert os.readlink(path) == third
+    assert t._links['pinned'].snapshot == first
+
+    # the snapshot of the link is gone, the link moves to the neighbour like with delete_snapshot()
+    shutil.rmtree(t._snapshots[first].path)
+    plan = t.consistency_check()
+    assert plan.relink == {'pinned': second}
+    assert os.readlink(path) == second
+    assert t._snapshots[second].links == ['pinned']
+
+
+def test_frozen_timeline_is_not_repaired(make_timeline):
+    t = _snapshots(make_timeline, 2)
+    t.create_link('missing', t._lsnapshots[0])
+    os.remove(t._links['missing'].path)
+    t.freeze()
+
+    assert t.consistency_check(dry_run=True).drop_links == ['missing']
+    with pytest.raises(Exception, match='frozen'):
+        t.consistency_check()
+    assert 'missing' in t._links
+
+
+def test_snapshots_being_built_are_not_orphans(make_timeline):
+    t = _snapshots(make_timeline, 2)
+
+    # create_snapshot() in another process: saved in the metadata file before it is built
+    other = timeline.Timeline.load(t._destination)
+    other._debug = True
+    building = other.create_snapshot()
+    other.save()
+
+    # import_snapshots() in another process: on disk only, after the metadata file was written
+    importing = os.path.join(t._destination, '2999.01.01-000000')
+    os.mkdir(importing)
+
+    plan = t.consistency_check()
+    assert building not in t._snapshots
+    assert plan.remove_paths == []
+    assert os.path.isdir(other._snapshots[building].path)
+    assert os.path.isdir(importing)
+
+
+def _backend(name):
+    return filesystem.MemoryFileSystem() if name == 'memory' else filesystem.create(name)
+
+
+@pytest.mark.parametrize('backend', ['native', 'subprocess', 'memory'])
+def test_orphans_are_removed_and_unknown_objects_reported(make_timeline, backend):
+    _, t = make_timeline(backend=_backend(backend))
+    for _ in range(2):
+        t.create_snapshot()
+    t.create_link('upstream', t._lsnapshots[-1], max_offset=1)
+
+    # an orphan snapshot directory and a stray file, left before the metadata file was written
+    orphan = os.path.join(t._destination, '2001.01.01-000000')
+    stray = os.path.join(t._destination, 'stray.txt')
+    if t._fs.on_disk:
+        os.mkdir(orphan)
+        with open(stray, 'w') as fh:
+            fh.write('stray\n')
+    else:
+        t._fs.makedirs(orphan)
+        t._fs.write_file(stray, 6)
+    t.save()
+
+    plan = t.consistency_check(dry_run=True)
+    assert (plan.remove_paths, plan.unknown) == ([orphan], [stray])
+    assert t._fs.isdir(orphan)
+
+    plan = t.consistency_check()
+    assert plan.remove_paths == [orphan]
+    assert not t._fs.exists(orphan) and t._fs.exists(stray)
+    entries = t._fs.entries(t._destination)
+    assert sorted(name for name, kind in entries.items() if kind == filesystem.DIR) == sorted(t._lsnapshots)
+    assert entries['upstream'] == filesystem.SYMLINK
+
+    plan = t.consistency_check(dry_run=True)
+    assert not plan and plan.unknown == [stray]
+
+
+@pytest.mark.parametrize('backend', ['native', 'memory'])
+def test_stale_manifests_are_removed(make_timeline, backend):
+    _, t = make_timeline(backend=_backend(backend))
+    t.create_snapshot()
+    manifest = t._checksums_manifest('2001.01.01-000000')
+    os.makedirs(os.path.dirname(manifest), exist_ok=True)
+    with open(manifest, 'w') as fh:
+        fh.write('\n')
+
+    plan = t.consistency_check()
+    assert plan.remove_paths == [manifest]
+    assert not os.path.exists(manifest)
@@ -0,0 +1,84 @@
+import asyncio
+import os
+import socket
+import sys
+import threading
+
+import pytest
+
+from timeline import cli
+from timeline import daemon
+from timeline import timeline
+
+
+@pytest.fixture
+def serve(tmp_path, monkeypatch):
+    """Return a function starting a daemon with the given commands on a socket in tmp_path"""
+
+    path = str(tmp_path / 'mrepo.sock')
+    monkeypatch.setenv('MREPO_SOCKET', path)
+    loops = []
+
+    def start(commands, **kwargs):
+        d = daemon.Daemon(commands, path, workers=2, **kwargs)
+        d._stdout = daemon._ThreadLocalStream(sys.stdout)
+        monkeypatch.setattr(sys, 'stdout', d._stdout)
+        loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        async def listen():
+            await asyncio.start_unix_server(d._handle, path=path)
+            started.set()
+
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(listen(), loop)
+        started.wait(5)
+        loops.append(loop)
+        return d
+
+    yield start
+    for loop in loops:
+        loop.call_soon_threadsafe(loop.stop)
+
+
+def _echo(options):
+    print(f'hello {options.repository}')
+
+
+def test_peer_uid():
+    a, b = socket.socketpair(socket.AF_UNIX)
+    with a, b:
+        assert daemon.peer_uid(a) == os.getuid()
+
+
+def test_requests_of_the_daemon_user_are_executed(serve, tmp_path):
+    serve({'echo': _echo})
+    response = daemon.forward('echo', {'repository': str(tmp_path / 'repo')})
+    assert response == {'status': 0, 'output': f'hello {tmp_path}/repo\n', 'error': None}
+
+
+def test_requests_of_other_users_are_rejected(serve):
+    d = serve({'echo': _echo})
+    d._uids = {os.getuid() + 1}
+    response = daemon.forward('echo', {'repository': 'repo'})
+    assert response['status'] == 2
+    assert response['error'] == 'permission denied'
+    assert response['output'] == ''
+
+    d._uids.add(os.getuid())
+    assert daemon.forward('echo', {'repository': 'repo'})['status'] == 0
+
+
+def test_stale_socket_runs_locally(make_timeline, tmp_path, monkeypatch):
+    _, t = make_timeline()
+    path = str(tmp_path / 'stale.sock')
+    stale = socket.socket(socket.AF_UNIX)
+    stale.bind(path)
+    stale.close()
+    monkeypatch.setenv('MREPO_SOCKET', path)
+    assert os.path.exists(path)
+    assert daemon.forward('config', {'repository': t._destination}) is None
+
+    monkeypatch.setattr(sys, 'argv', ['mrepo', 'config', '--max-snapshots', '10', t._destination])
+    cli.main()
+    assert timeline.Timeline.load(t._destination)._max_snapshots == 10
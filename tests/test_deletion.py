@@ -0,0 +1,122 @@
+import os
+
+import pytest
+
+from timeline import filesystem
+from timeline import timeline
+
+
+def _timeline(make_timeline, count):
+    repo, t = make_timeline()
+    for _ in range(count):
+        t.create_snapshot()
+    return t
+
+
+def test_removal_is_saved_in_batches(make_timeline, monkeypatch):
+    t = _timeline(make_timeline, 6)
+    saves = []
+    save_state = timeline.Timeline._save_state
+
+    def counted(self):
+        saves.append(list(self._pending_deletions))
+        save_state(self)
+    monkeypatch.setattr(timeline.Timeline, '_save_state', counted)
+
+    deleted = t._lsnapshots[:3]
+    t.set_max_snapshots(3)
+    t.rotate_snapshots()
+    # the rotation itself, then the progress once at the end
+    assert len(saves) == 2
+    assert len(saves[0]) == 3 and saves[-1] == []
+    assert not any(os.path.exists(os.path.join(t._destination, s)) for s in deleted)
+
+    t.set_max_snapshots(90)
+    for _ in range(3):
+        t.create_snapshot()
+    t.set_max_snapshots(3)
+    t._pending_save_interval = 0
+    saves.clear()
+    t.rotate_snapshots(jobs=1)
+    assert [len(pending) for pending in saves] == [3, 2, 1, 0]
+
+
+def test_interrupted_removal_is_resumed(make_timeline, monkeypatch):
+    t = _timeline(make_timeline, 6)
+    deleted = [t._snapshots[s].path for s in t._lsnapshots[:3]]
+    remove_tree = t._fs.remove_tree
+    removed = []
+
+    def interrupted(path, inodes=None):
+        if removed:
+            raise RuntimeError('interrupted')
+        remove_tree(path, inodes)
+        removed.append(path)
+    monkeypatch.setattr(t._fs, 'remove_tree', interrupted)
+
+    t.set_max_snapshots(3)
+    with pytest.raises(RuntimeError):
+        t.rotate_snapshots(jobs=1)
+    assert len(t._lsnapshots) == 3
+
+    # the progress up to the interruption was saved
+    state = timeline.Timeline.read_metadata(t._destination)
+    assert sorted(state['_pending_deletions']) == sorted(set(deleted) - set(removed))
+    assert not os.path.exists(removed[0])
+
+    resumed = timeline.Timeline.load(t._destination)
+    resumed.rotate_snapshots()
+    assert resumed._pending_deletions == []
+    assert timeline.Timeline.read_metadata(t._destination)['_pending_deletions'] == []
+    assert not any(os.path.exists(path) for path in deleted)
+
+
+def _backend(name):
+    return filesystem.MemoryFileSystem() if name == 'memory' else filesystem.create(name)
+
+
+def _bookkeeping_files(t, snapshot):
+    """Write a diff log, a checksum manifest and a digest index of snapshot on the host, return their paths"""
+
+    t._diff_log_path = os.path.join(os.path.dirname(t._destination), 'diff')
+    paths = [os.path.join(t._diff_log_path, f'{t._name}__{snapshot}{t._difflog_ext}'),
+             t._checksums_manifest(snapshot), t._digests_index(snapshot)]
+    for path in paths:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fh:
+            fh.write('\n')
+    t._snapshots[snapshot].diff_log_file = paths[0]
+    t.save()
+    return paths
+
+
+def _snapshot_dirs(t):
+    return sorted(name for name, kind in t._fs.entries(t._destination).items()
+                  if kind == filesystem.DIR and t._snapshot_name_re.match(name))
+
+
+@pytest.mark.parametrize('backend', ['native', 'subprocess', 'memory'])
+def test_delete_snapshot_removes_bookkeeping_files(make_timeline, backend):
+    _, t = make_timeline(backend=_backend(backend))
+    for _ in range(2):
+        t.create_snapshot()
+    snapshot = t._lsnapshots[0]
+    paths = _bookkeeping_files(t, snapshot)
+
+    t.delete_snapshot(snapshot)
+    assert _snapshot_dirs(t) == t._lsnapshots
+    assert not any(os.path.exists(path) for path in paths)
+
+
+@pytest.mark.parametrize('backend', ['native', 'subprocess', 'memory'])
+def test_rotation_removes_bookkeeping_files(make_timeline, backend):
+    _, t = make_timeline(max_snapshots=3, backend=_backend(backend))
+    for _ in range(3):
+        t.create_snapshot()
+    snapshot = t._lsnapshots[0]
+    paths = _bookkeeping_files(t, snapshot)
+
+    t.create_snapshot()
+    assert snapshot not in t._snapshots and t._pending_deletions == []
+    assert _snapshot_dirs(t) == t._lsnapshots
+    assert not any(os.path.exists(path) for path in paths)
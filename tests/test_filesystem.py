@@ -0,0 +1,47 @@
+import os
+
+import pytest
+
+from timeline import filesystem
+
+
+def test_backends_implement_the_interface():
+    with pytest.raises(TypeError):
+        filesystem.FileSystem()
+
+    class Incomplete(filesystem.FileSystem):
+        def exists(self, path):
+            return False
+    with pytest.raises(TypeError):
+        Incomplete()
+
+    for backend in (*filesystem.BACKENDS.values(), filesystem.MemoryFileSystem):
+        assert isinstance(backend(), filesystem.FileSystem)
+
+
+def _backend(name, root):
+    if name != 'memory':
+        return filesystem.create(name)
+    fs = filesystem.MemoryFileSystem()
+    fs.import_tree(root, root)
+    return fs
+
+
+@pytest.mark.parametrize('backend', ['native', 'subprocess', 'memory'])
+def test_find_returns_the_requested_kind_only(tmp_path, backend):
+    root = str(tmp_path / 'repo')
+    for rel in ('a/repodata/repomd.xml', 'a/repoview/index.html', 'b/repodata.bak/file', 'c/other'):
+        os.makedirs(os.path.join(root, os.path.dirname(rel)), exist_ok=True)
+        with open(os.path.join(root, rel), 'w') as fh:
+            fh.write('')
+    # a file with the name of a directory pattern and the other way round
+    for rel in ('c/repoview', 'c/Release', 'b/Release/x'):
+        os.makedirs(os.path.dirname(os.path.join(root, rel)), exist_ok=True)
+        with open(os.path.join(root, rel), 'w') as fh:
+            fh.write('')
+    fs = _backend(backend, root)
+
+    found = fs.find(root, ['repodata', 'repoview'], filesystem.DIR)
+    assert sorted(os.path.relpath(p, root) for p in found) == ['a/repodata', 'a/repoview']
+    found = fs.find(root, ['Release', 'repomd.xml', 'repoview'], filesystem.FILE)
+    assert sorted(os.path.relpath(p, root) for p in found) == ['a/repodata/repomd.xml', 'c/Release', 'c/repoview']
@@ -0,0 +1,64 @@
+import os
+
+from timeline import history
+
+
+def test_parse_diff_report():
+    lines = [
+        'Only in /t/new/Packages/a: pkg1.rpm\n',
+        'Only in /t/old/Packages/b: pkg2.rpm\n',
+        'Only in /t/new: extras\n',
+        'Files /t/new/repodata/repomd.xml and /t/old/repodata/repomd.xml differ\n',
+        'File /t/new/iso is a directory while file /t/old/iso is a regular file\n',
+        'diff: /t/new/broken: No such file or directory\n',
+    ]
+    assert list(history.parse_diff_report(lines, '/t/new', '/t/old')) == [
+        ('Packages/a/pkg1.rpm', history.ADDED),
+        ('Packages/b/pkg2.rpm', history.REMOVED),
+        ('extras', history.ADDED),
+        ('repodata/repomd.xml', history.MODIFIED),
+        ('iso', history.MODIFIED),
+    ]
+
+
+def test_path_history_survives_rotation(make_timeline, tmp_path):
+    repo, t = make_timeline(packages=5, max_snapshots=3, diff_log_path=str(tmp_path / 'diff'))
+    t.create_snapshot()
+    first = t._lsnapshots[-1]
+    removed = sorted(repo._pkgs)[0]
+    path = repo._pkgs[removed]
+
+    created = [first]
+    while removed in repo._pkgs:
+        repo.sync(added=1, removed=1)
+        created.append(t.create_snapshot())
+    gone = created[-1]
+    for _ in range(3):
+        repo.sync(added=1, removed=0)
+        created.append(t.create_snapshot())
+
+    # the snapshot which removed the package and its diff report are rotated away, the history is kept
+    assert gone not in t._snapshots
+    assert not any(name.startswith(f'{t._name}__{gone}__') for name in os.listdir(tmp_path / 'diff'))
+    assert t.path_history(path) == [(path, gone, created[created.index(gone) - 1], history.REMOVED)]
+
+    # the copied metadata is left out of the diff reports
+    assert t.path_history('repodata') == []
+    changes = t.path_history('Packages')
+    assert {change for _, _, _, change in changes} == {history.ADDED, history.REMOVED}
+    assert (path, gone, created[created.index(gone) - 1], history.REMOVED) in changes
+    # not recursive: only the changes of the directory itself
+    assert t.path_history('Packages', recursive=False) == []
+
+
+def test_missing_reports_are_added_later(make_timeline, tmp_path):
+    repo, t = make_timeline(packages=5, diff_log_path=str(tmp_path / 'diff'))
+    for _ in range(3):
+        t.create_snapshot()
+        repo.sync(added=1, removed=1)
+    expected = t.path_history('')
+    assert expected
+
+    os.remove(os.path.join(t._destination, t._index_file))
+    t.index_diff_reports()
+    assert t.path_history('') == expected
@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+from timeline import immutable
+
+
+def test_rules():
+    is_immutable = immutable.compile_rules(immutable.DEFAULT_RULES)
+    assert is_immutable('repodata/' + 'a' * 64 + '-primary.xml.gz')
+    assert is_immutable('el9/repodata/' + '0' * 32 + '-comps.xml')
+    assert not is_immutable('repodata/repomd.xml')
+    assert not is_immutable('repodata/primary.xml.gz')
+    assert is_immutable('dists/stable/main/binary-amd64/by-hash/SHA256/' + 'f' * 64)
+    assert not is_immutable('dists/stable/main/binary-amd64/Packages.gz')
+    assert immutable.compile_rules([]) is None
+
+
+def _copied_files(t, snapshot, in_copied):
+    """Return {relative path: shares its inode with the source} of the files below the copied metadata"""
+
+    path = t._snapshots[snapshot].path
+    result = {}
+    for directory, _, files in os.walk(path):
+        for name in files:
+            rel = os.path.relpath(os.path.join(directory, name), path)
+            if in_copied(rel):
+                result[rel] = os.stat(os.path.join(path, rel)).st_ino == os.stat(os.path.join(t._source, rel)).st_ino
+    return result
+
+
+_IN_COPIED = {
+    'rpm': lambda rel: rel.startswith('repodata/'),
+    'deb': lambda rel: '/binary-' in rel,
+}
+
+
+@pytest.mark.parametrize('kind', ['rpm', 'deb'])
+def test_content_addressed_files_stay_hard_linked(make_timeline, kind):
+    repo, t = make_timeline(kind=kind)
+    is_immutable = immutable.compile_rules(t._immutable_files_recursive)
+    files = _copied_files(t, t.create_snapshot(), _IN_COPIED[kind])
+
+    assert any(files.values()) and not all(files.values())
+    assert files == {rel: is_immutable(rel) for rel in files}
+
+    # a mutable file rewritten in place by the mirror tool does not change the snapshot
+    mutable = sorted(rel for rel, linked in files.items() if not linked)[0]
+    with open(os.path.join(t._snapshots[t._lsnapshots[-1]].path, mutable), 'rb') as fh:
+        content = fh.read()
+    with open(os.path.join(repo.root, mutable), 'r+b') as fh:
+        fh.write(b'rewritten')
+    with open(os.path.join(t._snapshots[t._lsnapshots[-1]].path, mutable), 'rb') as fh:
+        assert fh.read() == content
+
+
+def test_without_rules_everything_is_copied(make_timeline):
+    repo, t = make_timeline(immutable_files_recursive=[])
+    files = _copied_files(t, t.create_snapshot(), _IN_COPIED['rpm'])
+    assert len(files) > 1 and not any(files.values())
@@ -0,0 +1,102 @@
+import os
+
+from timeline import immutable
+from timeline import learn
+from timeline import timeline
+
+
+def _write(path, data, inplace=False):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if inplace:
+        with open(path, 'r+b') as fh:
+            fh.write(data)
+        return
+    with open(path + '.tmp', 'wb') as fh:
+        fh.write(data)
+    os.replace(path + '.tmp', path)
+
+
+def _observe(destination, source):
+    learner = learn.Learner(destination)
+    try:
+        return learner.observe(source)
+    finally:
+        learner.close()
+
+
+def _suggest(destination, copy_dirs, copy_files, rules=()):
+    learner = learn.Learner(destination)
+    try:
+        return learner.suggest(copy_dirs, copy_files, immutable.compile_rules(rules))
+    finally:
+        learner.close()
+
+
+def test_files_modified_in_place_are_covered_by_the_cheapest_rules(tmp_path):
+    source, destination = str(tmp_path / 'source'), str(tmp_path)
+    files = {
+        'repodata/repomd.xml': 100,
+        'repodata/primary.xml.gz': 1000,
+        'dists/stable/Release': 10,
+        'dists/stable/by-hash/SHA256/abc': 10,
+        'Packages/a.rpm': 5000,
+    }
+    for rel, size in files.items():
+        _write(os.path.join(source, rel), b'x' * size)
+    assert _observe(destination, source) == []
+
+    # rewritten in place (same inode) or replaced by a new file
+    for rel in ('repodata/repomd.xml', 'dists/stable/Release', 'dists/stable/by-hash/SHA256/abc'):
+        _write(os.path.join(source, rel), b'y' * (files[rel] + 1), inplace=True)
+    _write(os.path.join(source, 'repodata/primary.xml.gz'), b'z' * 1000)
+    assert sorted(_observe(destination, source)) == [
+        'dists/stable/Release', 'dists/stable/by-hash/SHA256/abc', 'repodata/repomd.xml']
+    os.remove(os.path.join(source, 'dists/stable/Release'))
+    _observe(destination, source)
+
+    suggestion = _suggest(destination, ['repodata'], [], immutable.DEBIAN_RULES)
+    assert suggestion.observations == 3
+    # the content-addressed file is never copied, the removed one still counts
+    assert suggestion.modified == ['dists/stable/Release', 'dists/stable/by-hash/SHA256/abc', 'repodata/repomd.xml']
+    assert suggestion.missed == ['dists/stable/Release']
+    assert (suggestion.copy_dirs, suggestion.copy_files) == ([], ['Release', 'repomd.xml'])
+    assert (suggestion.current_bytes, suggestion.bytes) == (1101, 101)
+
+
+def test_file_rules_are_preferred_on_a_tie(tmp_path):
+    source, destination = str(tmp_path / 'source'), str(tmp_path)
+    for arch in ('amd64', 'arm64'):
+        for name in ('Packages', 'Release'):
+            _write(os.path.join(source, 'dists', f'binary-{arch}', name), b'x' * 10)
+    _observe(destination, source)
+    for arch in ('amd64', 'arm64'):
+        for name in ('Packages', 'Release'):
+            _write(os.path.join(source, 'dists', f'binary-{arch}', name), b'y' * 20, inplace=True)
+    _observe(destination, source)
+
+    # 'dists' covers all four files for the same bytes as the file rules, which do not copy files added later
+    suggestion = _suggest(destination, [], [])
+    assert suggestion.missed == suggestion.modified and len(suggestion.modified) == 4
+    assert (suggestion.copy_dirs, suggestion.copy_files) == ([], ['Packages', 'Release'])
+    assert suggestion.bytes == 80
+
+
+def test_rules_are_learned_by_the_pipeline_and_applied(make_timeline):
+    repo, t = make_timeline(learn_copy_rules=2, learn_copy_rules_apply=True)
+    t.create_snapshot()
+    assert t._copy_dirs_recursive == ['repodata']
+
+    # a package rewritten in place, the metadata is replaced
+    repo.sync(added=0, removed=0, inplace=1)
+    t.create_snapshot()
+    suggestion = t.learn_copy_rules()
+    assert suggestion.observations == 2 and len(suggestion.modified) == 1
+    modified = suggestion.modified[0]
+    loaded = timeline.Timeline.load(t._destination)
+    assert (loaded._copy_dirs_recursive, loaded._copy_files_recursive) == ([], [os.path.basename(modified)])
+
+    # the learned rules copy the package, observation is over
+    snapshot = loaded.create_snapshot()
+    path = os.path.join(loaded._snapshots[snapshot].path, modified)
+    assert os.stat(path).st_ino != os.stat(os.path.join(repo.root, modified)).st_ino
+    assert loaded.learn_copy_rules().observations == 2
@@ -0,0 +1,67 @@
+import json
+import os
+
+from timeline import listing
+
+
+def _entries(directory):
+    with open(os.path.join(directory, listing.JSON_NAME)) as fh:
+        return {item['name']: item for item in json.load(fh)['entries']}
+
+
+def _inode(directory):
+    return os.stat(os.path.join(directory, listing.JSON_NAME)).st_ino
+
+
+def test_listings_of_unchanged_directories_are_reused(make_timeline, tmp_path):
+    repo, t = make_timeline(render_listings=True, diff_log_path=str(tmp_path / 'diff'))
+    previous = t._snapshots[t.create_snapshot()].path
+    repo.sync(added=1, removed=0)
+    latest = t._snapshots[t.create_snapshot()].path
+    added, relpath = max(repo._pkgs.items())
+    changed = os.path.dirname(relpath)
+
+    for root, dirs, files in os.walk(latest):
+        assert set(listing.NAMES) <= set(files)
+        assert set(_entries(root)) == set(dirs) | set(files) - set(listing.NAMES)
+    # the source is left alone
+    assert not os.path.exists(os.path.join(repo.root, listing.JSON_NAME))
+
+    # hard-linked from the previous snapshot: the same files and subdirectories
+    for relpath in ('', 'Packages', os.path.join('Packages', '2')):
+        assert _inode(os.path.join(latest, relpath)) == _inode(os.path.join(previous, relpath))
+    # rendered: new package files and metadata files with new inodes
+    for relpath in (changed, 'repodata'):
+        assert _inode(os.path.join(latest, relpath)) != _inode(os.path.join(previous, relpath))
+    item = _entries(os.path.join(latest, changed))[added]
+    assert item['type'] == 'file' and item['size'] == os.path.getsize(os.path.join(latest, changed, added))
+    with open(os.path.join(latest, changed, listing.HTML_NAME)) as fh:
+        assert added in fh.read()
+
+    # the listings follow the directory contents, they are no changes of their own
+    with open(t._snapshots[t._lsnapshots[-1]].diff_log_file) as fh:
+        assert not any(name in line for line in fh for name in listing.NAMES)
+
+
+def test_directories_with_own_listings_are_skipped(tmp_path):
+    root = tmp_path / 'snapshot'
+    (root / 'web').mkdir(parents=True)
+    (root / 'web' / listing.HTML_NAME).write_text('mirrored')
+    (root / 'data').mkdir()
+    (root / 'data' / 'file').write_text('content')
+
+    stats = listing.write_listings(str(root))
+    assert (stats.dirs, stats.rendered, stats.reused, stats.skipped) == (3, 2, 0, 1)
+    assert (root / 'web' / listing.HTML_NAME).read_text() == 'mirrored'
+    assert not (root / 'web' / listing.JSON_NAME).exists()
+    assert _entries(str(root / 'data'))['file']['size'] == len('content')
+
+    # directories whose entries differ from the previous tree are rendered again
+    (root / 'data' / 'new').write_text('')
+    copy = tmp_path / 'copy'
+    os.makedirs(copy / 'data')
+    for name in ('file', 'new'):
+        os.link(root / 'data' / name, copy / 'data' / name)
+    stats = listing.write_listings(str(copy), str(root))
+    assert (stats.rendered, stats.reused) == (2, 0)
+    assert set(_entries(str(copy / 'data'))) == {'file', 'new'}
@@ -0,0 +1,77 @@
+import os
+import shutil
+
+from timeline import history
+from timeline import merkle
+
+
+def _tree(root):
+    for rel, data in (('same/file', b'1'), ('changed/kept', b'2'), ('changed/removed', b'3'),
+                      ('copied/repomd.xml', b'4')):
+        os.makedirs(os.path.join(root, os.path.dirname(rel)), exist_ok=True)
+        with open(os.path.join(root, rel), 'wb') as fh:
+            fh.write(data)
+    os.symlink('same/file', os.path.join(root, 'link'))
+
+
+def _link_tree(source, target):
+    shutil.copytree(source, target, symlinks=True, copy_function=os.link)
+
+
+def test_unchanged_directories_are_not_read(tmp_path, monkeypatch):
+    a, b = str(tmp_path / 'a'), str(tmp_path / 'b')
+    _tree(a)
+    _link_tree(a, b)
+    hashed = lambda rel: rel.startswith('copied/')
+
+    # copied files get a new inode, identified by their content
+    os.remove(os.path.join(b, 'copied', 'repomd.xml'))
+    shutil.copy2(os.path.join(a, 'copied', 'repomd.xml'), os.path.join(b, 'copied', 'repomd.xml'))
+    tree_a, tree_b = merkle.digests(a, hashed), merkle.digests(b, hashed)
+    assert tree_a == tree_b and set(tree_a) == {'', 'same', 'changed', 'copied'}
+    assert list(merkle.compare(a, tree_a, b, tree_b)) == []
+
+    os.remove(os.path.join(b, 'changed', 'removed'))
+    with open(os.path.join(b, 'changed', 'added'), 'wb') as fh:
+        fh.write(b'5')
+    os.remove(os.path.join(b, 'link'))
+    os.symlink('changed/kept', os.path.join(b, 'link'))
+    tree_b = merkle.digests(b, hashed)
+    assert [tree_a[d] == tree_b[d] for d in ('', 'same', 'changed', 'copied')] == [False, True, False, True]
+
+    # the index holds the same digests
+    index = str(tmp_path / 'index' / 'b.merkle.gz')
+    merkle.write_index(index, tree_b)
+    assert merkle.read_index(index) == tree_b
+
+    scanned = []
+    entries = merkle._entries
+    monkeypatch.setattr(merkle, '_entries', lambda directory, skip: scanned.append(directory) or entries(directory, skip))
+    assert sorted(merkle.compare(a, tree_a, b, merkle.read_index(index))) == [
+        ('changed/added', history.ADDED), ('changed/removed', history.REMOVED), ('link', history.MODIFIED)]
+    assert sorted(os.path.relpath(d, tmp_path) for d in scanned) == ['a', 'a/changed', 'b', 'b/changed']
+
+
+def test_compare_snapshots(make_timeline):
+    repo, t = make_timeline(directory_digests=True, render_listings=True)
+    first = t.create_snapshot()
+    before = dict(repo._pkgs)
+    repo.sync(added=1, removed=1)
+    second = t.create_snapshot()
+    assert os.path.exists(t._digests_index(second))
+
+    packages = {(relpath, history.REMOVED) for name, relpath in before.items() if name not in repo._pkgs}
+    packages |= {(relpath, history.ADDED) for name, relpath in repo._pkgs.items() if name not in before}
+    changes = t.compare(first, second)
+    assert {change for change in changes if change[0].startswith('Packages/')} == packages
+    assert all(path.startswith(('Packages/', 'repodata/')) for path, _ in changes)
+    assert ('repodata/repomd.xml', history.MODIFIED) in changes
+
+    # the listings are left out, the newest snapshot matches its source
+    assert t.compare(second) == []
+    # without a recorded index the digests are computed
+    os.remove(t._digests_index(first))
+    assert t.compare(first, second) == changes
+
+    t.delete_snapshot(second)
+    assert not os.path.exists(t._digests_index(second))
@@ -0,0 +1,64 @@
+import os
+
+import pytest
+
+from timeline import packages
+
+
+def _snapshots(make_timeline, count, **options):
+    """Return a repository, its timeline and {package name: snapshots containing it} of count snapshots"""
+
+    repo, t = make_timeline(packages=5, **options)
+    contained = {}
+    for n in range(count):
+        if n:
+            repo.sync(added=1, removed=1)
+        snapshot = t.create_snapshot()
+        for filename in repo._pkgs:
+            contained.setdefault(filename.split('-')[0], []).append(snapshot)
+    return repo, t, contained
+
+
+def _intervals(t):
+    """Return {package name: [(first snapshot, last snapshot), ...]} of the package index"""
+
+    index = packages.PackageIndex(os.path.join(t._destination, t._index_file))
+    try:
+        rows = index._db.execute('SELECT p.name FROM packages p').fetchall()
+        return {name: [(first, last) for _, _, _, first, last in index.lookup(name)] for name, in rows}
+    finally:
+        index.close()
+
+
+def test_packages_are_indexed_with_first_and_last_snapshot(make_timeline):
+    repo, t, contained = _snapshots(make_timeline, 4, package_index=True)
+    assert _intervals(t) == {name: [(snapshots[0], snapshots[-1])] for name, snapshots in contained.items()}
+    name = sorted(repo._pkgs)[-1].split('-')[0]
+    assert t.find_package(name) == [(name, '1.3-1.el9', 'x86_64', t._lsnapshots[-1], t._lsnapshots[-1])]
+
+
+def test_out_of_order_generations_are_rejected(make_timeline):
+    repo, t, contained = _snapshots(make_timeline, 3)
+    first, second, third = t._lsnapshots
+
+    # given newest first, the snapshots are still added oldest first
+    t._package_index = True
+    t.index_packages([third, first, second])
+    ordered = _intervals(t)
+    assert ordered == {name: [(snapshots[0], snapshots[-1])] for name, snapshots in contained.items()}
+
+    index = packages.PackageIndex(os.path.join(t._destination, t._index_file))
+    try:
+        with pytest.raises(ValueError, match='older than the newest generation'):
+            index.update(t._snapshots[second].path, t._snapshots[second].seq, second)
+    finally:
+        index.close()
+    assert _intervals(t) == ordered
+
+    # an index built snapshot by snapshot is the same
+    os.remove(os.path.join(t._destination, t._index_file))
+    for snapshot in t._lsnapshots:
+        t.index_packages([snapshot])
+    assert _intervals(t) == ordered
+    t.index_packages()
+    assert _intervals(t) == ordered
@@ -0,0 +1,67 @@
+import configparser
+import threading
+
+from timeline import pipeline
+from timeline import timeline
+
+
+def test_pipeline_runs_inline_by_default(make_timeline):
+    repo, t = make_timeline()
+    cfg = configparser.ConfigParser()
+    cfg.read(t._cfgfile)
+    cfg.remove_option('MAIN', 'pipeline')
+    with open(t._cfgfile, 'w') as fh:
+        cfg.write(fh)
+
+    # existing timelines without the option do not start background runners
+    assert timeline.Timeline.load(t._destination)._pipeline == 'inline'
+
+
+def test_digests_and_pool_run_after_the_links_are_published(make_timeline, tmp_path, monkeypatch):
+    repo, t = make_timeline(directory_digests=True, pool_path=str(tmp_path / 'pool'))
+    t.create_snapshot()
+    t.create_link('latest', max_offset=1)
+    calls = []
+
+    def recorded(name, method):
+        def record(self, *args, **kwargs):
+            calls.append(name)
+            return method(self, *args, **kwargs)
+        return record
+    for name in ('rotate_snapshots', '_snapshot_digests', '_snapshot_pool'):
+        monkeypatch.setattr(timeline.Timeline, name, recorded(name, getattr(timeline.Timeline, name)))
+
+    snapshot = t.create_snapshot()
+    assert calls == ['rotate_snapshots', '_snapshot_digests', '_snapshot_pool']
+    assert [job['stage'] for job in pipeline.Queue(t._destination).jobs()[-2:]] == ['digests', 'pool']
+    assert t._links['latest'].snapshot == snapshot
+    assert t.compare(snapshot) == []
+
+
+def test_pipeline_results_survive_concurrent_saves(make_timeline):
+    repo, t = make_timeline()
+    for _ in range(5):
+        t.create_snapshot()
+    # a background runner stores results while a command works on the timeline it loaded before
+    runner = timeline.Timeline.load(t._destination)
+    command = timeline.Timeline.load(t._destination)
+    results = {snapshot: {'metrics': {'added': n}} for n, snapshot in enumerate(t._lsnapshots)}
+
+    def run():
+        for snapshot, updates in results.items():
+            runner._locked_update(snapshot, updates)
+    thread = threading.Thread(target=run)
+    thread.start()
+    for n in range(20):
+        command.create_link(f'link{n}')
+    thread.join()
+
+    state = timeline.Timeline.read_metadata(t._destination)
+    assert sorted(state['_links']) == sorted(f'link{n}' for n in range(20))
+    assert {s: {'metrics': state['_snapshots'][s]['metrics']} for s in results} == results
+
+    # the command keeps them with its next save as well
+    command.save()
+    loaded = timeline.Timeline.load(t._destination)
+    assert {s: {'metrics': loaded._snapshots[s].metrics} for s in results} == results
+    assert command._snapshots[t._lsnapshots[-1]].metrics == {'added': 4}
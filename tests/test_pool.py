@@ -0,0 +1,97 @@
+import os
+
+import pytest
+
+from timeline import filesystem
+from timeline import pool
+from timeline import timeline
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as fh:
+        fh.write(data)
+
+
+def _add(pool_path, root):
+    content_pool = pool.ContentPool(pool_path)
+    try:
+        return content_pool.add(root, pool.DEFAULT_PATTERNS)
+    finally:
+        content_pool.close()
+
+
+def _entries(pool_path):
+    content_pool = pool.ContentPool(pool_path)
+    try:
+        return content_pool.summary()[0]
+    finally:
+        content_pool.close()
+
+
+def test_files_with_the_same_content_share_the_pooled_inode(tmp_path):
+    pool_path = str(tmp_path / 'pool')
+    _write(str(tmp_path / 'a' / 'x.rpm'), b'same')
+    _write(str(tmp_path / 'b' / 'y.rpm'), b'same')
+    _write(str(tmp_path / 'b' / 'z.rpm'), b'other')
+    _write(str(tmp_path / 'b' / 'repomd.xml'), b'same')
+
+    first = _add(pool_path, str(tmp_path / 'a'))
+    assert (first.files, first.added, first.hashed) == (1, 1, 0)
+    second = _add(pool_path, str(tmp_path / 'b'))
+    # only the file with the size of a pooled one is hashed
+    assert (second.files, second.linked, second.added) == (2, 1, 1)
+    assert os.stat(tmp_path / 'a' / 'x.rpm').st_ino == os.stat(tmp_path / 'b' / 'y.rpm').st_ino
+    assert os.stat(tmp_path / 'b' / 'repomd.xml').st_nlink == 1
+
+    again = _add(pool_path, str(tmp_path / 'b'))
+    assert (again.pooled, again.linked, again.added) == (2, 0, 0)
+    assert _entries(pool_path) == 2
+
+
+def test_file_modified_in_place_is_dropped_from_the_pool(tmp_path):
+    pool_path = str(tmp_path / 'pool')
+    _write(str(tmp_path / 'a' / 'x.rpm'), b'same')
+    _add(pool_path, str(tmp_path / 'a'))
+    with open(tmp_path / 'a' / 'x.rpm', 'r+b') as fh:
+        fh.write(b'diff')
+    os.utime(tmp_path / 'a' / 'x.rpm', ns=(0, 0))
+
+    _write(str(tmp_path / 'b' / 'y.rpm'), b'diff')
+    stats = _add(pool_path, str(tmp_path / 'b'))
+    assert (stats.linked, stats.added) == (0, 1)
+    assert os.stat(tmp_path / 'a' / 'x.rpm').st_ino != os.stat(tmp_path / 'b' / 'y.rpm').st_ino
+    assert _entries(pool_path) == 1
+
+
+@pytest.mark.parametrize('backend', ['native', 'subprocess'])
+def test_pooled_files_of_deleted_snapshots_are_collected(make_timeline, tmp_path, monkeypatch, backend):
+    pool_path = str(tmp_path / 'pool')
+    repo, t = make_timeline(packages=5, max_snapshots=3, pool_path=pool_path, backend=filesystem.create(backend))
+    collected = []
+    collect_pool = timeline.Timeline.collect_pool
+    monkeypatch.setattr(timeline.Timeline, 'collect_pool',
+                        lambda self, inodes=None: collected.append(set(inodes)) or collect_pool(self, inodes))
+
+    def files(snapshot):
+        path = t._snapshots[snapshot].path
+        return {os.lstat(os.path.join(d, f)).st_ino for d, _, names in os.walk(path) for f in names}
+
+    first = t.create_snapshot()
+    assert _entries(pool_path) == 5
+    first_files = files(first)
+
+    # the source drops the pooled packages, only the snapshots and the pool hold them
+    repo.sync(added=1, removed=5)
+    second = t.create_snapshot()
+    second_files = files(second)
+    repo.sync(added=0, removed=1)
+    for _ in range(2):
+        t.create_snapshot()
+    # rotated away: the inodes come from the removal of the snapshot
+    assert first not in t._snapshots and collected == [first_files]
+    assert _entries(pool_path) == 1
+
+    t.delete_snapshot(second)
+    assert collected[1:] == [second_files]
+    assert _entries(pool_path) == 0
@@ -0,0 +1,84 @@
+import pickle
+import pickletools
+
+import pytest
+
+from timeline import timeline
+
+
+def test_old_state_is_loaded_and_saved_unchanged(make_timeline):
+    repo, t = make_timeline()
+    for _ in range(3):
+        t.create_snapshot()
+    t.create_link('latest', max_offset=1)
+
+    # written before generations and records: plain dicts without seq, with a key unknown to this version
+    old = timeline.Timeline.read_metadata(t._destination)
+    for snapshot in old['_snapshots'].values():
+        del snapshot['seq']
+    old['_snapshots'][t._lsnapshots[0]]['origin'] = 'mirror'
+    with open(t._datafile, 'wb') as fh:
+        pickle.dump(old, fh)
+
+    loaded = timeline.Timeline.load(t._destination)
+    first = loaded._snapshots[loaded._lsnapshots[0]]
+    assert isinstance(first, timeline.Snapshot) and isinstance(loaded._links['latest'], timeline.Link)
+    assert [loaded._snapshots[s].seq for s in loaded._lsnapshots] == [1, 2, 3]
+    assert first.path == old['_snapshots'][loaded._lsnapshots[0]]['path']
+    assert loaded._links['latest'].snapshot == loaded._lsnapshots[-1]
+
+    loaded.save()
+    saved = timeline.Timeline.read_metadata(t._destination)
+    for n, name in enumerate(loaded._lsnapshots, 1):
+        assert saved['_snapshots'][name] == dict(old['_snapshots'][name], seq=n)
+    assert saved['_links'] == old['_links']
+    assert type(saved['_lsnapshots']) is list
+
+    # the metadata file only holds builtin types
+    with open(t._datafile, 'rb') as fh:
+        globals_ = [arg for op, arg, _ in pickletools.genops(fh) if op.name in ('GLOBAL', 'STACK_GLOBAL')]
+    assert not any('timeline' in str(arg) for arg in globals_)
+
+
+def test_record_equality():
+    snapshot = timeline.Snapshot(created=1, path='/t/a', links=['latest'], seq=1)
+    assert snapshot == timeline.Snapshot.from_dict(snapshot.as_dict())
+    assert snapshot.as_dict() == {'created': 1, 'path': '/t/a', 'links': ['latest'], 'seq': 1}
+    assert snapshot != timeline.Snapshot(created=1, path='/t/a', links=['latest'], seq=2)
+    assert snapshot != snapshot.as_dict()
+    with pytest.raises(TypeError):
+        hash(snapshot)
+
+    copied = snapshot.copy()
+    copied.links.append('stable')
+    assert snapshot.links == ['latest']
+    with pytest.raises(AttributeError):
+        snapshot.size = 0
+
+
+def test_snapshot_positions_follow_changes():
+    snapshots = timeline.SnapshotList(['a', 'b', 'c'])
+    assert snapshots.index('c') == 2
+    snapshots.append('d')
+    assert snapshots.index('d') == 3 and 'd' in snapshots
+
+    changes = [
+        lambda s: s.remove('a'),
+        lambda s: s.insert(0, 'z'),
+        lambda s: s.pop(0),
+        lambda s: s.extend(['e']),
+        lambda s: s.sort(reverse=True),
+        lambda s: s.reverse(),
+        lambda s: s.__setitem__(0, 'y'),
+        lambda s: s.__delitem__(slice(0, 1)),
+        lambda s: s.__iadd__(['f']),
+        lambda s: s.clear(),
+    ]
+    for change in changes:
+        before = list(snapshots)
+        assert snapshots.index(before[0]) == 0
+        change(snapshots)
+        assert {name: snapshots.index(name) for name in snapshots} == {name: n for n, name in enumerate(snapshots)}
+        assert not any(name in snapshots for name in set(before) - set(snapshots))
+    assert 'b' not in snapshots and snapshots == []
+    assert pickle.loads(pickle.dumps(timeline.SnapshotList(['a']))) == ['a']
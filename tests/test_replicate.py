@@ -0,0 +1,103 @@
+import io
+import os
+
+import pytest
+
+from timeline import timeline
+
+
+def snapshot_dirs(t):
+    """Return the names of the snapshot directories in the destination of t"""
+
+    return sorted(name for name in os.listdir(t._destination)
+                  if t._snapshot_name_re.match(name) and os.path.isdir(os.path.join(t._destination, name)))
+
+
+def link_targets(t):
+    """Return {link name: target} of the symbolic links in the destination of t"""
+
+    return {name: os.readlink(os.path.join(t._destination, name))
+            for name in os.listdir(t._destination) if os.path.islink(os.path.join(t._destination, name))}
+
+
+def _tree(root):
+    """Return {relative path: (kind, content or link target)} of everything below root"""
+
+    result = {}
+    for directory, dirs, files in os.walk(root):
+        for name in dirs + files:
+            path = os.path.join(directory, name)
+            rel = os.path.relpath(path, root)
+            if os.path.islink(path):
+                result[rel] = ('l', os.readlink(path))
+            elif os.path.isdir(path):
+                result[rel] = ('d', None)
+            else:
+                with open(path, 'rb') as fh:
+                    result[rel] = ('f', fh.read())
+    return result
+
+
+@pytest.fixture
+def replica(make_timeline, tmp_path):
+    """Return a primary timeline with three snapshots and links, its synthetic repository and an empty replica"""
+
+    repo, primary = make_timeline()
+    primary.create_snapshot()
+    primary.create_link('upstream', max_offset=1)
+    primary.create_link('downstream')
+    for _ in range(2):
+        repo.sync(added=3, removed=2)
+        primary.create_snapshot()
+    secondary = timeline.Timeline('test-rpm', repo.root, str(tmp_path / 'replica'))
+    secondary._validate_metadata = False
+    secondary.save()
+    return repo, primary, secondary
+
+
+def _export(t, since=None):
+    stream = io.BytesIO()
+    t.export_snapshots(stream, since=since)
+    stream.seek(0)
+    return stream
+
+
+def _assert_replicated(primary, secondary):
+    assert secondary._lsnapshots == primary._lsnapshots
+    assert snapshot_dirs(secondary) == primary._lsnapshots
+    assert link_targets(secondary) == link_targets(primary)
+    for snapshot in primary._lsnapshots:
+        assert _tree(secondary._snapshots[snapshot].path) == _tree(primary._snapshots[snapshot].path)
+
+
+def test_export_import_round_trip(replica):
+    repo, primary, secondary = replica
+    assert secondary.import_snapshots(_export(primary)) == primary._lsnapshots
+    _assert_replicated(primary, secondary)
+
+    # incremental: files which did not change stay hard-linked to the base snapshot
+    base = primary._lsnapshots[-1]
+    repo.sync(added=3, removed=2)
+    primary.create_snapshot()
+    assert secondary.import_snapshots(_export(primary, since=base)) == primary._lsnapshots[-1:]
+    _assert_replicated(primary, secondary)
+    new, old = secondary._snapshots[primary._lsnapshots[-1]].path, secondary._snapshots[base].path
+    shared = [rel for rel, (kind, _) in _tree(new).items() if kind == 'f' and os.path.exists(os.path.join(old, rel))
+              and os.stat(os.path.join(new, rel)).st_ino == os.stat(os.path.join(old, rel)).st_ino]
+    assert shared
+
+
+def test_import_requires_latest_base(replica):
+    _, primary, secondary = replica
+    with pytest.raises(Exception, match='based on snapshot'):
+        secondary.import_snapshots(_export(primary, since=primary._lsnapshots[0]))
+    assert not secondary._lsnapshots
+
+
+def test_truncated_import_leaves_no_partial_snapshot(replica):
+    _, primary, secondary = replica
+    data = _export(primary).getvalue()
+    with pytest.raises(Exception):
+        secondary.import_snapshots(io.BytesIO(data[:len(data) * 2 // 3]))
+    assert snapshot_dirs(secondary) == secondary._lsnapshots
+    assert not secondary.consistency_check(dry_run=True)
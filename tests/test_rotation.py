@@ -0,0 +1,59 @@
+from timeline import catalog
+from timeline import status
+
+
+def _link_offset(t, link):
+    """Return the offset of link as computed by the timeline, the status endpoint and the catalog"""
+
+    offsets = {t._get_snapshot_offset(t._links[link].snapshot),
+               status.timeline_status(t._destination)['links'][link]['offset']}
+    if t._catalog_path:
+        _, rows = catalog.query(t._catalog_path, 'SELECT offset FROM links WHERE name = ?', (link,))
+        offsets.add(rows[0][0])
+    assert len(offsets) == 1
+    return offsets.pop()
+
+
+def test_deleted_snapshot_does_not_count(make_timeline):
+    repo, t = make_timeline()
+    for _ in range(5):
+        t.create_snapshot()
+    t.create_link('off3', t._lsnapshots[-3], max_offset=3)
+    target = t._lsnapshots[-3]
+
+    t.delete_snapshot(t._lsnapshots[-2])
+    assert _link_offset(t, 'off3') == 2
+    t.create_snapshot()
+    assert t._links['off3'].snapshot == target == t._lsnapshots[-3]
+    assert _link_offset(t, 'off3') == 3
+
+    t.create_snapshot()
+    assert t._links['off3'].snapshot == t._lsnapshots[-3]
+
+
+def test_max_snapshots_rotation_keeps_positions(make_timeline):
+    repo, t = make_timeline(max_snapshots=4)
+    t.create_snapshot()
+    t.create_link('off3', max_offset=3)
+    for _ in range(6):
+        t.create_snapshot()
+        assert t._links['off3'].snapshot == t._lsnapshots[max(0, len(t._lsnapshots) - 3)]
+    assert len(t._lsnapshots) == 4
+    assert _link_offset(t, 'off3') == 3
+
+
+def test_thinned_snapshots_count(make_timeline, tmp_path):
+    # snapshots of the same day: all but the newest, the link target and its next target are thinned out
+    repo, t = make_timeline(keep_daily=1, catalog_path=str(tmp_path / 'catalog.sqlite'))
+    created = [t.create_snapshot()]
+    t.create_link('off5', max_offset=5)
+    for n in range(8):
+        created.append(t.create_snapshot())
+        target = t._links['off5'].snapshot
+        # the offset counts all snapshots created since the target, thinned out or not
+        assert _link_offset(t, 'off5') == len(created) - created.index(target) <= 5
+    assert len(t._lsnapshots) < len(created)
+
+    t.create_snapshot()
+    assert _link_offset(t, 'off5') > len(t._lsnapshots)
+    assert t._thinned
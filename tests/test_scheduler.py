@@ -0,0 +1,80 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from timeline import scheduler
+
+DAY = datetime(2024, 5, 10)
+
+
+def _at(day, hour, minute=0):
+    return DAY + timedelta(days=day, hours=hour, minutes=minute)
+
+
+@pytest.fixture
+def schedule(make_timeline):
+    """Return a function configuring the schedule and the last snapshot time of a timeline, returns a Scheduler"""
+
+    _, t = make_timeline()
+    t.create_snapshot()
+
+    def configure(interval, window, last):
+        t._schedule_interval = interval
+        t._schedule_window = window
+        t._snapshots[t._lsnapshots[-1]].created = last
+        t.save()
+        return scheduler.Scheduler([t._destination])
+
+    return configure
+
+
+def _due(s, now):
+    return bool(s.due_jobs(now))
+
+
+def test_daily_interval_long_window(schedule):
+    s = schedule('1d', '00:00-23:00', _at(0, 0, 5))
+    for hour, minute in ((0, 35), (2, 5), (6, 5), (22, 59)):
+        assert not _due(s, _at(0, hour, minute))
+    assert not _due(s, _at(0, 23, 30))  # outside of the window, nothing missed
+    assert _due(s, _at(1, 0, 0))
+
+
+def test_daily_interval_run_late_in_window(schedule):
+    s = schedule('1d', '01:00-05:00', _at(0, 4, 50))
+    assert not _due(s, _at(0, 4, 55))
+    assert _due(s, _at(1, 1, 0))
+
+
+def test_catch_up_run_counts_for_its_window(schedule):
+    s = schedule('1d', '01:00-05:00', _at(0, 10))
+    assert not _due(s, _at(0, 12))
+    assert _due(s, _at(1, 1, 0))
+
+
+def test_window_wrapping_midnight(schedule):
+    s = schedule('1d', '22:00-04:00', _at(0, 23, 50))
+    assert not _due(s, _at(1, 2))
+    assert not _due(s, _at(1, 21, 59))
+    assert _due(s, _at(1, 22))
+
+
+def test_interval_shorter_than_window(schedule):
+    s = schedule('1h', '00:00-23:00', _at(0, 0, 5))
+    assert not _due(s, _at(0, 0, 50))
+    assert _due(s, _at(0, 1, 5))
+
+
+def test_interval_without_window(schedule):
+    s = schedule('1d', '', _at(0, 0, 5))
+    assert not _due(s, _at(0, 12))
+    assert _due(s, _at(1, 0, 1))  # within the tolerance
+    missed = s.due_jobs(_at(3, 0, 5))
+    assert missed and missed[0].missed == 2
+
+
+def test_window_bounds():
+    assert scheduler.window_start((60, 300), _at(0, 0, 30)) == _at(-1, 1)
+    assert scheduler.window_start((1320, 240), _at(1, 2)) == _at(0, 22)
+    assert scheduler.window_end((1320, 240), _at(0, 23)) == _at(1, 4)
+    assert scheduler.window_end((60, 300), _at(0, 6)) is None
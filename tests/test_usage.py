@@ -0,0 +1,72 @@
+import os
+
+import pytest
+
+from timeline import usage
+
+
+def _write(path, size):
+    with open(path, 'wb') as fh:
+        fh.write(b'x' * size)
+
+
+def _allocated(path):
+    return os.lstat(path).st_blocks * 512
+
+
+@pytest.fixture
+def trees(tmp_path):
+    """source and two snapshots sharing files by hard links, one file is also linked from outside"""
+
+    src, s1, s2, outside = (tmp_path / name for name in ('src', 's1', 's2', 'outside'))
+    for d in (src, s1, s2, outside):
+        d.mkdir()
+    _write(src / 'a', 5000)
+    _write(src / 'b', 9000)
+    _write(s1 / 'old', 13000)
+    _write(s1 / 'shared12', 17000)
+    _write(s2 / 'new2', 21000)
+    _write(s2 / 'ext', 25000)
+    os.link(src / 'a', s1 / 'a')
+    os.link(src / 'a', s2 / 'a')
+    os.link(src / 'b', s2 / 'b')
+    os.link(s1 / 'shared12', s2 / 'shared12')
+    os.link(s2 / 'ext', outside / 'ext')
+    return src, s1, s2
+
+
+def test_exclusive_shared_and_reclaimable(trees):
+    src, s1, s2 = trees
+    u = usage.scan_usage(str(src), [('s1', str(s1)), ('s2', str(s2))])
+    first, second = u.snapshots
+
+    assert (first.exclusive_inodes, first.shared_inodes) == (2, 2)
+    assert first.exclusive_bytes == _allocated(s1 / 'old') + _allocated(s1)
+    assert first.shared_bytes == _allocated(s1 / 'a') + _allocated(s1 / 'shared12')
+
+    assert (second.exclusive_inodes, second.shared_inodes) == (2, 4)
+    assert second.exclusive_bytes == _allocated(s2 / 'new2') + _allocated(s2)
+
+    assert (u.source_inodes, u.external_inodes) == (2, 1)
+    assert u.source_bytes == _allocated(src / 'a') + _allocated(src / 'b')
+    assert u.external_bytes == _allocated(s2 / 'ext')
+
+    # deleting the oldest snapshot frees its own file, deleting both also frees the file they share
+    assert u.reclaimable[0] == (0, 0)
+    assert u.reclaimable[1] == (first.exclusive_bytes, 2)
+    assert u.reclaimable[2] == (first.exclusive_bytes + second.exclusive_bytes + _allocated(s1 / 'shared12'), 5)
+    assert u.reclaimable_for(1) == u.reclaimable[1]
+    assert u.reclaimable_for(5) == (0, 0)
+
+
+def test_hard_links_within_a_snapshot_count_once(tmp_path):
+    src, snap = tmp_path / 'src', tmp_path / 'snap'
+    src.mkdir()
+    snap.mkdir()
+    _write(snap / 'one', 7000)
+    os.link(snap / 'one', snap / 'two')
+
+    u = usage.scan_usage(str(src), [('snap', str(snap))])
+    assert u.snapshots[0].exclusive_inodes == 2  # the file and the directory
+    assert u.snapshots[0].shared_inodes == 0
+    assert u.reclaimable[1] == (_allocated(snap / 'one') + _allocated(snap), 2)
@@ -0,0 +1,57 @@
+import glob
+import os
+
+import pytest
+
+from timeline import timeline
+
+
+def _corrupt_metadata(repo):
+    # a metadata file referenced by repomd.xml with the wrong size, like a mirror caught mid-sync
+    path = sorted(glob.glob(os.path.join(repo.root, 'repodata', '*-primary.xml.gz')))[0]
+    with open(path, 'ab') as fh:
+        fh.write(b'partial')
+
+
+def test_failed_validation_keeps_links_and_generation(make_timeline):
+    repo, t = make_timeline()
+    for _ in range(3):
+        t.create_snapshot()
+    t.create_link('latest', t._lsnapshots[-1], max_offset=1)
+    t.create_link('off2', t._lsnapshots[-2], max_offset=2)
+    snapshots = list(t._lsnapshots)
+    seq = t._seq
+
+    _corrupt_metadata(repo)
+    with pytest.raises(Exception, match='failed the repository metadata validation'):
+        t.create_snapshot()
+    assert t._lsnapshots == snapshots
+    assert t._seq == seq
+    assert t._links['latest'].snapshot == snapshots[-1]
+    assert t._links['off2'].snapshot == snapshots[-2]
+    assert sorted(e for e in os.listdir(t._destination) if e.startswith('20')) == sorted(snapshots)
+
+    # the next snapshot gets the generation the rejected one would have used
+    repo.write_metadata()
+    t.create_snapshot()
+    assert t._snapshots[t._lsnapshots[-1]].seq == seq + 1
+    assert t._links['latest'].snapshot == t._lsnapshots[-1]
+    assert t._links['off2'].snapshot == t._lsnapshots[-2]
+
+
+def test_validation_is_off_for_existing_configurations(make_timeline):
+    repo, t = make_timeline()
+    assert t._validate_metadata
+    t.create_snapshot()
+
+    # configuration written before the option existed
+    with open(t._cfgfile) as fh:
+        lines = [line for line in fh if not line.startswith('validate_metadata')]
+    with open(t._cfgfile, 'w') as fh:
+        fh.writelines(lines)
+    t = timeline.Timeline(t._name, t._source, t._destination)
+    assert not t._validate_metadata
+
+    _corrupt_metadata(repo)
+    t.create_snapshot()
+    assert len(t._lsnapshots) == 2
@@ -0,0 +1,79 @@
+import os
+import threading
+import time
+
+import pytest
+
+from timeline import watch
+
+
+@pytest.fixture(params=['inotify', 'polling'])
+def detection(request, monkeypatch):
+    """Run a test with inotify and with the polling fallback"""
+
+    if request.param == 'polling':
+        def unavailable():
+            raise OSError('inotify disabled by the test')
+        monkeypatch.setattr(watch, 'Inotify', unavailable)
+    monkeypatch.setattr(watch, 'POLL_INTERVAL', 0.05)
+    return request.param
+
+
+def _touch_metadata(repo, times, every):
+    """Rewrite repomd.xml <times> times, <every> seconds apart, in a thread"""
+
+    def sync():
+        for _ in range(times):
+            time.sleep(every)
+            repo.write_metadata()
+
+    thread = threading.Thread(target=sync)
+    thread.start()
+    return thread
+
+
+def test_metadata_paths(make_timeline):
+    repo, t = make_timeline('rpm')
+    assert watch.metadata_paths(repo.root, t._copy_dirs_recursive, t._copy_files_recursive) == \
+        [os.path.join(repo.root, 'repodata')]
+
+    repo, t = make_timeline('deb')
+    paths = watch.metadata_paths(repo.root, t._copy_dirs_recursive, t._copy_files_recursive)
+    assert paths
+    assert all(os.path.relpath(p, repo.root).startswith('dists') for p in paths)
+
+
+def test_waits_until_the_metadata_settled(make_timeline, detection):
+    repo, t = make_timeline()
+    t.create_snapshot()
+    time.sleep(0.05)
+
+    start = time.time()
+    sync = _touch_metadata(repo, 4, 0.1)
+    assert t.wait_for_sync(quiet_period=0.3, timeout=10)
+    sync.join()
+    # the last change was 0.4s after the start, followed by the quiet period
+    assert time.time() - start >= 0.7
+
+
+def test_times_out_without_a_sync(make_timeline, detection):
+    repo, t = make_timeline()
+    t.create_snapshot()
+    start = time.time()
+    assert not t.wait_for_sync(quiet_period=0.1, timeout=0.3)
+    assert 0.3 <= time.time() - start < 2
+
+
+def test_marker_newer_than_the_last_snapshot(make_timeline, detection):
+    repo, t = make_timeline()
+    marker = os.path.join(repo.root, '.sync-done')
+    with open(marker, 'w'):
+        pass
+    t.create_snapshot()
+    assert not t.wait_for_sync(marker='.sync-done', timeout=0.2)
+
+    def done():
+        time.sleep(0.1)
+        os.utime(marker)
+    threading.Thread(target=done).start()
+    assert t.wait_for_sync(marker='.sync-done', timeout=10)
@@ -0,0 +1,180 @@
+"""Catalog of all timelines on a server
+
+A SQLite database holding the timelines, their snapshots and links, so that
+questions like "which timelines are frozen" or "which links are past their
+max_offset" are answered by a single query instead of loading every metadata
+file. Timelines with ``catalog_path`` set in their configuration update their
+entry once per operation which saved them; ``mrepo catalog rebuild`` (re)creates the
+catalog from the metadata files, e.g. for a new server.
+"""
+
+import logging
+import os
+import sqlite3
+import time
+
+logger = logging.getLogger('Timeline.catalog')
+
+DEFAULT_CATALOG = '/var/lib/mrepo/catalog.sqlite'
+
+# stored as PRAGMA user_version once the schema has been created
+SCHEMA_VERSION = 1
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS timelines (
+    path TEXT PRIMARY KEY,
+    name TEXT,
+    source TEXT,
+    device INTEGER,
+    frozen TEXT,
+    max_snapshots INTEGER,
+    snapshots INTEGER,
+    oldest TEXT,
+    newest TEXT,
+    newest_created REAL,
+    last_duration REAL,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS timelines_frozen ON timelines (frozen);
+CREATE INDEX IF NOT EXISTS timelines_device ON timelines (device);
+CREATE TABLE IF NOT EXISTS snapshots (
+    timeline TEXT,
+    name TEXT,
+    created REAL,
+    duration REAL,
+    PRIMARY KEY (timeline, name)
+);
+CREATE TABLE IF NOT EXISTS links (
+    timeline TEXT,
+    name TEXT,
+    snapshot TEXT,
+    offset INTEGER,
+    max_offset INTEGER,
+    past_max_offset INTEGER,
+    PRIMARY KEY (timeline, name)
+);
+CREATE INDEX IF NOT EXISTS links_past_max_offset ON links (past_max_offset);
+'''
+
+# named queries for 'mrepo catalog query'
+QUERIES = {
+    'timelines': 'SELECT path, name, snapshots, max_snapshots, newest, frozen FROM timelines ORDER BY path',
+    'frozen': 'SELECT path, name, frozen FROM timelines WHERE frozen IS NOT NULL ORDER BY path',
+    'past-max-offset': 'SELECT timeline, name, snapshot, offset, max_offset FROM links '
+                       'WHERE past_max_offset = 1 ORDER BY timeline, name',
+    'per-device': 'SELECT device, COUNT(*) AS timelines, SUM(snapshots) AS snapshots FROM timelines '
+                  'GROUP BY device ORDER BY device',
+    'links': 'SELECT timeline, name, snapshot, offset, max_offset FROM links ORDER BY timeline, name',
+    'stale': 'SELECT path, name, newest, datetime(newest_created, \'unixepoch\', \'localtime\') AS newest_created '
+             'FROM timelines ORDER BY newest_created LIMIT 20',
+}
+
+
+def connect(path, readonly=False):
+    """open the catalog, the schema is created if the catalog is new"""
+
+    if readonly:
+        db = sqlite3.connect(f'file:{path}?mode=ro', uri=True, timeout=30)
+        return db
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    db = sqlite3.connect(path, timeout=30)
+    if db.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+        # WAL mode is persistent, it is kept by the database file
+        db.execute('PRAGMA journal_mode=WAL')
+        db.executescript(_SCHEMA)
+        db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+    return db
+
+
+def _timestamp(value):
+    return value.timestamp() if value is not None else None
+
+
+def _update(db, state):
+    """store the state (as pickled in the metadata file) of a timeline, replacing its previous entry"""
+
+    path = os.path.normpath(os.path.abspath(state['_destination']))
+    snapshots = state.get('_snapshots', {})
+    lsnapshots = state.get('_lsnapshots', [])
+    try:
+        device = os.stat(path).st_dev
+    except OSError:
+        device = None
+
+    newest = snapshots.get(lsnapshots[-1], {}) if lsnapshots else {}
+    db.execute('INSERT OR REPLACE INTO timelines VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+        path, state['_name'], state['_source'], device,
+        str(state['_frozen']) if state.get('_frozen') else None,
+        state.get('_max_snapshots'), len(lsnapshots),
+        lsnapshots[0] if lsnapshots else None, lsnapshots[-1] if lsnapshots else None,
+        _timestamp(newest.get('created')), newest.get('duration'), time.time(),
+    ))
+
+    # snapshots: only the difference to the stored ones is written
+    stored = {name: duration for name, duration in
+              db.execute('SELECT name, duration FROM snapshots WHERE timeline = ?', (path,))}
+    removed = set(stored) - set(lsnapshots)
+    db.executemany('DELETE FROM snapshots WHERE timeline = ? AND name = ?', ((path, name) for name in removed))
+    db.executemany('INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?)', (
+        (path, name, _timestamp(snapshots[name].get('created')), snapshots[name].get('duration'))
+        for name in lsnapshots
+        if name not in stored or stored[name] != snapshots[name].get('duration')))
+
+    # positions counted from the newest snapshot, plus the snapshots thinned out by the retention policy since
+    thinned = state.get('_thinned', [])
+    positions = {name: len(lsnapshots) - n for n, name in enumerate(lsnapshots)}
+    db.execute('DELETE FROM links WHERE timeline = ?', (path,))
+    rows = []
+    for name, link in state.get('_links', {}).items():
+        target = link.get('snapshot')
+        # same convention as Timeline._get_snapshot_offset(): the newest snapshot has offset 1
+        offset = (positions[target] + sum(1 for seq in thinned if seq > snapshots[target].get('seq', 0))
+                  if target in positions else None)
+        max_offset = link.get('max_offset') or 0
+        rows.append((path, name, target, offset, max_offset,
+                     int(bool(max_offset) and offset is not None and offset > max_offset)))
+    db.executemany('INSERT INTO links VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+
+def update(catalog_path, state):
+    """update the catalog entry of a single timeline"""
+
+    db = connect(catalog_path)
+    try:
+        with db:
+            _update(db, state)
+    finally:
+        db.close()
+
+
+def rebuild(catalog_path, timelines):
+    """recreate the catalog from (path, state) pairs of all timelines, returns their number"""
+
+    db = connect(catalog_path)
+    count = 0
+    try:
+        with db:
+            for table in ('timelines', 'snapshots', 'links'):
+                db.execute(f'DELETE FROM {table}')
+            for path, state in timelines:
+                # use the real location, the stored destination may be relative
+                _update(db, dict(state, _destination=path))
+                count += 1
+    finally:
+        db.close()
+    return count
+
+
+def query(catalog_path, sql, parameters=()):
+    """run a query (or the name of a predefined query) on the catalog, returns (columns, rows)"""
+
+    db = connect(catalog_path, readonly=True)
+    try:
+        cur = db.execute(QUERIES.get(sql, sql), parameters)
+        columns = [d[0] for d in cur.description or ()]
+        return columns, cur.fetchall()
+    finally:
+        db.close()
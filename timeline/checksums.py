@@ -0,0 +1,211 @@
+"""Content checksums of snapshot files
+
+Snapshots share their inodes with the source directory. A sync tool which
+rewrites a file in place instead of replacing it therefore silently changes
+every snapshot holding that file. This module records a sha256sum-compatible
+manifest per snapshot and verifies snapshots against it later.
+
+Hashing is done in a process pool and every inode is hashed at most once,
+both when recording (persistent cache keyed by dev, inode, size and mtime)
+and when verifying (per-run cache shared by all verified snapshots).
+"""
+
+import concurrent.futures
+import gzip
+import hashlib
+import logging
+import os
+import sqlite3
+
+logger = logging.getLogger('Timeline.checksums')
+
+_BLOCKSIZE = 1024 * 1024
+
+
+def hash_file(path, algorithm='sha256'):
+    """return the hex digest of the given file, None if it cannot be read"""
+
+    h = hashlib.new(algorithm)
+    try:
+        with open(path, 'rb') as fh:
+            for block in iter(lambda: fh.read(_BLOCKSIZE), b''):
+                h.update(block)
+    except OSError as e:
+        logger.warning('cannot read [%s]: %s', path, e)
+        return None
+    return h.hexdigest()
+
+
+def hash_files(paths, jobs=None, algorithm='sha256', threads=False):
+    """hash the given paths in a worker pool, returns a list of digests (same order)
+
+            a process pool is used by default. with threads=True a thread pool is used instead,
+            which has no startup cost and is a good fit for a few large files (hashlib releases
+            the GIL while hashing large blocks)
+    """
+
+    paths = list(paths)
+    if jobs == 1 or len(paths) < (2 if threads else 16):
+        return [hash_file(p, algorithm) for p in paths]
+
+    if threads:
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        chunksize = 1
+    else:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+        chunksize = max(1, min(256, len(paths) // (4 * (jobs or os.cpu_count() or 1))))
+
+    with pool:
+        return list(pool.map(hash_file, paths, [algorithm] * len(paths), chunksize=chunksize))
+
+
+def file_key(st):
+    """cache key of a stat result, a file with the same key is assumed to be unchanged"""
+
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def walk_files(root):
+    """yield (relative path, stat result) of all regular files below root, sorted per directory"""
+
+    stack = ['']
+    while stack:
+        reldir = stack.pop()
+        try:
+            with os.scandir(os.path.join(root, reldir)) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError as e:
+            logger.warning('cannot scan [%s]: %s', os.path.join(root, reldir), e)
+            continue
+        subdirs = []
+        for entry in entries:
+            relpath = os.path.join(reldir, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(relpath)
+            elif entry.is_file(follow_symlinks=False):
+                yield relpath, entry.stat(follow_symlinks=False)
+        stack.extend(reversed(subdirs))
+
+
+class ChecksumCache:
+    """persistent cache (dev, inode, size, mtime) -> digest, stored in a sqlite database
+
+            every lookup/store marks the entry with the given generation (e.g. the snapshot name),
+            entries not marked since a generation can be pruned
+    """
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS checksums ('
+            ' dev INTEGER, ino INTEGER, size INTEGER, mtime INTEGER,'
+            ' digest TEXT, generation TEXT,'
+            ' PRIMARY KEY (dev, ino, size, mtime))')
+
+    def lookup(self, key):
+        row = self._db.execute(
+            'SELECT digest FROM checksums WHERE dev=? AND ino=? AND size=? AND mtime=?', key).fetchone()
+        return row[0] if row else None
+
+    def store(self, items, generation):
+        """store/refresh (key, digest) pairs"""
+
+        self._db.executemany(
+            'INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?)',
+            ((*key, digest, generation) for key, digest in items))
+
+    def prune(self, oldest_generation):
+        """drop entries which were last used before the given generation"""
+
+        cur = self._db.execute('DELETE FROM checksums WHERE generation < ?', (oldest_generation,))
+        return cur.rowcount
+
+    def commit(self):
+        self._db.commit()
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+
+def write_manifest(path, entries):
+    """write (relative path, digest) entries in sha256sum format (gzip compressed)"""
+
+    tmp_path = f'{path}.tmp'
+    with gzip.open(tmp_path, 'wt', encoding='utf-8', newline='\n') as fh:
+        for relpath, digest in entries:
+            fh.write(f'{digest}  {relpath}\n')
+    os.replace(tmp_path, path)
+
+
+def read_manifest(path):
+    """yield (relative path, digest) entries from a manifest written by write_manifest()"""
+
+    with gzip.open(path, 'rt', encoding='utf-8', newline='\n') as fh:
+        for line in fh:
+            digest, relpath = line.rstrip('\n').split('  ', 1)
+            yield relpath, digest
+
+
+def record(root, manifest, cache, generation, jobs=None):
+    """compute the checksums of all files below root and write them to the manifest
+
+            returns (files, hashed files, hashed bytes)
+    """
+
+    entries = []
+    missing = {}
+    for relpath, st in walk_files(root):
+        key = file_key(st)
+        digest = cache.lookup(key)
+        entries.append([relpath, digest, key])
+        if digest is None:
+            missing.setdefault(key, os.path.join(root, relpath))
+
+    keys = list(missing)
+    digests = dict(zip(keys, hash_files([missing[k] for k in keys], jobs)))
+    hashed_bytes = sum(k[2] for k in keys)
+
+    for entry in entries:
+        if entry[1] is None:
+            entry[1] = digests.get(entry[2])
+    cache.store(((e[2], e[1]) for e in entries if e[1] is not None), generation)
+    cache.commit()
+
+    write_manifest(manifest, ((e[0], e[1]) for e in entries if e[1] is not None))
+
+    return len(entries), len(keys), hashed_bytes
+
+
+def verify(root, manifest, digests, jobs=None):
+    """verify the files below root against the manifest
+
+            digests is a dict (dev, inode, size, mtime) -> digest shared between calls, so inodes
+            shared by several snapshots are only hashed once
+
+            returns (drifted, hashed files), drifted is a list of (relative path, expected digest,
+            actual digest), actual is None for missing/unreadable files
+    """
+
+    entries = []
+    todo = {}
+    for relpath, expected in read_manifest(manifest):
+        try:
+            st = os.lstat(os.path.join(root, relpath))
+        except OSError:
+            entries.append((relpath, expected, None))
+            continue
+        key = file_key(st)
+        entries.append((relpath, expected, key))
+        if key not in digests:
+            todo.setdefault(key, os.path.join(root, relpath))
+
+    keys = list(todo)
+    digests.update(zip(keys, hash_files([todo[k] for k in keys], jobs)))
+
+    drifted = []
+    for relpath, expected, key in entries:
+        actual = digests.get(key) if key else None
+        if actual != expected:
+            drifted.append((relpath, expected, actual))
+    return drifted, len(keys)
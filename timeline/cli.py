@@ -3,10 +3,19 @@
 """Repository Timeline Tool"""
 
 import argparse
+import logging
 import os
+import signal
 import subprocess
 import sys
+import time
 import lockfile
+from timeline import catalog
+from timeline import daemon
+from timeline import pipeline
+from timeline import pool
+from timeline import scheduler
+from timeline import status
 from timeline import timeline
 
 
@@ -16,6 +25,11 @@ def setup_argparse():
     parser = argparse.ArgumentParser(
         description="",
     )
+    parser.add_argument(
+        '--no-daemon',
+        action='store_true',
+        help='do not forward the command to a running mrepo daemon, execute it in this process',
+    )
 
     subparsers = parser.add_subparsers(
         dest='subcommand',
@@ -62,6 +76,12 @@ def setup_argparse():
         action='store_true',
         help='check repository for consistency',
     )
+    config_parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='only show what --consistency-check would repair, or the planned operations and costs of\n'
+             '--max-snapshots/--excludes, without changing anything',
+    )
     config_parser.add_argument(
         '-v', '--verbose', '--debug',
         action='store_true',
@@ -193,6 +213,34 @@ def setup_argparse():
         type=int,
         default=None,
     )
+    create_snap_parser.add_argument(
+        '--wait-for-sync',
+        action='store_true',
+        help='wait until the source has been synchronized since the last snapshot, i.e. until the repository\n'
+             'metadata changed and has not changed for --quiet-period seconds',
+    )
+    create_snap_parser.add_argument(
+        '--sync-marker',
+        help='wait until this file (relative to the source directory) is newer than the last snapshot',
+        default=None,
+    )
+    create_snap_parser.add_argument(
+        '--quiet-period',
+        help='seconds without changes of the repository metadata after which a sync is complete [default=%(default)s]',
+        type=int,
+        default=60,
+    )
+    create_snap_parser.add_argument(
+        '--sync-timeout',
+        help='give up waiting for a sync after the given amount of seconds (no snapshot is taken)',
+        type=int,
+        default=None,
+    )
+    create_snap_parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='only show the planned operations and the estimated duration and space',
+    )
     create_snap_parser.add_argument(
         '--lock',
         action='store_true',
@@ -275,20 +323,516 @@ def setup_argparse():
         default=None,
     )
 
+    # usage subcommand
+    usage_parser = subparsers.add_parser(
+        'usage',
+        epilog=usage.__doc__,
+        formatter_class=argparse.RawTextHelpFormatter,
+        help='Display exclusive and shared disk usage per snapshot',
+    )
+    usage_parser.set_defaults(func=usage)
+    usage_parser.add_argument(
+        'repository',
+        action='store',
+        metavar='REPOSITORY_LOCATION',
+        help='Path to repository',
+    )
+    usage_parser.add_argument(
+        '--max-snapshots',
+        help='show the space reclaimed when rotating down to this amount of snapshots [default=current setting]',
+        type=int,
+        default=None,
+    )
+    usage_parser.add_argument(
+        '--bytes',
+        action='store_true',
+        help='print plain byte values instead of human readable sizes',
+    )
+
+    # verify subcommand
+    verify_parser = subparsers.add_parser(
+        'verify',
+        epilog=verify.__doc__,
+        formatter_class=argparse.RawTextHelpFormatter,
+        help='Verify snapshots against their recorded checksums',
+    )
+    verify_parser.set_defaults(func=verify)
+    verify_parser.add_argument(
+        'repository',
+        action='store',
+        metavar='REPOSITORY_LOCATION',
+        help='Path to repository',
+    )
+    verify_parser.add_argument(
+        '--snapshot',
+        action='append',
+        help='snapshot to verify, can be given multiple times [default=all snapshots]',
+        default=None,
+    )
+    verify_parser.add_argument(
+        '--record',
+        action='store_true',
+        help='record checksums instead of verifying (e.g. for snapshots created before record_checksums was enabled)',
+    )
+    verify_parser.add_argument(
+        '-j', '--jobs',
+        help='number of hashing processes [default=number of cpus]',
+        type=int,
+        default=None,
+    )
+
+    # compare subcommand
+    compare_parser = subparsers.add_parser(
+        'compare',
+        epilog=compare.__doc__,
+        formatter_class=argparse.RawTextHelpFormatter,
+        help='Compare a snapshot with another snapshot or with the source directory',
+    )
+    compare_parser.set_defaults(func=compare)
+    compare_parser.add_argument(
+        'repository',
+        action='store',
+        metavar='REPOSITORY_LOCATION',
+        help='Path to repository',
+    )
+    compare_parser.add_argument(
+        'snapshot',
+        action='store',
+        metavar='SNAPSHOT',
+        help='snapshot or link',
+    )
+    compare_parser.add_argument(
+        'other',
+        action='store',
+        metavar='OTHER',
+        nargs='?',
+        default=None,
+        help='snapshot or link to compare with [default=the source directory]',
+    )
+
+    # schedule subcommand
+    schedule_parser = subparsers.add_parser(
+        'schedule',
+        epilog=schedule.__doc__,
+        formatter_class=argparse.RawTextHelpFormatter,
+        help='Take snapshots according to the schedules in the timeline configuration files',
+    )
+    schedule_parser.set_defaults(func=schedule)
+    schedule_parser.add_argument(
+        'repository',
+        action='store',
+        nargs='+',
+        metavar='REPOSITORY_LOCATION',
+        help='Path to repository or to a directory containing repositories',
+    )
+    schedule_parser.add_argument(
+        '--max-per-device',
+        help='max. amount of snapshots taken in parallel on the same device [default=1]',
+        type=int,
+        default=1,
+    )
+    schedule_parser.add_argument(
+        '--max-jobs',
+        help='max. amount of snapshots taken in parallel [default=4]',
+        type=int,
+        default=4,
+    )
+    schedule_parser.add_argument(
+        '--default-duration',
+        help='expected duration in seconds of timelines without recorded snapshot durations [default=600]',
+        type=int,
+        default=600,
+    )
+    schedule_parser.add_argument(
+        '--poll',
+        help='seconds between checks for due timelines [default=60]',
+        type=int,
+        default=60,
+    )
+    schedule_parser.add_argument(
+        '--once',
+        action='store_true',
+        help='take all currently due snapshots and exit (e.g. when started from cron)',
+    )
+    schedule_parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='only show the due timelines in the order they would be started',
+    )
+
+    # export subcommand
+    export_parser = subparsers.add_parser(
+        'export',
+        epilog=export_timeline.__doc__,
+        formatter_class=argparse.RawTextHelpFormatter,
+        help='Export the snapshots newer than a base snapshot as a stream, see import',
+    )
+    export_parser.set_defaults(func=export_timeline)
+    export_parser.add_argument(
+        'repository',
+        action='store',
+        metavar='REPOSITORY_LOCATION',
+        help='Path to repository',
+    )
+    export_parser.add_argument(
+        '--since',
+        action='store',
+        metavar='SNAPSHOT',
+        help='base snapshot, only files which are new compared to it are exported (default: all snapshots)',
+    )
+    export_parser.add_argument(
+        '-o', '--output',
+        action='store',
+        default='-',
+        metavar='FILE',
+        help='write the stream to FILE instead of stdout',
+    )
+    export_parser.add_argument(
+        '-z', '--gzip',
+        action='store_true',
+        help='compress the stream',
+    )
+
+    # import subcommand
+    import_parser = subparsers.add_parser(
+        'import',
+        epilog=import_timeline.__doc__,
+        formatter_class=argparse.RawTextHelpFormatter,
+        help='Import the snapshots and links of an export stream',
+    )
+    import_parser.set_defaults(func=import_timeline)
+    import_parser.add_argument(
+        'repository',
+        action='store',
+        metavar='REPOSITORY_LOCATION',
+        help='Path to repository',
+    )
+    import_parser.add_argument(
+        '-i', '--input',
+        action='store',
+        default='-',
+        metavar='FILE',
+        help='read the stream from FILE instead of stdin',
+    )
+
+    # which-snapshot subcommand
+    which_snapshot_parser = subparsers.add_parser(
+        'which-snapshot',
+        epilog=which_snapshot.__doc__,
+        formatter_class=argparse.RawTextHelpFormatter,
+        help='Show in which snapshots a package (version) was available',
+    )
+    which_snapshot_parser.set_defaults(func=which_snapshot)
+    which_snapshot_parser.add_argument(
+        'repository',
+        action='store',
+        metavar='REPOSITORY_LOCATION',
+        help='Path to repository',
+    )
+    which_snapshot_parser.add_argument(
+        'package',
+        action='store',
+        nargs='?',
+        metavar='PACKAGE[=VERSION]',
+        help='package name, optionally with version (e.g. bash=5.1.8-6.el9)',
+    )
+    which_snapshot_parser.add_argument(
+        '--index',
+        action='store_true',
+        help='add all snapshots which are not indexed yet to the package index first',
+    )
+
+    # history subcommand
+    history_parser = subparsers.add_parser(
+        'history',
+        epilog=history.__doc__,
+        formatter_class=argparse.RawTextHelpFormatter,
+        help='Show in which snapshots a path was added, removed or modified',
+    )
+    history_parser.set_defaults(func=history)
+    history_parser.add_argument(
+        'repository',
+        action='store',
+        metavar='REPOSITORY_LOCATION',
+        help='Path to repository',
+    )
+    history_parser.add_argument(
+        'path',
+        action='store',
+        nargs='?',
+        metavar='PATH',
+        help='path relative to the repository root, directories include the paths below them',
+    )
+    history_parser.add_argument(
+        '--no-recursive',
+        dest='recursive',
+        action='store_false',
+        help='do not include the changes of the paths below PATH',
+    )
+    history_parser.add_argument(
+        '--index',
+        action='store_true',
+        help='add the existing diff reports which are not indexed yet to the path history first',
+    )
+
+    # pipeline subcommand
+    pipeline_parser = subparsers.add_parser(
+        'pipeline',
+        epilog=pipeline_status.__doc__ + pipeline_run.__doc__,
+        formatter_class=argparse.RawTextHelpFormatter,
+        help='Show or run the post-snapshot pipeline (diff report, checksums, package index, metrics)',
+    )
+    pipeline_subparsers = pipeline_parser.add_subparsers(
+        dest='pipeline_command',
+        help='Available pipeline commands',
+    )
+    pipeline_subparsers.required = True
+    pipeline_status_parser = pipeline_subparsers.add_parser(
+        'status',
+        epilog=pipeline_status.__doc__,
+        formatter_class=argparse.RawTextHelpFormatter,
+        help='Show the queued, running, failed and recently finished pipeline jobs',
+    )
+    pipeline_status_parser.set_defaults(func=pipeline_status)
+    pipeline_run_parser = pipeline_subparsers.add_parser(
+        'run',
+        epilog=pipeline_run.__doc__,
+        formatter_class=argparse.RawTextHelpFormatter,
+        help='Run the queued pipeline jobs until the queue is empty',
+    )
+    pipeline_run_parser.set_defaults(func=pipeline_run)
+    pipeline_run_parser.add_argument(
+        '--jobs',
+        help='number of jobs run in parallel [default=pipeline_jobs in timeline.cfg]',
+        type=int,
+    )
+    pipeline_run_parser.add_argument(
+        '--no-wait',
+        dest='wait',
+        action='store_false',
+        help='do not wait for the retries of failed jobs, leave them in the queue',
+    )
+    pipeline_retry_parser = pipeline_subparsers.add_parser(
+        'retry',
+        help='Queue the failed pipeline jobs again and run them',
+    )
+    pipeline_retry_parser.set_defaults(func=pipeline_retry)
+    for p in (pipeline_status_parser, pipeline_run_parser, pipeline_retry_parser):
+        p.add_argument(
+            'repository',
+            action='store',
+            metavar='REPOSITORY_LOCATION',
+            help='Path to repository',
+        )
+
+    # pool subcommand
+    pool_parser = subparsers.add_parser(
+        'pool',
+        epilog=content_pool.__doc__,
+        formatter_class=argparse.RawTextHelpFormatter,
+        help='Show the content pool of a timeline or remove its unused files',
+    )
+    pool_parser.set_defaults(func=content_pool)
+    pool_parser.add_argument(
+        'repository',
+        action='store',
+        metavar='REPOSITORY_LOCATION',
+        help='Path to repository',
+    )
+    pool_parser.add_argument(
+        '--gc',
+        action='store_true',
+        help='remove the pooled files which are not linked from any snapshot or source anymore',
+    )
+
+    # learn subcommand
+    learn_parser = subparsers.add_parser(
+        'learn',
+        epilog=learn_copy_rules.__doc__,
+        formatter_class=argparse.RawTextHelpFormatter,
+        help='Show or apply the copy rules learned from in-place modifications of the source',
+    )
+    learn_parser.set_defaults(func=learn_copy_rules)
+    learn_parser.add_argument(
+        'repository',
+        action='store',
+        metavar='REPOSITORY_LOCATION',
+        help='Path to repository',
+    )
+    learn_parser.add_argument(
+        '--apply',
+        action='store_true',
+        help='write the learned copy rules into timeline.cfg',
+    )
+    learn_parser.add_argument(
+        '--reset',
+        action='store_true',
+        help='drop the observations and start learning again',
+    )
+
+    # catalog subcommand
+    catalog_parser = subparsers.add_parser(
+        'catalog',
+        epilog=catalog_rebuild.__doc__ + catalog_query.__doc__,
+        formatter_class=argparse.RawTextHelpFormatter,
+        help='Rebuild or query the catalog of all timelines',
+    )
+    catalog_parser.add_argument(
+        '--catalog',
+        help=f'path of the catalog database [default={catalog.DEFAULT_CATALOG}]',
+        default=catalog.DEFAULT_CATALOG,
+    )
+    catalog_subparsers = catalog_parser.add_subparsers(
+        dest='catalog_command',
+        help='Available catalog commands',
+    )
+    catalog_subparsers.required = True
+    catalog_rebuild_parser = catalog_subparsers.add_parser(
+        'rebuild',
+        epilog=catalog_rebuild.__doc__,
+        formatter_class=argparse.RawTextHelpFormatter,
+        help='Recreate the catalog from the metadata files of all timelines',
+    )
+    catalog_rebuild_parser.set_defaults(func=catalog_rebuild)
+    catalog_rebuild_parser.add_argument(
+        'repository',
+        action='store',
+        nargs='+',
+        metavar='REPOSITORY_LOCATION',
+        help='Path to repository or to a directory containing repositories',
+    )
+    catalog_query_parser = catalog_subparsers.add_parser(
+        'query',
+        epilog=catalog_query.__doc__,
+        formatter_class=argparse.RawTextHelpFormatter,
+        help='Query the catalog',
+    )
+    catalog_query_parser.set_defaults(func=catalog_query)
+    catalog_query_parser.add_argument(
+        'query',
+        action='store',
+        metavar='QUERY',
+        help='name of a predefined query ({0}) or an SQL statement'.format(', '.join(catalog.QUERIES)),
+    )
+
+    # http subcommand
+    http_parser = subparsers.add_parser(
+        'http',
+        epilog=http.__doc__,
+        formatter_class=argparse.RawTextHelpFormatter,
+        help='Serve the state of all timelines below a directory as JSON over HTTP (read-only)',
+    )
+    http_parser.set_defaults(func=http)
+    http_parser.add_argument(
+        'repository',
+        action='store',
+        metavar='ROOT',
+        help='Directory containing the timelines (searched recursively)',
+    )
+    http_parser.add_argument(
+        '--bind',
+        help='address to listen on [default=%(default)s]',
+        default='127.0.0.1',
+    )
+    http_parser.add_argument(
+        '--port',
+        help='port to listen on [default=%(default)s]',
+        type=int,
+        default=8080,
+    )
+    http_parser.add_argument(
+        '--revalidate',
+        help='seconds between checks of the metadata files for changes [default=%(default)s]',
+        type=float,
+        default=1.0,
+    )
+    http_parser.add_argument(
+        '--rescan',
+        help='seconds between searches for new timelines [default=%(default)s]',
+        type=float,
+        default=60.0,
+    )
+
+    # serve subcommand
+    serve_parser = subparsers.add_parser(
+        'serve',
+        epilog=serve.__doc__,
+        formatter_class=argparse.RawTextHelpFormatter,
+        help='Run a daemon which executes mrepo commands with resident timelines',
+    )
+    serve_parser.add_argument(
+        '--socket',
+        help=f'path of the unix domain socket [default=$MREPO_SOCKET or {daemon.DEFAULT_SOCKET}]',
+        default=None,
+    )
+    serve_parser.add_argument(
+        '--workers',
+        help='number of worker threads, i.e. timelines processed in parallel [default=8]',
+        type=int,
+        default=8,
+    )
+    serve_parser.add_argument(
+        '--mode',
+        help='permissions of the socket [default=0600]',
+        type=lambda value: int(value, 8),
+        default=0o600,
+    )
+    serve_parser.add_argument(
+        '--allow-uid',
+        help='uid of a user whose commands are executed besides root and the user running the daemon '
+             '(can be given several times)',
+        type=int,
+        action='append',
+        default=[],
+        dest='allow_uids',
+    )
+    serve_parser.set_defaults(
+        func=serve,
+        commands={name: p.get_default('func') for name, p in subparsers.choices.items()
+                  if name != 'serve' and p.get_default('func')},
+    )
+
     arguments = parser.parse_args()
 
     return arguments
 
 
+def _load(options, path):
+    """Load a timeline, the daemon passes its cache as options.loader"""
+
+    loader = getattr(options, 'loader', None) or timeline.Timeline.load
+    return loader(path)
+
+
 def config(options):
     """examples:
     %(prog)s /srv/repo/linux/ubuntu.timeline --freeze
     %(prog)s /srv/repo/linux/ubuntu.timeline --unfreeze
     %(prog)s /srv/repo/linux/ubuntu.timeline --consistency-check
+    %(prog)s /srv/repo/linux/ubuntu.timeline --consistency-check --dry-run
     %(prog)s /srv/repo/linux/ubuntu.timeline --max-snapshots=42
+    %(prog)s /srv/repo/linux/ubuntu.timeline --max-snapshots=20 --dry-run
+    %(prog)s /srv/repo/linux/ubuntu.timeline --excludes=dists/focal:pool/universe --dry-run
+
+    with --dry-run nothing is changed, it cannot be combined with --freeze/--unfreeze
     """
 
-    t = timeline.Timeline.load(options.repository)
+    if options.dry_run and (options.freeze or options.unfreeze):
+        raise Exception('--dry-run cannot be combined with --freeze/--unfreeze')
+
+    t = _load(options, options.repository)
+
+    if options.dry_run:
+        if options.max_snapshots or options.excludes is not None:
+            plan = t.plan(max_snapshots=options.max_snapshots, excludes=options.excludes)
+            for line in plan.describe():
+                print(line)
+        if options.consistency_check:
+            for line in t.consistency_check(dry_run=True).describe():
+                print(line)
+        if options.verbose:
+            print(t)
+        return
 
     if options.max_snapshots:
         t.set_max_snapshots( options.max_snapshots )
@@ -314,7 +858,7 @@ def create_default_links(options):
     %(prog)s /srv/repo/linux/ubuntu.timeline
     """
 
-    t = timeline.Timeline.load(options.repository)
+    t = _load(options, options.repository)
     t.create_link('upstream', max_offset=1)
     t.create_link('downstream')
     for i in (3, 7, 14, 21, 30, 60, 90):
@@ -337,7 +881,7 @@ def create_link(options):
         options.snapshot = os.path.split(
             os.path.normpath(options.snapshot)
         )[1]
-    t = timeline.Timeline.load(split_path[0])
+    t = _load(options, split_path[0])
     t.create_link(
         link=split_path[1],
         snapshot=options.snapshot,
@@ -372,7 +916,7 @@ def create_named_snap(options):
             sys.exit(0)
 
     try:
-        t = timeline.Timeline.load(split_path[0])
+        t = _load(options, split_path[0])
         t.create_named_snapshot(
             snapshot=split_path[1],
             source_snapshot=options.source_snapshot
@@ -405,8 +949,17 @@ def create_repo(options):
 def create_snap(options):
     """examples:
     %(prog)s /srv/repo/linux/ubuntu.timeline
+    %(prog)s /srv/repo/linux/ubuntu.timeline --lock --wait-for-sync --quiet-period=120
+    %(prog)s /srv/repo/linux/ubuntu.timeline --lock --sync-marker=.sync-done --sync-timeout=7200
+    %(prog)s /srv/repo/linux/ubuntu.timeline --dry-run
     """
 
+    if options.dry_run:
+        t = _load(options, options.repository)
+        for line in t.plan(create_snapshot=True).describe():
+            print(line)
+        return
+
     if options.lock:
         lock_file = os.path.join(options.repository, '.lock')
         lock = lockfile.FileLock(lock_file)
@@ -418,10 +971,14 @@ def create_snap(options):
             sys.exit(0)
 
     try:
-        t = timeline.Timeline.load( options.repository )
+        t = _load(options, options.repository)
         t.create_snapshot(
             random_sleep_before_snapshot=options.random_sleep,
-            sleep_after_snapshot=options.sleep_after
+            sleep_after_snapshot=options.sleep_after,
+            wait_for_sync=options.wait_for_sync,
+            sync_marker=options.sync_marker,
+            quiet_period=options.quiet_period,
+            sync_timeout=options.sync_timeout
         )
     except:
         if options.lock:
@@ -439,7 +996,7 @@ def delete_link(options):
 
     split_path = os.path.split(os.path.normpath(options.repository))
 
-    t = timeline.Timeline.load(split_path[0])
+    t = _load(options, split_path[0])
     t.delete_link(link=split_path[1])
 
 
@@ -451,7 +1008,7 @@ def delete_snap(options):
     snapshot_path = os.path.normpath(options.repository)
     split_path = os.path.split(snapshot_path)
 
-    t = timeline.Timeline.load(split_path[0])
+    t = _load(options, split_path[0])
 
     try:
         t.delete_snapshot(snapshot=split_path[1])
@@ -478,13 +1035,13 @@ def rename_link(options):
             os.path.normpath(options.linkname)
         )[1]
 
-    t = timeline.Timeline.load(split_path[0])
+    t = _load(options, split_path[0])
     l = t.delete_link(link=split_path[1])
     t.create_link(
         link=link_name,
-        snapshot=l['snapshot'],
-        max_offset=l['max_offset'],
-        warn_before_max_offset=l['warn_before_max_offset']
+        snapshot=l.snapshot,
+        max_offset=l.max_offset,
+        warn_before_max_offset=l.warn_before_max_offset
     )
 
 
@@ -503,16 +1060,397 @@ def update_link(options):
             os.path.normpath(options.snapshot)
         )[1]
 
-    t = timeline.Timeline.load(split_path[0])
+    t = _load(options, split_path[0])
     t.update_link(
         link=split_path[1],
         snapshot=options.snapshot
     )
 
 
+def _format_size(value, plain=False):
+    """Return a human readable size string"""
+
+    if plain:
+        return str(value)
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if abs(value) < 1024 or unit == 'TiB':
+            break
+        value /= 1024
+    return f'{value:.1f}{unit}' if unit != 'B' else f'{value}B'
+
+
+def usage(options):
+    """examples:
+    %(prog)s /srv/repo/linux/ubuntu.timeline
+    %(prog)s /srv/repo/linux/ubuntu.timeline --max-snapshots=30
+    """
+
+    t = _load(options, options.repository)
+    max_snapshots = options.max_snapshots or t.get_max_snapshots()
+    u = t.get_usage()
+
+    size = lambda value: _format_size(value, options.bytes)
+    print(f'{"SNAPSHOT":<28} {"EXCLUSIVE":>12} {"INODES":>10} {"SHARED":>12} {"INODES":>10} {"RECLAIM":>12}')
+    for n, s in enumerate(u.snapshots, 1):
+        print(f'{s.name:<28} {size(s.exclusive_bytes):>12} {s.exclusive_inodes:>10} '
+              f'{size(s.shared_bytes):>12} {s.shared_inodes:>10} {size(u.reclaimable[n][0]):>12}')
+    print()
+    print(f'source:   {size(u.source_bytes)} in {u.source_inodes} inodes')
+    print(f'external: {size(u.external_bytes)} in {u.external_inodes} inodes (hard-linked outside the timeline)')
+    reclaim_bytes, reclaim_inodes = u.reclaimable_for(max_snapshots)
+    print(f'max_snapshots={max_snapshots}: deleting '
+          f'{max(0, len(u.snapshots) - max_snapshots)} snapshot(s) frees '
+          f'{size(reclaim_bytes)} in {reclaim_inodes} inodes')
+
+
+def verify(options):
+    """examples:
+    %(prog)s /srv/repo/linux/ubuntu.timeline
+    %(prog)s /srv/repo/linux/ubuntu.timeline --snapshot=2015.02.12-141326 --jobs=8
+    %(prog)s /srv/repo/linux/ubuntu.timeline --record
+    """
+
+    t = _load(options, options.repository)
+
+    snapshots = None
+    if options.snapshot:
+        snapshots = [os.path.split(os.path.normpath(s))[1] for s in options.snapshot]
+
+    if options.record:
+        for snapshot in snapshots or t._lsnapshots:
+            t.record_checksums(snapshot, jobs=options.jobs)
+        return
+
+    drifted = t.verify_snapshots(snapshots, jobs=options.jobs)
+    for snapshot, files in drifted.items():
+        print(f'snapshot [{snapshot}]: {len(files)} file(s) drifted')
+        for path, expected, actual in files:
+            print(f'    {path}: expected {expected}, found {actual or "MISSING"}')
+    if drifted:
+        sys.exit(1)
+
+
+def compare(options):
+    """examples:
+    %(prog)s /srv/repo/linux/ubuntu.timeline upstream
+    %(prog)s /srv/repo/linux/ubuntu.timeline offset030 upstream
+    %(prog)s /srv/repo/linux/ubuntu.timeline 2015.02.12-141326 2015.02.13-141502
+
+    prints the paths added, removed or modified from SNAPSHOT to OTHER and exits with 1 if there are
+    differences. with directory_digests = True in timeline.cfg only the changed directories are read
+    """
+
+    t = _load(options, options.repository)
+
+    def resolve(name):
+        name = os.path.split(os.path.normpath(name))[1]
+        return t._links[name].snapshot if name in t._links else name
+
+    changes = t.compare(resolve(options.snapshot), resolve(options.other) if options.other else None)
+    for path, change in changes:
+        print(f'{change:8} {path}')
+    if changes:
+        sys.exit(1)
+
+
+def schedule(options):
+    """examples:
+    %(prog)s /srv/repo/linux
+    %(prog)s /srv/repo/linux/ubuntu.timeline /srv/repo/linux/scientific.timeline --max-per-device=2
+    %(prog)s /srv/repo/linux --dry-run
+
+    the schedule of each timeline is configured in its timeline.cfg
+    (schedule_interval, schedule_window, schedule_catch_up)
+    """
+
+    s = scheduler.Scheduler(
+        options.repository,
+        max_per_device=options.max_per_device,
+        max_jobs=options.max_jobs,
+        default_duration=options.default_duration,
+    )
+
+    if options.dry_run:
+        for job in s.due_jobs():
+            deadline = job.deadline.strftime('%H:%M') if job.deadline else '-'
+            print(f'{job.path:<50} expected={job.expected:.0f}s missed={job.missed} '
+                  f'window_end={deadline} device={job.device}')
+        return
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: s.stop())
+    try:
+        s.run(poll=options.poll, once=options.once)
+    except KeyboardInterrupt:
+        s.stop()
+
+
+def export_timeline(options):
+    """examples:
+    %(prog)s /srv/repo/linux/ubuntu.timeline --since 2024.03.01-030000 -o /tmp/ubuntu.tar
+    %(prog)s /srv/repo/linux/ubuntu.timeline --since 2024.03.01-030000 -z | ssh mirror2 mrepo import -i - /srv/repo/linux/ubuntu.timeline
+
+    the base snapshot must be the latest snapshot of the importing timeline
+    """
+
+    if options.output == '-':
+        # the stream goes to stdout, keep log messages out of it
+        _log_to_stderr()
+    t = _load(options, options.repository)
+    if options.output == '-':
+        t.export_snapshots(sys.stdout.buffer, options.since, options.gzip)
+        sys.stdout.buffer.flush()
+    else:
+        with open(options.output, 'wb') as fh:
+            t.export_snapshots(fh, options.since, options.gzip)
+
+
+def import_timeline(options):
+    """examples:
+    %(prog)s /srv/repo/linux/ubuntu.timeline -i /tmp/ubuntu.tar
+    ssh mirror1 mrepo export --since 2024.03.01-030000 -z /srv/repo/linux/ubuntu.timeline | %(prog)s /srv/repo/linux/ubuntu.timeline
+    """
+
+    t = _load(options, options.repository)
+    if options.input == '-':
+        t.import_snapshots(sys.stdin.buffer)
+    else:
+        with open(options.input, 'rb') as fh:
+            t.import_snapshots(fh)
+
+
+def _log_to_stderr():
+    for logger in (logging.getLogger(), logging.getLogger('Timeline')):
+        for handler in logger.handlers:
+            if isinstance(handler, logging.StreamHandler) and getattr(handler, 'stream', None) is sys.stdout:
+                handler.setStream(sys.stderr)
+
+
+def which_snapshot(options):
+    """examples:
+    %(prog)s /srv/repo/linux/rocky.timeline bash
+    %(prog)s /srv/repo/linux/rocky.timeline bash=5.1.8-6.el9
+    %(prog)s /srv/repo/linux/ubuntu.timeline openssl=3.0.2-0ubuntu1.15
+    %(prog)s /srv/repo/linux/ubuntu.timeline --index
+
+    requires package_index = True in timeline.cfg (or --index)
+    """
+
+    t = _load(options, options.repository)
+    if options.index:
+        t.index_packages()
+    if not options.package:
+        return
+
+    name, _, version = options.package.partition('=')
+    rows = t.find_package(name, version or None)
+    if not rows:
+        print(f'package [{options.package}] not found in the package index')
+        sys.exit(1)
+
+    latest = t._lsnapshots[-1] if t._lsnapshots else None
+    for name, version, arch, first, last in rows:
+        first_note = '' if first in t._snapshots else ' (deleted)'
+        last_note = ' (latest)' if last == latest else ('' if last in t._snapshots else ' (deleted)')
+        print(f'{name} {version} {arch}: {first}{first_note} -> {last}{last_note}')
+
+
+def history(options):
+    """examples:
+    %(prog)s /srv/repo/linux/rocky.timeline repodata/repomd.xml
+    %(prog)s /srv/repo/linux/rocky.timeline Packages/b
+    %(prog)s /srv/repo/linux/ubuntu.timeline --index
+
+    the path history is built from the diff reports, see diff_log_path in timeline.cfg
+    """
+
+    t = _load(options, options.repository)
+    if options.index:
+        t.index_diff_reports()
+    if options.path is None:
+        return
+
+    rows = t.path_history(options.path, options.recursive)
+    if not rows:
+        print(f'no changes of [{options.path}] recorded')
+        sys.exit(1)
+
+    for path, snapshot, previous, change in rows:
+        note = '' if snapshot in t._snapshots else ' (deleted)'
+        print(f'{snapshot}{note} {change:8} {path} (since {previous})')
+
+
+def pipeline_status(options):
+    """examples:
+    %(prog)s status /srv/repo/linux/ubuntu.timeline
+    """
+
+    jobs, active = pipeline.status(options.repository)
+    counts = {}
+    for job in jobs:
+        counts[job['state']] = counts.get(job['state'], 0) + 1
+    print('runner: {0}, jobs: {1}'.format(
+        'active' if active else 'idle',
+        ', '.join(f'{counts.get(state, 0)} {state}'
+                  for state in (pipeline.PENDING, pipeline.RUNNING, pipeline.FAILED, pipeline.DONE))))
+
+    now = time.time()
+    for job in jobs:
+        if job['state'] == pipeline.DONE:
+            info = 'took {0:.1f}s, done {1:.0f}s after the links were published'.format(
+                job['finished'] - job['started'], job['finished'] - job['queued'])
+        elif job['state'] == pipeline.RUNNING:
+            info = 'running for {0:.0f}s (pid {1})'.format(now - job['started'], job['pid'])
+        elif job['state'] == pipeline.PENDING and job['not_before'] > now:
+            info = 'retry in {0:.0f}s'.format(job['not_before'] - now)
+        else:
+            info = 'queued {0:.0f}s ago'.format(now - job['queued'])
+        error = f' error: {job["error"]}' if job['error'] else ''
+        print(f'{job["snapshot"]} {job["stage"]:10} {job["state"]:8} attempts={job["attempts"]} {info}{error}')
+
+
+def pipeline_run(options):
+    """
+    %(prog)s run /srv/repo/linux/ubuntu.timeline
+    %(prog)s run /srv/repo/linux/ubuntu.timeline --jobs=4 --no-wait
+
+    create-snapshot queues the pipeline of every new snapshot and starts a runner in the background,
+    see pipeline and pipeline_jobs in timeline.cfg. its output is appended to .pipeline.log
+    """
+
+    t = _load(options, options.repository)
+    done, failed = t.run_pipeline(jobs=options.jobs or t._pipeline_jobs, wait=options.wait)
+    print(f'{done} pipeline job(s) done, {failed} failed')
+
+
+def pipeline_retry(options):
+    """Queue the failed jobs again and run them"""
+
+    count = pipeline.Queue(options.repository).retry()
+    print(f'{count} failed pipeline job(s) queued again')
+    if count:
+        t = _load(options, options.repository)
+        t.run_pipeline(jobs=t._pipeline_jobs)
+
+
+def content_pool(options):
+    """examples:
+    %(prog)s /srv/repo/linux/rocky9.timeline
+    %(prog)s /srv/repo/linux/rocky9.timeline --gc
+
+    requires pool_path in timeline.cfg. the pool is shared by all timelines configured with the same pool_path
+    """
+
+    t = _load(options, options.repository)
+    if not t._pool_path:
+        print(f'no content pool configured, set pool_path in [{t._cfgfile}]')
+        sys.exit(1)
+    if options.gc:
+        removed, removed_bytes = t.collect_pool()
+        print(f'removed {removed} unused file(s) ({removed_bytes} bytes) from the pool')
+
+    p = pool.ContentPool(t._pool_path)
+    try:
+        entries, size, shared = p.summary()
+    finally:
+        p.close()
+    print(f'pool [{t._pool_path}]: {entries} file(s), {size} bytes, {shared} shared by several snapshots/sources')
+
+
+def learn_copy_rules(options):
+    """examples:
+    %(prog)s /srv/repo/linux/ubuntu.timeline
+    %(prog)s /srv/repo/linux/ubuntu.timeline --apply
+
+    the source is observed after each new snapshot while learn_copy_rules in timeline.cfg is set to the
+    number of snapshots to observe
+    """
+
+    t = _load(options, options.repository)
+    if not t._learn_copy_rules and not options.apply:
+        print(f'learning is disabled, set learn_copy_rules in [{t._cfgfile}]')
+    suggestion = t.learn_copy_rules(apply=options.apply, reset=options.reset)
+    if options.reset:
+        print('observations dropped')
+        return
+    print(f'learning: {suggestion.observations} of {t._learn_copy_rules} snapshot(s) observed')
+    for line in suggestion.describe():
+        print(line)
+    if options.apply:
+        print(f'copy rules written to [{t._cfgfile}]')
+
+
+def catalog_rebuild(options):
+    """examples:
+    %(prog)s rebuild /srv/repo
+    %(prog)s --catalog=/srv/repo/.catalog.sqlite rebuild /srv/repo/linux /srv/repo/windows
+    """
+
+    def states():
+        for path in timeline.find_timelines(options.repository):
+            try:
+                yield path, timeline.Timeline.read_metadata(path)
+            except Exception as e:
+                print(f'WARNING: cannot read timeline [{path}]: {e}', file=sys.stderr)
+
+    count = catalog.rebuild(options.catalog, states())
+    print(f'catalog [{options.catalog}] rebuilt with {count} timeline(s)')
+
+
+def catalog_query(options):
+    """
+    %(prog)s query frozen
+    %(prog)s query past-max-offset
+    %(prog)s query per-device
+    %(prog)s query "SELECT path, snapshots FROM timelines WHERE snapshots < max_snapshots"
+
+    set catalog_path in the MAIN section of timeline.cfg to keep the catalog
+    up to date whenever a timeline is changed
+    """
+
+    columns, rows = catalog.query(options.catalog, options.query)
+    print('\t'.join(columns))
+    for row in rows:
+        print('\t'.join('' if v is None else str(v) for v in row))
+
+
+def http(options):
+    """examples:
+    %(prog)s /srv/repo
+    %(prog)s /srv/repo --bind=0.0.0.0 --port=8081
+
+    endpoints:
+    /timelines, /timelines/<timeline>, /timelines/<timeline>/snapshots,
+    /timelines/<timeline>/links, /metrics
+    (<timeline> is the path of the timeline relative to ROOT)
+    """
+
+    status.serve(options.repository, options.bind, options.port, options.revalidate, options.rescan)
+
+
+def serve(options):
+    """examples:
+    %(prog)s
+    %(prog)s --socket=/run/mrepo.sock --workers=16
+
+    while the daemon is running, mrepo forwards all other subcommands to it
+    (unless --no-daemon is given). the socket path is taken from $MREPO_SOCKET.
+    commands of other users than root and the user running the daemon are
+    rejected unless they are allowed with --allow-uid
+    """
+
+    daemon.Daemon(options.commands, options.socket, options.workers, options.mode, options.allow_uids).run()
+
+
 def main():
     """Main party"""
     args = setup_argparse()
+    if not args.no_daemon:
+        response = daemon.forward(args.subcommand, vars(args))
+        if response is not None:
+            sys.stdout.write(response['output'])
+            if response['error']:
+                print(f'mrepo: error: {response["error"]}', file=sys.stderr)
+            sys.exit(response['status'])
     args.func(args)
 
 if __name__ == '__main__':
@@ -0,0 +1,355 @@
+"""Resident timeline daemon
+
+``mrepo serve`` keeps Timeline instances loaded and executes the regular
+subcommands on behalf of ``mrepo`` clients connecting to a Unix domain socket.
+This saves the interpreter startup, the logging setup and Timeline.load() for
+every call, which adds up when many small link updates are issued.
+
+Protocol: the client sends one JSON object per connection, terminated by a
+newline::
+
+    {"subcommand": "update-link", "options": {"repository": "/srv/...", ...}}
+
+and receives one JSON object::
+
+    {"status": 0, "output": "...", "error": null}
+
+Requests for the same timeline are serialised, requests for different
+timelines run in parallel in a pool of worker threads. A cached timeline is
+reloaded when its metadata file (.timeline) or configuration file changes,
+e.g. because it was modified by an ``mrepo`` call which bypassed the daemon.
+
+Requests are only executed for clients running as the user of the daemon,
+root or one of the allowed users (the uid of the peer is taken from
+SO_PEERCRED), whatever the permissions of the socket are.
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import io
+import json
+import logging
+import os
+import signal
+import socket
+import struct
+import sys
+import threading
+import traceback
+
+from timeline import timeline
+
+logger = logging.getLogger('Timeline.daemon')
+
+DEFAULT_SOCKET = '/run/mrepo.sock'
+
+# subcommands whose repository argument carries an appended link/snapshot name
+_NAMED_SUBCOMMANDS = frozenset((
+    'create-link', 'create-named-snapshot', 'delete-link', 'delete-snapshot', 'rename-link', 'update-link',
+))
+
+# options holding paths, made absolute by the client since the daemon runs in another directory
+_PATH_OPTIONS = ('repository', 'source', 'destination')
+
+# subcommands never forwarded to the daemon
+_LOCAL_SUBCOMMANDS = frozenset(('serve', 'schedule', 'http', 'catalog', 'export', 'import', 'pipeline'))
+
+_MAX_REQUEST = 1024 * 1024
+
+
+def socket_path():
+    """path of the daemon socket, can be changed with the MREPO_SOCKET environment variable"""
+
+    return os.environ.get('MREPO_SOCKET', DEFAULT_SOCKET)
+
+
+def timeline_key(subcommand, options):
+    """normalised path of the timeline a request operates on"""
+
+    path = options.get('destination') if subcommand == 'create-repo' else options.get('repository')
+    if not path:
+        return None
+    path = os.path.normpath(path)
+    if subcommand in _NAMED_SUBCOMMANDS:
+        path = os.path.dirname(path)
+    return path
+
+
+class _ThreadLocalStream(io.TextIOBase):
+    """stdout replacement which redirects writes of a thread into its capture buffer"""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._local = threading.local()
+
+    def _target(self):
+        return getattr(self._local, 'buffer', None) or self._stream
+
+    def writable(self):
+        return True
+
+    def write(self, s):
+        return self._target().write(s)
+
+    def flush(self):
+        self._target().flush()
+
+    def begin(self):
+        self._local.buffer = io.StringIO()
+
+    def end(self):
+        buffer = self._local.buffer
+        self._local.buffer = None
+        return buffer.getvalue()
+
+    def capturing(self):
+        return getattr(self._local, 'buffer', None) is not None
+
+
+class _CaptureHandler(logging.Handler):
+    """copy log records of a capturing thread into its output, like the console handler of a local run"""
+
+    def __init__(self, stream):
+        super().__init__(logging.INFO)
+        self._stream = stream
+        self.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                                            '%Y-%m-%d %H:%M:%S'))
+
+    def emit(self, record):
+        if self._stream.capturing():
+            self._stream.write(self.format(record) + '\n')
+
+
+class TimelineCache:
+    """loaded Timeline instances, revalidated against the metadata/configuration files"""
+
+    def __init__(self):
+        self._timelines = {}
+        self._mutex = threading.Lock()
+
+    @staticmethod
+    def _signature(path):
+        sig = []
+        for name in (timeline.Timeline._datafile_ext, timeline.Timeline._cfgfile_ext):
+            try:
+                st = os.stat(os.path.join(path, name))
+            except OSError:
+                sig.append(None)
+                continue
+            sig.append((st.st_ino, st.st_size, st.st_mtime_ns))
+        return tuple(sig)
+
+    def load(self, path):
+        """return the cached Timeline for path, (re)load it if the files on disk changed"""
+
+        path = os.path.normpath(os.path.abspath(path))
+        signature = self._signature(path)
+        with self._mutex:
+            cached = self._timelines.get(path)
+        if cached and cached[1] == signature:
+            return cached[0]
+
+        if cached:
+            logger.info('timeline [%s] changed on disk, reloading', path)
+        t = timeline.Timeline.load(path)
+        with self._mutex:
+            self._timelines[path] = (t, self._signature(path))
+        return t
+
+    def refresh(self, path):
+        """remember the current on-disk state of path after a request modified it"""
+
+        path = os.path.normpath(os.path.abspath(path))
+        with self._mutex:
+            cached = self._timelines.get(path)
+            if cached:
+                self._timelines[path] = (cached[0], self._signature(path))
+
+    def discard(self, path):
+        """drop path from the cache, e.g. after a failed request left the instance in an unknown state"""
+
+        path = os.path.normpath(os.path.abspath(path))
+        with self._mutex:
+            self._timelines.pop(path, None)
+
+    def __len__(self):
+        return len(self._timelines)
+
+
+class Daemon:
+    """asyncio server executing mrepo subcommands
+
+            commands:   dict subcommand -> function taking an argparse.Namespace (see cli)
+            workers:    number of worker threads, i.e. timelines processed in parallel
+    """
+
+    def __init__(self, commands, path=None, workers=8, mode=0o600, allow_uids=()):
+        self._commands = commands
+        self._path = path or socket_path()
+        self._mode = mode
+        self._uids = {0, os.getuid(), *allow_uids}
+        self._cache = TimelineCache()
+        self._locks = {}
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self._stdout = None
+        self._server = None
+
+    def _execute(self, subcommand, options, key):
+        """run a subcommand in a worker thread, return the response dict"""
+
+        options = dict(options)
+        options['loader'] = self._cache.load
+        namespace = argparse.Namespace(**options)
+
+        status, error = 0, None
+        self._stdout.begin()
+        try:
+            self._commands[subcommand](namespace)
+        except SystemExit as e:
+            if isinstance(e.code, int) or e.code is None:
+                status = e.code or 0
+            else:
+                status, error = 1, str(e.code)
+        except Exception as e:
+            status, error = 1, str(e) or e.__class__.__name__
+            logger.debug('request [%s] failed:\n%s', subcommand, traceback.format_exc())
+        finally:
+            output = self._stdout.end()
+
+        if key:
+            if status:
+                self._cache.discard(key)
+            else:
+                self._cache.refresh(key)
+        return {'status': status, 'output': output, 'error': error}
+
+    def _authorized(self, sock):
+        """check the user of the client connected to sock against the allowed users"""
+
+        uid = peer_uid(sock)
+        if uid not in self._uids:
+            logger.warning('rejecting request of user [%s]', uid)
+            return False
+        return True
+
+    async def _handle(self, reader, writer):
+        try:
+            line = await reader.readline()
+            if not self._authorized(writer.get_extra_info('socket')):
+                raise PermissionError('permission denied')
+            request = json.loads(line)
+            subcommand = request['subcommand']
+            options = request.get('options') or {}
+            if subcommand not in self._commands or subcommand in _LOCAL_SUBCOMMANDS:
+                raise ValueError(f'unknown subcommand [{subcommand}]')
+        except PermissionError as e:
+            request, response = None, {'status': 2, 'output': '', 'error': str(e)}
+        except (ValueError, KeyError, TypeError) as e:
+            response = {'status': 2, 'output': '', 'error': f'invalid request: {e}'}
+        else:
+            key = timeline_key(subcommand, options)
+            logger.debug('request [%s] for [%s]', subcommand, key)
+            lock = self._locks.setdefault(key, asyncio.Lock())
+            async with lock:
+                loop = asyncio.get_running_loop()
+                response = await loop.run_in_executor(self._executor, self._execute, subcommand, options, key)
+
+        try:
+            writer.write(json.dumps(response).encode() + b'\n')
+            await writer.drain()
+        except ConnectionError:
+            logger.warning('client went away before the response for [%s] was sent', request)
+        finally:
+            writer.close()
+
+    async def _serve(self):
+        if os.path.exists(self._path):
+            if _connect(self._path) is not None:
+                raise Exception(f'daemon already running on [{self._path}]')
+            os.unlink(self._path)
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop.set)
+
+        self._server = await asyncio.start_unix_server(self._handle, path=self._path, limit=_MAX_REQUEST)
+        os.chmod(self._path, self._mode)
+        logger.info('listening on [%s]', self._path)
+        async with self._server:
+            await stop.wait()
+
+    def run(self):
+        """serve until interrupted"""
+
+        self._stdout = _ThreadLocalStream(sys.stdout)
+        sys.stdout = self._stdout
+        handler = _CaptureHandler(self._stdout)
+        logging.getLogger('Timeline').addHandler(handler)
+        try:
+            asyncio.run(self._serve())
+        finally:
+            logging.getLogger('Timeline').removeHandler(handler)
+            sys.stdout = self._stdout._stream
+            self._executor.shutdown(wait=True)
+            if os.path.exists(self._path):
+                os.unlink(self._path)
+            logger.info('daemon on [%s] stopped', self._path)
+
+
+def peer_uid(sock):
+    """uid of the process connected to the unix domain socket sock"""
+
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    return struct.unpack('3i', creds)[1]
+
+
+def _connect(path):
+    """return a socket connected to the daemon, None if it is not running
+
+            a socket file left behind by a daemon which died refuses the connection
+    """
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError as e:
+        logger.debug('cannot connect to the daemon on [%s]: %s', path, e)
+        sock.close()
+        return None
+    return sock
+
+
+def forward(subcommand, options):
+    """send a request to a running daemon
+
+            returns the response dict, None if no daemon is running or it went away before it got
+            the whole request (i.e. the request was not executed)
+    """
+
+    if subcommand in _LOCAL_SUBCOMMANDS:
+        return None
+    path = socket_path()
+    if not os.path.exists(path):
+        return None
+    sock = _connect(path)
+    if sock is None:
+        return None
+
+    options = {k: v for k, v in options.items() if k not in ('func', 'loader')}
+    for name in _PATH_OPTIONS:
+        if options.get(name):
+            options[name] = os.path.abspath(options[name])
+
+    with sock:
+        try:
+            sock.sendall(json.dumps({'subcommand': subcommand, 'options': options}).encode() + b'\n')
+        except ConnectionError as e:
+            logger.debug('daemon on [%s] went away: %s', path, e)
+            return None
+        with sock.makefile('rb') as fh:
+            line = fh.readline()
+    if not line:
+        raise Exception(f'daemon on [{path}] closed the connection without response')
+    return json.loads(line)
@@ -0,0 +1,435 @@
+"""File system backends
+
+Timeline creates, copies and removes snapshot trees and links only through
+a backend, so the engine doing the work can be replaced:
+
+- ``SubprocessFileSystem``: ``cp``, ``rm``, ``ln`` and ``find`` processes
+  (the default, ``filesystem = subprocess`` in timeline.cfg)
+- ``NativeFileSystem``: ``os`` calls in the mrepo process, no process is
+  started per operation (``filesystem = native``)
+- ``MemoryFileSystem``: a tree in memory, for benchmarking and simulating the
+  metadata and rotation logic without any disk I/O (passed to
+  ``Timeline(..., backend=...)``, it cannot be configured)
+
+The metadata files of a timeline (state, configuration, queues, indexes) are
+regular files with every backend. Features which read the contents of the
+snapshots (metadata validation, content pool, directory listings and
+digests, the post-snapshot pipeline) require a backend on disk.
+"""
+
+import abc
+import fnmatch
+import os
+import shutil
+import stat
+import subprocess
+import threading
+
+DIR, FILE, SYMLINK, OTHER = 'dir', 'file', 'symlink', 'other'
+
+
+class FileSystem(abc.ABC):
+    """interface of the backends, paths are absolute"""
+
+    # the trees are on disk, so other code can read them
+    on_disk = True
+
+    @abc.abstractmethod
+    def exists(self, path):
+        """like os.path.exists()"""
+
+    @abc.abstractmethod
+    def isdir(self, path):
+        """like os.path.isdir()"""
+
+    @abc.abstractmethod
+    def islink(self, path):
+        """like os.path.islink()"""
+
+    @abc.abstractmethod
+    def readlink(self, path):
+        """like os.readlink()"""
+
+    @abc.abstractmethod
+    def entries(self, path):
+        """return {name: DIR, FILE, SYMLINK or OTHER} of the entries of a directory (symbolic links not followed)"""
+
+    @abc.abstractmethod
+    def makedirs(self, path, exist_ok=False):
+        """like os.makedirs()"""
+
+    @abc.abstractmethod
+    def link_tree(self, source, directory):
+        """hard-link source (recursively for a directory) into directory, like 'cp -al'"""
+
+    @abc.abstractmethod
+    def copy_tree(self, source, target):
+        """copy source (recursively for a directory) to the new path target, like 'cp -a'"""
+
+    @abc.abstractmethod
+    def copy_into(self, sources, directory):
+        """copy the given files into directory, like 'cp -a'"""
+
+    @abc.abstractmethod
+    def remove(self, path):
+        """remove a file or symbolic link, like 'rm -f'"""
+
+    @abc.abstractmethod
+    def remove_tree(self, path, inodes=None):
+        """remove path and everything below it, like 'rm -rf'
+
+                the inode numbers of the removed files are added to the set inodes if given (backends on disk)
+        """
+
+    @abc.abstractmethod
+    def symlink(self, target, path, replace=False):
+        """create a symbolic link to target, with replace an existing link is replaced atomically"""
+
+    def find(self, root, patterns, kind):
+        """return the paths of the directories (kind DIR) or files (kind FILE) below root whose names match patterns"""
+
+        found = []
+        stack = [root]
+        while stack:
+            directory = stack.pop()
+            for name, k in sorted(self.entries(directory).items()):
+                path = os.path.join(directory, name)
+                if k == kind and any(fnmatch.fnmatch(name, p) for p in patterns):
+                    found.append(path)
+                if k == DIR:
+                    stack.append(path)
+        return found
+
+
+class NativeFileSystem(FileSystem):
+    """os calls in the current process"""
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def isdir(self, path):
+        return os.path.isdir(path)
+
+    def islink(self, path):
+        return os.path.islink(path)
+
+    def readlink(self, path):
+        return os.readlink(path)
+
+    def entries(self, path):
+        result = {}
+        with os.scandir(path) as it:
+            for e in it:
+                if e.is_symlink():
+                    result[e.name] = SYMLINK
+                elif e.is_dir(follow_symlinks=False):
+                    result[e.name] = DIR
+                else:
+                    result[e.name] = FILE if e.is_file(follow_symlinks=False) else OTHER
+        return result
+
+    def makedirs(self, path, exist_ok=False):
+        os.makedirs(path, exist_ok=exist_ok)
+
+    @staticmethod
+    def _copy_metadata(path, st):
+        """owner, mode and times of a directory, set after its entries have been added"""
+
+        try:
+            os.chown(path, st.st_uid, st.st_gid)
+        except PermissionError:
+            pass
+        os.chmod(path, stat.S_IMODE(st.st_mode))
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    def _tree(self, source, target, copy_file):
+        st = os.lstat(source)
+        if not stat.S_ISDIR(st.st_mode):
+            copy_file(source, target, st)
+            return
+        os.mkdir(target)
+        with os.scandir(source) as it:
+            names = [e.name for e in it]
+        for name in names:
+            self._tree(os.path.join(source, name), os.path.join(target, name), copy_file)
+        self._copy_metadata(target, st)
+
+    @staticmethod
+    def _link_file(source, target, st):
+        os.link(source, target, follow_symlinks=False)
+
+    @staticmethod
+    def _copy_file(source, target, st):
+        if stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(source), target)
+            try:
+                os.lchown(target, st.st_uid, st.st_gid)
+            except PermissionError:
+                pass
+            return
+        # copy2 copies the content, mode, times and extended attributes
+        shutil.copy2(source, target, follow_symlinks=False)
+        try:
+            os.chown(target, st.st_uid, st.st_gid)
+        except PermissionError:
+            pass
+
+    def link_tree(self, source, directory):
+        self._tree(source, os.path.join(directory, os.path.basename(source)), self._link_file)
+
+    def copy_tree(self, source, target):
+        self._tree(source, target, self._copy_file)
+
+    def copy_into(self, sources, directory):
+        for source in sources:
+            self._copy_file(source, os.path.join(directory, os.path.basename(source)), os.lstat(source))
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def remove_tree(self, path, inodes=None):
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            return
+        if not stat.S_ISDIR(st.st_mode):
+            os.remove(path)
+            if inodes is not None and stat.S_ISREG(st.st_mode):
+                inodes.add(st.st_ino)
+            return
+        with os.scandir(path) as it:
+            names = [e.name for e in it]
+        for name in names:
+            self.remove_tree(os.path.join(path, name), inodes)
+        os.rmdir(path)
+
+    def symlink(self, target, path, replace=False):
+        if not replace:
+            os.symlink(target, path)
+            return
+        tmp_path = '{0}.tmp{1}'.format(path, os.getpid())
+        os.symlink(target, tmp_path)
+        os.replace(tmp_path, path)
+
+
+class SubprocessFileSystem(NativeFileSystem):
+    """cp, rm, ln and find processes, queries are answered by os calls"""
+
+    def link_tree(self, source, directory):
+        subprocess.check_call(['cp', '-al', source, directory])
+
+    def copy_tree(self, source, target):
+        subprocess.check_call(['cp', '-a', source, target])
+
+    def copy_into(self, sources, directory):
+        subprocess.check_call(['cp', '-a'] + list(sources) + [directory])
+
+    def remove(self, path):
+        subprocess.check_call(['rm', '-f', path])
+
+    def remove_tree(self, path, inodes=None):
+        if inodes is not None:
+            # rm does not report what it removed
+            return super().remove_tree(path, inodes)
+        subprocess.check_call(['rm', '-rf', path])
+
+    def symlink(self, target, path, replace=False):
+        if not replace:
+            subprocess.check_call(['ln', '-s', target, path])
+            return
+        tmp_path = '{0}.tmp{1}'.format(path, os.getpid())
+        subprocess.check_call(['ln', '-s', target, tmp_path])
+        subprocess.check_call(['mv', '-Tf', tmp_path, path])
+
+    def find(self, root, patterns, kind):
+        # e.g. find /tmp/foo -type d ( -name repodata -o -name repoview -o -name bar )
+        cmd = ['find', root, '-type', 'd' if kind == DIR else 'f', '(', '-name', patterns[0]]
+        for p in patterns[1:]:
+            cmd.extend(['-o', '-name', p])
+        cmd.append(')')
+        return subprocess.Popen(cmd, stdout=subprocess.PIPE, encoding='utf-8').communicate()[0].splitlines()
+
+
+class _File:
+    """a file of the memory backend, shared by its hard links"""
+
+    __slots__ = ('size',)
+
+    def __init__(self, size=0):
+        self.size = size
+
+
+class _Symlink:
+    __slots__ = ('target',)
+
+    def __init__(self, target):
+        self.target = target
+
+
+class MemoryFileSystem(FileSystem):
+    """a tree in memory: directories are dicts, files are _File objects shared by their hard links"""
+
+    on_disk = False
+
+    # symbolic links followed when resolving a path
+    _MAX_LINKS = 40
+
+    def __init__(self):
+        self._root = {}
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _parts(path):
+        return [p for p in os.path.normpath(path).split('/') if p]
+
+    def _lookup(self, path, follow=True, links=0):
+        """return the node at path, None if it does not exist"""
+
+        node = self._root
+        parts = self._parts(path)
+        for n, name in enumerate(parts):
+            if not isinstance(node, dict) or name not in node:
+                return None
+            node = node[name]
+            if isinstance(node, _Symlink) and (follow or n < len(parts) - 1):
+                if links >= self._MAX_LINKS:
+                    return None
+                base = '/' + '/'.join(parts[:n])
+                node = self._lookup(os.path.join(base, node.target), True, links + 1)
+                if node is None:
+                    return None
+        return node
+
+    def _parent(self, path):
+        """return (directory node, name) of path, the directory must exist"""
+
+        parent = self._lookup(os.path.dirname(os.path.normpath(path)))
+        if not isinstance(parent, dict):
+            raise FileNotFoundError(f'no such directory [{os.path.dirname(path)}]')
+        return parent, os.path.basename(os.path.normpath(path))
+
+    def exists(self, path):
+        return self._lookup(path) is not None
+
+    def isdir(self, path):
+        return isinstance(self._lookup(path), dict)
+
+    def islink(self, path):
+        return isinstance(self._lookup(path, follow=False), _Symlink)
+
+    def readlink(self, path):
+        node = self._lookup(path, follow=False)
+        if not isinstance(node, _Symlink):
+            raise OSError(f'[{path}] is not a symbolic link')
+        return node.target
+
+    def entries(self, path):
+        node = self._lookup(path)
+        if not isinstance(node, dict):
+            raise FileNotFoundError(f'no such directory [{path}]')
+        return {name: DIR if isinstance(n, dict) else SYMLINK if isinstance(n, _Symlink) else FILE
+                for name, n in list(node.items())}
+
+    def makedirs(self, path, exist_ok=False):
+        with self._lock:
+            node = self._root
+            parts = self._parts(path)
+            for n, name in enumerate(parts):
+                child = node.get(name)
+                if child is None:
+                    child = node[name] = {}
+                elif not isinstance(child, dict):
+                    raise FileExistsError(f'[{path}] exists and is not a directory')
+                elif n == len(parts) - 1 and not exist_ok:
+                    raise FileExistsError(f'[{path}] exists')
+                node = child
+
+    @staticmethod
+    def _clone(node, copy):
+        if isinstance(node, dict):
+            return {name: MemoryFileSystem._clone(child, copy) for name, child in node.items()}
+        if copy and isinstance(node, _File):
+            return _File(node.size)
+        return node
+
+    def _add(self, source, target, copy):
+        with self._lock:
+            node = self._lookup(source, follow=False)
+            if node is None:
+                raise FileNotFoundError(f'no such file or directory [{source}]')
+            parent, name = self._parent(target)
+            if name in parent:
+                raise FileExistsError(f'[{target}] exists')
+            parent[name] = self._clone(node, copy)
+
+    def link_tree(self, source, directory):
+        self._add(source, os.path.join(directory, os.path.basename(source)), False)
+
+    def copy_tree(self, source, target):
+        self._add(source, target, True)
+
+    def copy_into(self, sources, directory):
+        for source in sources:
+            self._add(source, os.path.join(directory, os.path.basename(source)), True)
+
+    def remove(self, path):
+        with self._lock:
+            parent = self._lookup(os.path.dirname(os.path.normpath(path)))
+            name = os.path.basename(os.path.normpath(path))
+            if not isinstance(parent, dict) or name not in parent:
+                return
+            if isinstance(parent[name], dict):
+                raise IsADirectoryError(f'[{path}] is a directory')
+            del parent[name]
+
+    def remove_tree(self, path, inodes=None):
+        # the files have no inode numbers
+        with self._lock:
+            parent = self._lookup(os.path.dirname(os.path.normpath(path)))
+            if isinstance(parent, dict):
+                parent.pop(os.path.basename(os.path.normpath(path)), None)
+
+    def symlink(self, target, path, replace=False):
+        with self._lock:
+            parent, name = self._parent(path)
+            if name in parent and not replace:
+                raise FileExistsError(f'[{path}] exists')
+            parent[name] = _Symlink(target)
+
+    def write_file(self, path, size=0):
+        """create or replace (new inode) a file, its directory must exist"""
+
+        with self._lock:
+            parent, name = self._parent(path)
+            parent[name] = _File(size)
+
+    def import_tree(self, source, path):
+        """copy the structure of the tree source on disk to path (file sizes only, no contents)"""
+
+        self.makedirs(path, exist_ok=True)
+        with os.scandir(source) as it:
+            for e in it:
+                target = os.path.join(path, e.name)
+                if e.is_symlink():
+                    self.symlink(os.readlink(e.path), target)
+                elif e.is_dir(follow_symlinks=False):
+                    self.import_tree(e.path, target)
+                else:
+                    self.write_file(target, e.stat(follow_symlinks=False).st_size)
+
+
+BACKENDS = {
+    'subprocess': SubprocessFileSystem,
+    'native': NativeFileSystem,
+}
+
+
+def create(name):
+    """return a new instance of the backend configured as name (see BACKENDS)"""
+
+    if name not in BACKENDS:
+        raise Exception('unknown file system backend [{0}], use one of: {1}'.format(name, ', '.join(sorted(BACKENDS))))
+    return BACKENDS[name]()
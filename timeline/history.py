@@ -0,0 +1,126 @@
+"""Path history across snapshots
+
+Every diff report (``diff -r -q`` of a new snapshot against the previous one,
+see ``diff_log_path``) is parsed as it is generated and added to a history
+index: for every changed path the generation and the kind of change
+(added, removed, modified). The index lives in the SQLite database of the
+timeline destination (next to the package index), sorted by path, so the
+history of a file or of a whole directory is a single range lookup. It
+survives the rotation of the snapshots and of their diff reports.
+"""
+
+import logging
+import os
+import sqlite3
+
+logger = logging.getLogger('Timeline.history')
+
+ADDED = 'added'
+REMOVED = 'removed'
+MODIFIED = 'modified'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS path_history (
+    path TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    change TEXT NOT NULL,
+    PRIMARY KEY (path, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS diff_reports (
+    seq INTEGER PRIMARY KEY,
+    snapshot TEXT NOT NULL,
+    previous TEXT NOT NULL
+);
+'''
+
+
+def parse_diff_report(lines, current_path, previous_path):
+    """yield (relative path, change) for the lines of a 'diff -r -q current previous' report"""
+
+    current = current_path.rstrip('/') + '/'
+    previous = previous_path.rstrip('/') + '/'
+
+    def relative(path):
+        for prefix in (current, previous):
+            if path.startswith(prefix):
+                return path[len(prefix):]
+            if path == prefix[:-1]:
+                return ''
+        return None
+
+    for line in lines:
+        line = line.rstrip('\n')
+        if line.startswith('Only in '):
+            directory, sep, name = line[8:].partition(': ')
+            rel = relative(directory)
+            if not sep or rel is None:
+                continue
+            change = ADDED if (directory + '/').startswith(current) else REMOVED
+            yield (os.path.join(rel, name) if rel else name), change
+        elif line.startswith('Files ') and line.endswith(' differ'):
+            path, sep, _ = line[6:].partition(' and ' + previous)
+            rel = relative(path)
+            if sep and rel is not None:
+                yield rel, MODIFIED
+        elif line.startswith('File ') and ' while file ' + previous in line:
+            # type changes: 'File <a> is a directory while file <b> is a regular file'
+            path = line[5:line.index(' while file ' + previous)].rsplit(' is a', 1)[0]
+            rel = relative(path)
+            if rel is not None:
+                yield rel, MODIFIED
+        else:
+            logger.debug('ignoring diff report line [%s]', line)
+
+
+class HistoryIndex:
+    """the path history of a timeline, stored in a sqlite database"""
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, timeout=30)
+        self._db.executescript(_SCHEMA)
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+    def indexed(self):
+        """return the set of generations whose diff report is in the index"""
+
+        return {seq for seq, in self._db.execute('SELECT seq FROM diff_reports')}
+
+    def add_report(self, report, seq, snapshot, previous, current_path, previous_path):
+        """add the diff report (file name) of snapshot (generation seq) against previous, returns the number of changes"""
+
+        with open(report, errors='replace') as fh:
+            changes = dict(parse_diff_report(fh, current_path, previous_path))
+        with self._db as db:
+            db.execute('DELETE FROM path_history WHERE seq = ?', (seq,))
+            db.executemany('INSERT INTO path_history VALUES (?, ?, ?)',
+                           ((path, seq, change) for path, change in changes.items()))
+            db.execute('INSERT OR REPLACE INTO diff_reports VALUES (?, ?, ?)', (seq, snapshot, previous))
+        logger.debug('indexed [%s] changes of snapshot [%s]', len(changes), snapshot)
+        return len(changes)
+
+    def lookup(self, path, recursive=True):
+        """return (path, snapshot, previous snapshot, change) for the changes of path, oldest first
+
+                recursive:  include the changes below path (a prefix range on the sorted index)
+                changes of the parent directories (i.e. path was added or removed with them) are included
+        """
+
+        path = path.strip('/')
+        clauses = ['h.path = ?']
+        params = [path]
+        if recursive:
+            # '0' follows '/', so this is the range of all paths below path
+            clauses.append('(h.path >= ? AND h.path < ?)' if path else 'h.path >= ?')
+            params.extend([path + '/', path + '0'] if path else [''])
+        parent = os.path.dirname(path)
+        while parent:
+            clauses.append('h.path = ?')
+            params.append(parent)
+            parent = os.path.dirname(parent)
+
+        sql = ('SELECT h.path, r.snapshot, r.previous, h.change FROM path_history h '
+               'JOIN diff_reports r ON r.seq = h.seq WHERE ' + ' OR '.join(clauses) + ' ORDER BY h.seq, h.path')
+        return self._db.execute(sql, params).fetchall()
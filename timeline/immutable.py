@@ -0,0 +1,75 @@
+"""Content-addressed files in copied repository metadata
+
+The directories and files of ``copy_dirs_recursive``/``copy_files_recursive``
+are copied into every snapshot because the mirror tool rewrites them. Parts of
+them never change though: Debian ``by-hash/<algorithm>/<digest>`` files and
+RPM ``repodata`` files named ``<checksum>-primary.xml.gz`` etc. encode their
+content in their name, a new version is a new file. Files matching the
+``immutable_files_recursive`` patterns are left hard-linked inside copied
+directories, only the other (mutable) files such as ``repomd.xml``,
+``Release`` or ``InRelease`` are copied.
+
+Patterns are shell-style patterns matched against the path of a file
+relative to the source directory, with a leading ``/`` (``*`` also matches
+``/``), e.g. ``*/by-hash/*/*``.
+"""
+
+import fnmatch
+import logging
+import os
+import re
+
+from timeline import filesystem
+
+logger = logging.getLogger('Timeline.immutable')
+
+# Debian/Ubuntu: dists/<suite>/<component>/binary-<arch>/by-hash/SHA256/<digest>
+DEBIAN_RULES = ['*/by-hash/*/*']
+
+# RPM (createrepo unique-md-filenames): repodata/<md5, sha1, sha256 or sha512>-<type>.<ext>
+REDHAT_RULES = ['*/repodata/' + '[0-9a-f]' * 32 + '*-*']
+
+DEFAULT_RULES = DEBIAN_RULES + REDHAT_RULES
+
+
+def compile_rules(rules):
+    """return a function telling whether a relative path matches one of the rules, None without rules"""
+
+    if not rules:
+        return None
+    regex = re.compile('|'.join(fnmatch.translate(r) for r in rules))
+    return lambda relpath: regex.match('/' + relpath) is not None
+
+
+def copy_mutable_files(fs, source_dir, snapshot_dir, relpath, is_immutable):
+    """replace the hard links of the mutable files below snapshot_dir by copies of the files in source_dir
+
+            fs:             file system backend, see timeline.filesystem
+            relpath:        path of both directories relative to the source/snapshot directory
+            is_immutable:   function returned by compile_rules()
+
+            files are copied with one copy per directory, returns (files copied, files left hard-linked)
+    """
+
+    copied = kept = 0
+    stack = ['']
+    while stack:
+        rel_dir = stack.pop()
+        mutable = []
+        for name, kind in fs.entries(os.path.join(snapshot_dir, rel_dir)).items():
+            rel = os.path.join(rel_dir, name)
+            if kind == filesystem.DIR:
+                stack.append(rel)
+            elif kind != filesystem.FILE:
+                continue
+            elif is_immutable(os.path.join(relpath, rel)):
+                kept += 1
+            else:
+                mutable.append(name)
+        if not mutable:
+            continue
+        for name in mutable:
+            fs.remove(os.path.join(snapshot_dir, rel_dir, name))
+        fs.copy_into([os.path.join(source_dir, rel_dir, name) for name in mutable], os.path.join(snapshot_dir, rel_dir))
+        copied += len(mutable)
+    return copied, kept
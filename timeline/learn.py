@@ -0,0 +1,219 @@
+"""Learning the copy rules from observed in-place modifications
+
+Files of the source are hard-linked into the snapshots, so a file which the
+mirror tool rewrites in place (same inode, new content) changes in every
+snapshot holding it. ``copy_dirs_recursive``/``copy_files_recursive`` must
+cover these files, but the default rules are guesses: they copy whole
+metadata directories which are often replaced file by file (new inodes, safe
+to hard-link) and miss files which are rewritten in place elsewhere.
+
+With ``learn_copy_rules = N`` the source is observed after each of the next
+N snapshots (the ``learn`` stage of the post-snapshot pipeline): the inode,
+size and mtime of every file are recorded in ``.learn.sqlite`` and a file
+whose size or mtime changed while its inode stayed the same has been
+modified in place. Afterwards the smallest set of rules (directory or file
+names, chosen by the bytes they copy) covering all of these files is
+suggested, together with the bytes per snapshot it copies compared to the
+current rules, and applied to timeline.cfg with ``learn_copy_rules_apply``
+or ``mrepo learn --apply``.
+"""
+
+import fnmatch
+import json
+import logging
+import os
+import sqlite3
+import time
+
+logger = logging.getLogger('Timeline.learn')
+
+DB_FILE = '.learn.sqlite'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    present INTEGER NOT NULL,
+    inplace INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+) WITHOUT ROWID;
+'''
+
+
+class Suggestion:
+    """copy rules computed by Learner.suggest()"""
+
+    def __init__(self):
+        self.observations = 0
+        self.modified = []          # paths modified in place
+        self.missed = []            # ... which are not covered by the current rules
+        self.copy_dirs = []
+        self.copy_files = []
+        self.current_bytes = 0      # bytes copied into every snapshot by the current rules
+        self.bytes = 0              # ... and by the suggested rules
+
+    def describe(self):
+        """human readable summary"""
+
+        lines = ['observed the source [{0}] time(s), [{1}] file(s) modified in place'.format(
+            self.observations, len(self.modified))]
+        lines += ['modified in place but hard-linked by the current rules: [{0}]'.format(p) for p in self.missed]
+        lines.append('suggested copy_dirs_recursive = {0}'.format(':'.join(self.copy_dirs)))
+        lines.append('suggested copy_files_recursive = {0}'.format(':'.join(self.copy_files)))
+        saved = self.current_bytes - self.bytes
+        lines.append('copied per snapshot: [{0}] bytes (currently [{1}] bytes, {2} [{3}] bytes)'.format(
+            self.bytes, self.current_bytes, 'saves' if saved >= 0 else 'adds', abs(saved)))
+        return lines
+
+
+def _components(path):
+    return path.split('/')
+
+
+class Learner:
+    """the observations of the timeline in destination"""
+
+    def __init__(self, destination):
+        self._db = sqlite3.connect(os.path.join(destination, DB_FILE), timeout=300)
+        self._db.executescript(_SCHEMA)
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+    def _meta(self, key, default=None):
+        row = self._db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def _set_meta(self, key, value):
+        self._db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, json.dumps(value)))
+
+    @property
+    def observations(self):
+        return self._meta('observations', 0)
+
+    def reset(self):
+        self._db.execute('DELETE FROM files')
+        self._db.execute('DELETE FROM meta')
+        self._db.commit()
+
+    def observe(self, source, excludes=()):
+        """record the files of source (without the excluded relative paths), returns the paths modified in place"""
+
+        start = time.time()
+        known = {row[0]: row[1:] for row in self._db.execute('SELECT path, ino, size, mtime, inplace FROM files')}
+        excluded = set(excludes)
+        seen = {}
+        modified = []
+        stack = ['']
+        while stack:
+            rel_dir = stack.pop()
+            try:
+                with os.scandir(os.path.join(source, rel_dir)) as it:
+                    entries = list(it)
+            except OSError as e:
+                logger.warning('cannot scan [%s]: %s', os.path.join(source, rel_dir), e)
+                continue
+            for entry in entries:
+                rel = os.path.join(rel_dir, entry.name)
+                if rel in excluded:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(rel)
+                    continue
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                inplace = 0
+                if rel in known:
+                    ino, size, mtime, inplace = known[rel]
+                    if ino == st.st_ino and (size, mtime) != (st.st_size, st.st_mtime_ns):
+                        inplace += 1
+                        modified.append(rel)
+                seen[rel] = (st.st_ino, st.st_size, st.st_mtime_ns, 1, inplace)
+
+        # paths which are gone are kept if they have been modified in place, their names are still relevant
+        for rel, (ino, size, mtime, inplace) in known.items():
+            if rel not in seen and inplace:
+                seen[rel] = (ino, size, mtime, 0, inplace)
+        self._db.execute('DELETE FROM files')
+        self._db.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)', ((k, *v) for k, v in seen.items()))
+        self._set_meta('observations', self.observations + 1)
+        self._db.commit()
+        logger.info('observed [%s] files of [%s] in [%.1f] seconds, [%s] modified in place',
+                    len(seen), source, time.time() - start, len(modified))
+        return modified
+
+    def suggest(self, copy_dirs, copy_files, is_immutable=None):
+        """compute the minimal copy rules from the observations, returns a Suggestion
+
+                copy_dirs/copy_files:   the current rules
+                is_immutable:           see timeline.immutable.compile_rules(), these files are never copied
+        """
+
+        result = Suggestion()
+        result.observations = self.observations
+        files = self._db.execute('SELECT path, size, present, inplace FROM files').fetchall()
+        result.modified = sorted(p for p, _, _, inplace in files if inplace)
+        for path in result.modified:
+            if is_immutable and is_immutable(path):
+                logger.warning('content-addressed file [%s] has been modified in place', path)
+        modified = [p for p in result.modified if not (is_immutable and is_immutable(p))]
+
+        def copied_by(path, dirs, names):
+            parts = _components(path)
+            return (any(fnmatch.fnmatch(d, p) for d in parts[:-1] for p in dirs)
+                    or any(fnmatch.fnmatch(parts[-1], p) for p in names))
+
+        result.missed = [p for p in modified if not copied_by(p, copy_dirs, copy_files)]
+
+        # candidate rules: the name of a modified file or of one of its directories
+        candidates = {}
+        for path in modified:
+            parts = _components(path)
+            candidates.setdefault(('file', parts[-1]), set()).add(path)
+            for d in parts[:-1]:
+                candidates.setdefault(('dir', d), set()).add(path)
+
+        # bytes copied by every candidate and by the current rules
+        cost = dict.fromkeys(candidates, 0)
+        for path, size, present, _ in files:
+            if not present or (is_immutable and is_immutable(path)):
+                continue
+            parts = _components(path)
+            if copied_by(path, copy_dirs, copy_files):
+                result.current_bytes += size
+            key = ('file', parts[-1])
+            if key in cost:
+                cost[key] += size
+            for d in set(parts[:-1]):
+                if ('dir', d) in cost:
+                    cost[('dir', d)] += size
+
+        # greedy weighted set cover: cheapest rule per newly covered path first, file rules on a tie as they do
+        # not copy files added later
+        uncovered = set(modified)
+        chosen = []
+        while uncovered:
+            rule = min((r for r in candidates if candidates[r] & uncovered),
+                       key=lambda r: (cost[r] / len(candidates[r] & uncovered), r[0] == 'dir', r[1]))
+            chosen.append(rule)
+            uncovered -= candidates[rule]
+
+        # a file rule whose files are all below a chosen directory rule is redundant
+        dirs = {name for kind, name in chosen if kind == 'dir'}
+        result.copy_dirs = sorted(dirs)
+        result.copy_files = sorted(name for kind, name in chosen if kind == 'file' and any(
+            not dirs.intersection(_components(p)[:-1]) for p in candidates[(kind, name)]))
+        result.bytes = sum(size for path, size, present, _ in files
+                           if present and not (is_immutable and is_immutable(path))
+                           and copied_by(path, result.copy_dirs, result.copy_files))
+        return result
@@ -0,0 +1,160 @@
+"""Pre-rendered directory listings
+
+With ``render_listings = True`` every directory of a new snapshot gets a
+static ``index.html`` and ``index.json`` listing, so the web server serving
+the links (``upstream/``, ``offsetNNN/``, ...) reads one file instead of
+listing and stat'ing large ``Packages/`` or ``pool/`` directories on every
+request. Snapshots never change once built, so the listings never go stale.
+
+Listings are written in a single walk of the new snapshot. Every listing
+records a signature of its directory, computed from the names and inode
+numbers of the entries (taken from the directory entries, nothing is
+stat'ed; subdirectories count by name since every snapshot has its own
+directory inodes). A directory with the signature of the same directory in
+the previous snapshot holds the same files, its listings are hard-linked
+from there. Only changed directories are stat'ed and rendered.
+
+Directories which already contain an ``index.html`` or ``index.json`` (e.g.
+from the mirrored repository) are left alone.
+"""
+
+import hashlib
+import html
+import json
+import logging
+import os
+import time
+import urllib.parse
+
+logger = logging.getLogger('Timeline.listing')
+
+HTML_NAME = 'index.html'
+JSON_NAME = 'index.json'
+NAMES = (HTML_NAME, JSON_NAME)
+
+FORMAT = 1
+
+_DIR, _FILE, _SYMLINK = 'dir', 'file', 'symlink'
+
+
+class ListingStats:
+    """counts of a write_listings() run"""
+
+    def __init__(self):
+        self.dirs = 0
+        self.rendered = 0
+        self.reused = 0
+        self.skipped = 0
+        self.seconds = 0.0
+
+
+def _kind(entry):
+    if entry.is_symlink():
+        return _SYMLINK
+    return _DIR if entry.is_dir(follow_symlinks=False) else _FILE
+
+
+def signature(entries):
+    """signature of a directory from its (sorted) os.DirEntry objects, without stat'ing them"""
+
+    h = hashlib.sha1()
+    for entry in entries:
+        kind = _kind(entry)
+        h.update('{0}\0{1}\0{2}\n'.format(entry.name, kind, '' if kind == _DIR else entry.inode()).encode(
+            'utf-8', 'surrogateescape'))
+    return h.hexdigest()
+
+
+def _describe(entry):
+    kind = _kind(entry)
+    item = {'name': entry.name, 'type': kind}
+    if kind == _FILE:
+        st = entry.stat(follow_symlinks=False)
+        item['size'] = st.st_size
+        item['mtime'] = int(st.st_mtime)
+    elif kind == _SYMLINK:
+        item['target'] = os.readlink(entry.path)
+    return item
+
+
+def _render_html(relpath, items):
+    title = html.escape('/' + relpath)
+    lines = ['<!DOCTYPE html>', '<html><head><meta charset="utf-8"><title>Index of {0}</title></head>'.format(title),
+             '<body><h1>Index of {0}</h1><table>'.format(title),
+             '<tr><th>Name</th><th>Last modified</th><th>Size</th></tr>']
+    if relpath:
+        lines.append('<tr><td><a href="../">../</a></td><td></td><td></td></tr>')
+    for item in items:
+        name = item['name'] + ('/' if item['type'] == _DIR else '')
+        mtime = time.strftime('%Y-%m-%d %H:%M', time.gmtime(item['mtime'])) if 'mtime' in item else ''
+        lines.append('<tr><td><a href="{0}">{1}</a></td><td>{2}</td><td>{3}</td></tr>'.format(
+            urllib.parse.quote(name, errors='surrogateescape'), html.escape(name), mtime, item.get('size', '')))
+    lines.append('</table></body></html>')
+    return '\n'.join(lines) + '\n'
+
+
+def _write(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8', errors='surrogateescape') as fh:
+        fh.write(data)
+    os.replace(tmp, path)
+
+
+def _reuse(previous_dir, directory, sig):
+    """hard-link the listings of previous_dir if it has the signature sig, returns True on success"""
+
+    try:
+        with open(os.path.join(previous_dir, JSON_NAME), encoding='utf-8', errors='surrogateescape') as fh:
+            document = json.load(fh)
+    except (OSError, ValueError):
+        return False
+    if not isinstance(document, dict) or document.get('format') != FORMAT or document.get('signature') != sig:
+        return False
+    try:
+        for name in NAMES:
+            os.link(os.path.join(previous_dir, name), os.path.join(directory, name))
+    except OSError as e:
+        logger.debug('cannot reuse the listings of [%s]: %s', previous_dir, e)
+        for name in NAMES:
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+        return False
+    return True
+
+
+def write_listings(root, previous_root=None):
+    """write the listings of all directories below root, reusing those of previous_root, returns ListingStats"""
+
+    start = time.time()
+    stats = ListingStats()
+    stack = ['']
+    while stack:
+        relpath = stack.pop()
+        directory = os.path.join(root, relpath)
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError as e:
+            logger.warning('cannot scan [%s]: %s', directory, e)
+            continue
+        stats.dirs += 1
+        stack.extend(os.path.join(relpath, e.name) for e in reversed(entries) if e.is_dir(follow_symlinks=False))
+
+        if any(e.name in NAMES for e in entries):
+            stats.skipped += 1
+            continue
+        sig = signature(entries)
+        if previous_root and _reuse(os.path.join(previous_root, relpath), directory, sig):
+            stats.reused += 1
+            continue
+
+        items = [_describe(e) for e in entries]
+        document = {'format': FORMAT, 'path': '/' + relpath, 'signature': sig, 'entries': items}
+        _write(os.path.join(directory, JSON_NAME), json.dumps(document, separators=(',', ':'), ensure_ascii=False))
+        _write(os.path.join(directory, HTML_NAME), _render_html(relpath, items))
+        stats.rendered += 1
+
+    stats.seconds = time.time() - start
+    return stats
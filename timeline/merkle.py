@@ -0,0 +1,171 @@
+"""Merkle directory digests
+
+The digest of a directory is computed from the sorted names, types and
+tokens of its entries: the digest of a subdirectory, the target of a
+symbolic link and, for a file, its inode number, size and mtime. Files
+which are copied into every snapshot (copy_dirs_recursive/
+copy_files_recursive) get a new inode each time, their token is the sha256
+of their content instead. Two trees with the same digest for a directory
+hold the same files below it.
+
+With ``directory_digests = True`` the digests of every new snapshot are
+stored in a compact index (``.digests/<snapshot>.merkle.gz``: the raw sha1
+digest and the relative path of every directory). ``compare()`` walks two
+digest maps from the top and only descends into directories whose digests
+differ, so comparing two snapshots (or a snapshot and the source) reads the
+changed directories only. Files with different inodes but the same size are
+compared by content, so files replaced by identical copies (content pool,
+copy rules) are not reported.
+"""
+
+import gzip
+import hashlib
+import logging
+import os
+
+from timeline import checksums
+from timeline import history
+
+logger = logging.getLogger('Timeline.merkle')
+
+_MAGIC = b'MERKLE1\n'
+
+_DIR, _FILE, _SYMLINK, _OTHER = 'd', 'f', 'l', 'o'
+
+
+def _kind(entry):
+    if entry.is_symlink():
+        return _SYMLINK
+    if entry.is_dir(follow_symlinks=False):
+        return _DIR
+    return _FILE if entry.is_file(follow_symlinks=False) else _OTHER
+
+
+def digests(root, hashed=None, skip=(), excludes=()):
+    """return {relative directory path: digest (bytes)} of root and all directories below it
+
+            hashed:     function telling whether the file at a relative path is identified by its content
+            skip:       entry names left out (e.g. generated directory listings)
+            excludes:   relative paths left out
+    """
+
+    result = {}
+
+    def visit(relpath):
+        h = hashlib.sha1()
+        try:
+            with os.scandir(os.path.join(root, relpath)) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError as e:
+            logger.warning('cannot scan [%s]: %s', os.path.join(root, relpath), e)
+            entries = []
+        for entry in entries:
+            rel = os.path.join(relpath, entry.name)
+            if entry.name in skip or rel in excludes:
+                continue
+            kind = _kind(entry)
+            if kind == _DIR:
+                token = visit(rel).hex()
+            elif kind == _SYMLINK:
+                token = os.readlink(entry.path)
+            elif kind == _FILE:
+                if hashed and hashed(rel):
+                    token = 'sha256:{0}'.format(checksums.hash_file(entry.path))
+                else:
+                    st = entry.stat(follow_symlinks=False)
+                    token = '{0}:{1}:{2}'.format(st.st_ino, st.st_size, st.st_mtime_ns)
+            else:
+                token = ''
+            h.update('{0}\0{1}\0{2}\n'.format(entry.name, kind, token).encode('utf-8', 'surrogateescape'))
+        result[relpath] = h.digest()
+        return result[relpath]
+
+    visit('')
+    return result
+
+
+def write_index(path, tree):
+    """write the digests returned by digests() to path"""
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    with gzip.open(tmp, 'wb') as fh:
+        fh.write(_MAGIC)
+        for relpath in sorted(tree):
+            fh.write(tree[relpath] + relpath.encode('utf-8', 'surrogateescape') + b'\0')
+    os.replace(tmp, path)
+
+
+def read_index(path):
+    """return the digests stored by write_index()"""
+
+    with gzip.open(path, 'rb') as fh:
+        data = fh.read()
+    if not data.startswith(_MAGIC):
+        raise Exception(f'[{path}] is not a directory digest index')
+    tree = {}
+    pos = len(_MAGIC)
+    while pos < len(data):
+        end = data.index(b'\0', pos + 20)
+        tree[data[pos + 20:end].decode('utf-8', 'surrogateescape')] = data[pos:pos + 20]
+        pos = end + 1
+    return tree
+
+
+def _entries(directory, skip):
+    try:
+        with os.scandir(directory) as it:
+            return {e.name: e for e in it if e.name not in skip}
+    except FileNotFoundError:
+        return {}
+
+
+def _same_file(a, b):
+    sa, sb = a.stat(follow_symlinks=False), b.stat(follow_symlinks=False)
+    if (sa.st_dev, sa.st_ino) == (sb.st_dev, sb.st_ino):
+        return True
+    if sa.st_size != sb.st_size:
+        return False
+    return checksums.hash_file(a.path) == checksums.hash_file(b.path)
+
+
+def compare(root_a, tree_a, root_b, tree_b, skip=(), excludes=()):
+    """yield (relative path, change) for the differences from root_a to root_b, see history.ADDED etc.
+
+            tree_a/tree_b: digests of both trees, directories with the same digest are not descended into.
+            an added or removed directory is reported once, not the entries below it.
+            skip/excludes: see digests()
+    """
+
+    stack = ['']
+    visited = 0
+    while stack:
+        relpath = stack.pop()
+        digest = tree_a.get(relpath)
+        if digest is not None and digest == tree_b.get(relpath):
+            continue
+        visited += 1
+        entries_a = _entries(os.path.join(root_a, relpath), skip)
+        entries_b = _entries(os.path.join(root_b, relpath), skip)
+        for name in sorted(set(entries_a) | set(entries_b)):
+            rel = os.path.join(relpath, name)
+            if rel in excludes:
+                continue
+            a, b = entries_a.get(name), entries_b.get(name)
+            if b is None:
+                yield rel, history.REMOVED
+                continue
+            if a is None:
+                yield rel, history.ADDED
+                continue
+            kind = _kind(a)
+            if kind != _kind(b):
+                yield rel, history.MODIFIED
+            elif kind == _DIR:
+                stack.append(rel)
+            elif kind == _SYMLINK:
+                if os.readlink(a.path) != os.readlink(b.path):
+                    yield rel, history.MODIFIED
+            elif kind == _FILE and not _same_file(a, b):
+                yield rel, history.MODIFIED
+    logger.debug('compared [%s] directories of [%s] and [%s]', visited, root_a, root_b)
@@ -0,0 +1,215 @@
+"""Package index across snapshots
+
+Answers "which snapshot first shipped package X version Y": for every
+package (name, version, architecture) the index keeps the intervals of
+snapshot generations in which the package was listed by the repository
+metadata (``repodata/*-primary.xml.gz``, ``dists/*/*/binary-*/Packages.gz``).
+
+The index is updated when a snapshot is created. Metadata files are parsed
+with streaming parsers, and only if their checksum (taken from repomd.xml or
+the Release file, computed otherwise) changed since the previous snapshot;
+unchanged package sets just extend the open intervals. The index lives in a
+SQLite database in the timeline destination and survives snapshot rotation.
+"""
+
+import gzip
+import logging
+import os
+import sqlite3
+import time
+import xml.etree.ElementTree as ElementTree
+
+from timeline import checksums
+from timeline import repository
+
+logger = logging.getLogger('Timeline.packages')
+
+_COMMON_NS = '{http://linux.duke.edu/metadata/common}'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS packages (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    version TEXT NOT NULL,
+    arch TEXT NOT NULL,
+    UNIQUE (name, version, arch)
+);
+CREATE TABLE IF NOT EXISTS package_intervals (
+    package INTEGER NOT NULL,
+    first INTEGER NOT NULL,
+    last INTEGER NOT NULL,
+    PRIMARY KEY (package, first)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS package_intervals_last ON package_intervals (last);
+CREATE TABLE IF NOT EXISTS package_files (
+    path TEXT PRIMARY KEY,
+    digest TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS package_file_contents (
+    path TEXT NOT NULL,
+    package INTEGER NOT NULL,
+    PRIMARY KEY (path, package)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS generations (
+    seq INTEGER PRIMARY KEY,
+    snapshot TEXT NOT NULL
+);
+'''
+
+
+def parse_primary(path):
+    """yield (name, version, arch) for every package in a primary.xml(.gz), streaming"""
+
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as fh:
+        for _, elem in ElementTree.iterparse(fh, events=('end',)):
+            if elem.tag != _COMMON_NS + 'package':
+                continue
+            version = elem.find(_COMMON_NS + 'version')
+            if version is not None:
+                evr = '{0}-{1}'.format(version.get('ver'), version.get('rel'))
+                if version.get('epoch') not in (None, '', '0'):
+                    evr = '{0}:{1}'.format(version.get('epoch'), evr)
+                yield elem.findtext(_COMMON_NS + 'name'), evr, elem.findtext(_COMMON_NS + 'arch')
+            elem.clear()
+
+
+def parse_packages(path):
+    """yield (name, version, arch) for every stanza of a Debian Packages(.gz) file, streaming"""
+
+    opener = gzip.open if path.endswith('.gz') else open
+    fields = {}
+    with opener(path, 'rt', encoding='utf-8', errors='replace') as fh:
+        for line in fh:
+            if not line.strip():
+                if 'Package' in fields:
+                    yield fields['Package'], fields.get('Version', ''), fields.get('Architecture', '')
+                fields = {}
+            elif not line[0].isspace() and ':' in line:
+                key, value = line.split(':', 1)
+                if key in ('Package', 'Version', 'Architecture'):
+                    fields[key] = value.strip()
+    if 'Package' in fields:
+        yield fields['Package'], fields.get('Version', ''), fields.get('Architecture', '')
+
+
+def find_package_lists(root):
+    """return {relative path: digest or None} of the package lists below root
+
+            digests are taken from repomd.xml/Release, None if the metadata does not list the file
+    """
+
+    found = {}
+    for metadata in repository.find_metadata(root):
+        try:
+            if metadata.endswith('repomd.xml'):
+                checks = [c for c in repository.parse_repomd(metadata)
+                          if os.path.basename(c.path).endswith(('primary.xml.gz', 'primary.xml'))]
+            else:
+                checks = [c for c in repository.parse_release(metadata)
+                          if os.path.basename(c.path) == 'Packages.gz']
+        except (OSError, ElementTree.ParseError, ValueError) as e:
+            logger.warning('cannot parse [%s]: %s', metadata, e)
+            continue
+        for check in checks:
+            if os.path.exists(check.path):
+                found[os.path.relpath(check.path, root)] = f'{check.algorithm}:{check.digest}'
+    return found
+
+
+class PackageIndex:
+    """the package index of a timeline, stored in a sqlite database"""
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, timeout=30)
+        self._db.executescript(_SCHEMA)
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+    def _load_file(self, relpath, path):
+        """(re)parse a package list, replace its contents"""
+
+        parse = parse_primary if 'primary.xml' in os.path.basename(path) else parse_packages
+        db = self._db
+        db.execute('CREATE TEMP TABLE IF NOT EXISTS staging (name TEXT, version TEXT, arch TEXT)')
+        db.execute('DELETE FROM staging')
+        db.executemany('INSERT INTO staging VALUES (?, ?, ?)', parse(path))
+        db.execute('INSERT OR IGNORE INTO packages (name, version, arch) SELECT name, version, arch FROM staging')
+        db.execute('DELETE FROM package_file_contents WHERE path = ?', (relpath,))
+        db.execute('INSERT OR IGNORE INTO package_file_contents '
+                   'SELECT ?, p.id FROM staging s JOIN packages p USING (name, version, arch)', (relpath,))
+        return db.execute('SELECT COUNT(*) FROM staging').fetchone()[0]
+
+    def indexed(self):
+        """return the set of generations in the index"""
+
+        return {seq for seq, in self._db.execute('SELECT seq FROM generations')}
+
+    def update(self, root, seq, snapshot):
+        """add the snapshot with generation seq (files below root) to the index
+
+                intervals ending at the previously indexed generation are extended for packages
+                which are still listed, generations must be added in ascending order (ValueError
+                for a generation older than the newest one in the index)
+
+                returns (package lists, parsed package lists, packages)
+        """
+
+        start = time.time()
+        db = self._db
+        newest = db.execute('SELECT MAX(seq) FROM generations').fetchone()[0]
+        if newest is not None and seq < newest:
+            raise ValueError(f'generation [{seq}] of snapshot [{snapshot}] is older than the newest '
+                             f'generation [{newest}] in the package index')
+        lists = find_package_lists(root)
+
+        with db:
+            stored = dict(db.execute('SELECT path, digest FROM package_files'))
+            parsed = 0
+            for relpath, digest in sorted(lists.items()):
+                path = os.path.join(root, relpath)
+                if digest is None:
+                    digest = 'sha256:' + (checksums.hash_file(path) or '')
+                if stored.get(relpath) == digest:
+                    continue
+                count = self._load_file(relpath, path)
+                db.execute('INSERT OR REPLACE INTO package_files VALUES (?, ?)', (relpath, digest))
+                parsed += 1
+                logger.debug('indexed [%s] packages from [%s]', count, relpath)
+
+            for relpath in set(stored) - set(lists):
+                db.execute('DELETE FROM package_files WHERE path = ?', (relpath,))
+                db.execute('DELETE FROM package_file_contents WHERE path = ?', (relpath,))
+
+            previous_seq = db.execute('SELECT MAX(seq) FROM generations WHERE seq < ?', (seq,)).fetchone()[0]
+            db.execute('INSERT OR REPLACE INTO generations VALUES (?, ?)', (seq, snapshot))
+            db.execute('CREATE TEMP TABLE IF NOT EXISTS current (package INTEGER PRIMARY KEY)')
+            db.execute('DELETE FROM current')
+            db.execute('INSERT INTO current SELECT DISTINCT package FROM package_file_contents')
+            if previous_seq is not None:
+                db.execute('UPDATE package_intervals SET last = ? '
+                           'WHERE last = ? AND package IN (SELECT package FROM current)', (seq, previous_seq))
+            db.execute('INSERT OR IGNORE INTO package_intervals '
+                       'SELECT package, ?, ? FROM current WHERE package NOT IN '
+                       '(SELECT package FROM package_intervals WHERE last = ?)', (seq, seq, seq))
+            packages = db.execute('SELECT COUNT(*) FROM current').fetchone()[0]
+
+        logger.info('package index: [%s] packages in [%s] package lists ([%s] parsed) in [%.1f] seconds',
+                    packages, len(lists), parsed, time.time() - start)
+        return len(lists), parsed, packages
+
+    def lookup(self, name, version=None):
+        """return (name, version, arch, first snapshot, last snapshot) for the matching packages"""
+
+        sql = ('SELECT p.name, p.version, p.arch, gf.snapshot, gl.snapshot FROM packages p '
+               'JOIN package_intervals i ON i.package = p.id '
+               'JOIN generations gf ON gf.seq = i.first JOIN generations gl ON gl.seq = i.last '
+               'WHERE p.name = ?')
+        params = [name]
+        if version:
+            sql += ' AND p.version = ?'
+            params.append(version)
+        sql += ' ORDER BY p.version, p.arch, i.first'
+        return self._db.execute(sql, params).fetchall()
@@ -0,0 +1,304 @@
+"""Post-snapshot pipeline
+
+Work which is not needed to publish a snapshot (directory digests, content
+pool, diff report and path history, checksum recording, package index,
+metrics) runs after the snapshot has been committed and the links have been
+rotated, so link publication only waits for the build itself, its directory
+listings and its validation. ``create_snapshot`` queues one job per stage::
+
+    digests     directory digests (directory_digests = True)
+    pool        deduplication against the content pool (pool_path), after the
+                digests so they match the inodes of the source
+    diff        diff report against the previous snapshot, added to the path history
+    checksums   content checksums (record_checksums = True)
+    index       package index (package_index = True)
+    metrics     changes of the snapshot, counted from the diff report
+    learn       observation of the source for learning the copy rules (learn_copy_rules)
+
+The queue is a JSON file in the timeline destination (``.pipeline.json``),
+changed under an exclusive lock, so it survives crashes and is shared by all
+processes. A runner (``mrepo pipeline run``, started in the background by
+``create_snapshot``) works through it with a pool of threads: jobs of the
+ordered stages run in the order of the snapshots, metrics wait for the diff
+and the pool for the digests of their snapshot. Failed jobs are retried with a growing delay, jobs of a
+runner which died are picked up again. ``mrepo pipeline status`` shows the
+queue.
+
+By default (``pipeline = inline``) ``create_snapshot`` runs the jobs itself
+once the links are published, ``pipeline = background`` starts the runner.
+"""
+
+import concurrent.futures
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+logger = logging.getLogger('Timeline.pipeline')
+
+QUEUE_FILE = '.pipeline.json'
+LOCK_FILE = '.pipeline.lock'
+RUNNER_LOCK_FILE = '.pipeline.run'
+LOG_FILE = '.pipeline.log'
+
+PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+
+# stage name -> (jobs of the same stage run in snapshot order, stages of the same snapshot to wait for)
+STAGES = {
+    'digests': (False, ()),
+    'pool': (True, ('digests',)),
+    'diff': (False, ()),
+    'checksums': (True, ()),
+    'index': (True, ()),
+    'metrics': (False, ('diff',)),
+    'learn': (True, ()),
+}
+
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 60
+
+# finished jobs kept in the queue for 'mrepo pipeline status'
+_KEEP_FINISHED = 100
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Queue:
+    """the persistent job queue of a timeline"""
+
+    def __init__(self, destination):
+        self.destination = destination
+        self.path = os.path.join(destination, QUEUE_FILE)
+        self._lock_path = os.path.join(destination, LOCK_FILE)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """yield the list of jobs, changes are written back atomically"""
+
+        with open(self._lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            jobs = self._read()
+            before = json.dumps(jobs, sort_keys=True)
+            yield jobs
+            if json.dumps(jobs, sort_keys=True) != before:
+                tmp = f'{self.path}.tmp{os.getpid()}'
+                with open(tmp, 'w') as fh:
+                    json.dump(jobs, fh, indent=1)
+                os.replace(tmp, self.path)
+
+    def _read(self):
+        try:
+            with open(self.path) as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return []
+
+    def jobs(self):
+        """return all jobs, oldest first"""
+
+        return self._read()
+
+    def enqueue(self, snapshot, seq, stages, **args):
+        """queue the stages for snapshot (generation seq), args are passed to every stage"""
+
+        now = time.time()
+        with self._locked() as jobs:
+            next_id = max((job['id'] for job in jobs), default=0) + 1
+            for n, stage in enumerate(stages):
+                jobs.append({'id': next_id + n, 'snapshot': snapshot, 'seq': seq, 'stage': stage, 'args': args,
+                             'state': PENDING, 'attempts': 0, 'error': None, 'queued': now, 'not_before': now,
+                             'started': None, 'finished': None, 'pid': None})
+        logger.info('queued stages [%s] of snapshot [%s]', ', '.join(stages), snapshot)
+
+    def claim(self, limit):
+        """mark up to limit jobs which are ready to run as running, returns them"""
+
+        now = time.time()
+        claimed = []
+        with self._locked() as jobs:
+            self._recover(jobs)
+            for job in jobs:
+                if len(claimed) >= limit:
+                    break
+                if job['state'] == PENDING and job['not_before'] <= now and self._ready(job, jobs):
+                    job.update(state=RUNNING, started=now, pid=os.getpid(), attempts=job['attempts'] + 1)
+                    claimed.append(dict(job))
+        return claimed
+
+    @staticmethod
+    def _ready(job, jobs):
+        ordered, after = STAGES.get(job['stage'], (False, ()))
+        for other in jobs:
+            if other['state'] in (DONE, FAILED) or other is job:
+                continue
+            if ordered and other['stage'] == job['stage'] and other['seq'] < job['seq']:
+                return False
+            if other['stage'] in after and other['snapshot'] == job['snapshot']:
+                return False
+        return True
+
+    @staticmethod
+    def _recover(jobs):
+        """requeue the running jobs of processes which are gone"""
+
+        for job in jobs:
+            if job['state'] == RUNNING and job['pid'] != os.getpid() and not _alive(job['pid']):
+                logger.warning('runner of job [%s] (%s of snapshot [%s]) is gone, requeued',
+                               job['id'], job['stage'], job['snapshot'])
+                job.update(state=PENDING, pid=None)
+
+    def finish(self, job_id, error=None):
+        """record the result of a running job, failed jobs are retried up to MAX_ATTEMPTS times"""
+
+        now = time.time()
+        with self._locked() as jobs:
+            for job in jobs:
+                if job['id'] != job_id:
+                    continue
+                job.update(finished=now, error=error, pid=None)
+                if error is None:
+                    job['state'] = DONE
+                elif job['attempts'] < MAX_ATTEMPTS:
+                    job.update(state=PENDING, not_before=now + RETRY_DELAY * 2 ** (job['attempts'] - 1))
+                else:
+                    job['state'] = FAILED
+            finished = [job for job in jobs if job['state'] == DONE]
+            for job in finished[:max(0, len(finished) - _KEEP_FINISHED)]:
+                jobs.remove(job)
+
+    def retry(self):
+        """requeue all failed jobs, returns their number"""
+
+        now = time.time()
+        with self._locked() as jobs:
+            failed = [job for job in jobs if job['state'] == FAILED]
+            for job in failed:
+                job.update(state=PENDING, attempts=0, not_before=now)
+        return len(failed)
+
+    def next_attempt(self):
+        """seconds until the next pending job may run (0 if one is ready), None if nothing is pending
+
+                jobs waiting for jobs run by another process are checked again after a second
+        """
+
+        now = time.time()
+        jobs = self._read()
+        pending = [job for job in jobs if job['state'] == PENDING]
+        if not pending:
+            return None
+        if any(job['not_before'] <= now and self._ready(job, jobs) for job in pending):
+            return 0.0
+        return max(1.0, min(job['not_before'] for job in pending) - now)
+
+
+class Runner:
+    """works through the queue of a timeline
+
+            load:       function returning a Timeline instance to run a job with
+            commit:     function (snapshot, {field: value}) storing the results of a job in the timeline state
+    """
+
+    def __init__(self, destination, load, commit, jobs=2):
+        self.queue = Queue(destination)
+        self._load = load
+        self._commit = commit
+        self._jobs = max(1, jobs)
+
+    def run(self, wait=True):
+        """run jobs until the queue is empty, with wait=False pending retries are left for later runs
+
+                returns (jobs done, jobs failed)
+        """
+
+        done = failed = 0
+        running = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._jobs) as pool:
+            while True:
+                for job in self.queue.claim(self._jobs - len(running)):
+                    running[pool.submit(self._run_job, job)] = job
+                if running:
+                    finished, _ = concurrent.futures.wait(running, timeout=RETRY_DELAY,
+                                                          return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in finished:
+                        running.pop(future)
+                        if future.result():
+                            done += 1
+                        else:
+                            failed += 1
+                    continue
+                delay = self.queue.next_attempt()
+                if delay is None or (delay and not wait):
+                    break
+                time.sleep(min(delay, RETRY_DELAY) or 0.1)
+        return done, failed
+
+    def _run_job(self, job):
+        start = time.time()
+        logger.info('running %s of snapshot [%s] (attempt %s)', job['stage'], job['snapshot'], job['attempts'])
+        try:
+            t = self._load()
+            if job['snapshot'] not in t._snapshots:
+                logger.info('snapshot [%s] has been deleted, skipping %s', job['snapshot'], job['stage'])
+            else:
+                updates = t.run_pipeline_stage(job['stage'], job['snapshot'], **job['args'])
+                if updates:
+                    self._commit(job['snapshot'], updates)
+        except Exception as e:
+            logger.error('%s of snapshot [%s] failed: %s', job['stage'], job['snapshot'], e)
+            self.queue.finish(job['id'], error=str(e) or type(e).__name__)
+            return False
+        self.queue.finish(job['id'])
+        logger.info('finished %s of snapshot [%s] in [%.1f] seconds', job['stage'], job['snapshot'], time.time() - start)
+        return True
+
+
+@contextlib.contextmanager
+def runner_lock(destination):
+    """hold the runner lock of a timeline, yields False if another runner holds it"""
+
+    with open(os.path.join(destination, RUNNER_LOCK_FILE), 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def spawn(destination, jobs=2):
+    """start 'mrepo pipeline run' for the timeline in a detached background process, output goes to LOG_FILE"""
+
+    with open(os.path.join(destination, LOG_FILE), 'a') as log:
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'timeline', '--no-daemon', 'pipeline', 'run', destination, f'--jobs={jobs}'],
+            stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT, start_new_session=True, close_fds=True)
+    logger.info('started pipeline runner [%s] for [%s]', process.pid, destination)
+    return process.pid
+
+
+def status(destination):
+    """return (jobs, runner active) of the timeline in destination"""
+
+    with open(os.path.join(destination, RUNNER_LOCK_FILE), 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            active = False
+        except BlockingIOError:
+            active = True
+    return Queue(destination).jobs(), active
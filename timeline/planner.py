@@ -0,0 +1,196 @@
+"""Dry-run planning of snapshot and rotation runs
+
+``mrepo create-snapshot --dry-run`` and ``mrepo config --dry-run`` with
+``--max-snapshots``/``--excludes`` report what a run would do and cost
+instead of doing it:
+
+- a single scandir walk of the source counts the entries which would be
+  hard-linked and the files/bytes which would be copied by the copy rules,
+  under the current and the planned excludes at the same time; only copied
+  files and directories are stat'ed
+- the rotation is simulated on a copy of the timeline state: snapshots to
+  delete and links to move
+- the space freed by deleting snapshots is computed by scanning them (an
+  inode is freed once all of its hard links are in deleted snapshots)
+- the duration of the next snapshot is estimated from the recorded durations
+  of the previous ones, scaled by the number of entries to link
+"""
+
+import fnmatch
+import logging
+import os
+import statistics
+import time
+
+from timeline import immutable
+from timeline import usage
+
+logger = logging.getLogger('Timeline.planner')
+
+# number of recorded durations used for the estimate
+_DURATION_HISTORY = 5
+
+
+class SourceScan:
+    """counts of a source scan, for the current (index 0) and the planned (index 1) excludes"""
+
+    def __init__(self):
+        self.entries = [0, 0]         # objects hard-linked into the snapshot
+        self.dirs = [0, 0]            # directories created in the snapshot
+        self.dir_bytes = [0, 0]       # space allocated by these directories
+        self.copy_files = [0, 0]      # files copied by copy_dirs_recursive/copy_files_recursive
+        self.copy_bytes = [0, 0]
+        self.seconds = 0.0
+
+
+def scan_source(source, excludes, planned_excludes, copy_dirs, copy_files, immutable_files=()):
+    """walk the source once, see SourceScan
+
+            excludes/planned_excludes: relative paths (normalized) which are not part of the snapshot
+            immutable_files: patterns of the files which stay hard-linked, see timeline.immutable
+    """
+
+    start = time.time()
+    is_immutable = immutable.compile_rules(immutable_files)
+    result = SourceScan()
+    excluded = (set(excludes), set(planned_excludes))
+
+    # (directory, relative path, excluded now, excluded as planned, below a copied directory)
+    stack = [(source, '', False, False, False)]
+    while stack:
+        directory, rel_dir, ex0, ex1, copied = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = list(it)
+        except OSError as e:
+            logger.warning('cannot scan [%s]: %s', directory, e)
+            continue
+
+        for entry in entries:
+            rel = os.path.join(rel_dir, entry.name)
+            e0 = ex0 or rel in excluded[0]
+            e1 = ex1 or rel in excluded[1]
+            if e0 and e1:
+                continue
+            sides = [i for i, e in enumerate((e0, e1)) if not e]
+
+            is_dir = entry.is_dir(follow_symlinks=False)
+            copy = copied or (is_dir and any(fnmatch.fnmatch(entry.name, p) for p in copy_dirs))
+            if not is_dir and not copy and not entry.is_symlink():
+                copy = any(fnmatch.fnmatch(entry.name, p) for p in copy_files)
+            linked = copy and not is_dir and is_immutable is not None and is_immutable(rel)
+
+            st = None
+            if is_dir or (copy and not linked and not entry.is_symlink()):
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError as e:
+                    logger.warning('cannot stat [%s]: %s', entry.path, e)
+
+            for i in sides:
+                result.entries[i] += 1
+                if is_dir:
+                    result.dirs[i] += 1
+                    result.dir_bytes[i] += usage._allocated(st) if st else 0
+                elif copy and not linked and st:
+                    result.copy_files[i] += 1
+                    result.copy_bytes[i] += usage._allocated(st)
+
+            if is_dir:
+                stack.append((entry.path, rel, e0, e1, copy))
+
+    result.seconds = time.time() - start
+    return result
+
+
+def freed_space(paths):
+    """(bytes, inodes) freed by deleting all of the given directories
+
+            an inode is freed when all of its hard links (st_nlink) are below these directories
+    """
+
+    pending = {}
+    freed_bytes = freed_inodes = 0
+    for path in paths:
+        for st, is_dir in usage._scan(path):
+            if is_dir or st.st_nlink == 1:
+                freed_bytes += usage._allocated(st)
+                freed_inodes += 1
+                continue
+            key = (st.st_dev, st.st_ino)
+            seen = pending.get(key, 0) + 1
+            if seen == st.st_nlink:
+                del pending[key]
+                freed_bytes += usage._allocated(st)
+                freed_inodes += 1
+            else:
+                pending[key] = seen
+    return freed_bytes, freed_inodes
+
+
+def recorded_duration(durations):
+    """median of the last recorded snapshot durations, None if none were recorded"""
+
+    durations = [d for d in durations if d is not None][-_DURATION_HISTORY:]
+    return statistics.median(durations) if durations else None
+
+
+def _size(value):
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if abs(value) < 1024 or unit == 'TiB':
+            return '{0:.1f} {1}'.format(value, unit) if unit != 'B' else '{0} B'.format(value)
+        value /= 1024.0
+
+
+class RunPlan:
+    """planned operations and costs computed by Timeline.plan()"""
+
+    def __init__(self):
+        self.create_snapshot = False
+        self.scan = None                # SourceScan, None if the source was not scanned
+        self.changes_excludes = False   # scan index 1 holds the planned excludes
+        self.max_snapshots = None
+
+        # rotation
+        self.delete_snapshots = []
+        self.thinned_snapshots = []     # deleted by the retention policy, a subset of delete_snapshots
+        self.move_links = {}            # link -> (current snapshot, new snapshot)
+        self.drop_links = []
+        self.freed_bytes = 0
+        self.freed_inodes = 0
+
+        # estimates
+        self.recorded_duration = None   # median duration of the previous snapshots
+        self.duration = None
+        self.space = None
+
+    def describe(self):
+        """human readable list of the planned operations and their costs"""
+
+        lines = []
+        scan = self.scan
+        if scan:
+            lines.append('source scanned in [{0:.1f}] seconds'.format(scan.seconds))
+            i = 1 if self.changes_excludes else 0
+            if self.changes_excludes:
+                lines.append('entries to link: [{0}] (currently [{1}], {2:+d})'.format(
+                    scan.entries[1], scan.entries[0], scan.entries[1] - scan.entries[0]))
+            else:
+                lines.append('entries to link: [{0}], directories to create: [{1}]'.format(scan.entries[0], scan.dirs[0]))
+            lines.append('files to copy: [{0}] ({1})'.format(scan.copy_files[i], _size(scan.copy_bytes[i])))
+        if self.create_snapshot:
+            lines.append('create snapshot (new snapshot needs about {0})'.format(_size(self.space or 0)))
+        if self.max_snapshots is not None:
+            lines.append('max_snapshots: [{0}]'.format(self.max_snapshots))
+        lines += ['delete snapshot [{0}]'.format(s) for s in self.delete_snapshots]
+        lines += ['move link [{0}] from snapshot [{1}] to [{2}]'.format(l, f, t) for l, (f, t) in sorted(self.move_links.items())]
+        lines += ['drop link [{0}]'.format(l) for l in self.drop_links]
+        if self.delete_snapshots:
+            lines.append('deleting snapshots frees {0} in [{1}] inodes'.format(_size(self.freed_bytes), self.freed_inodes))
+        if self.scan:
+            if self.duration is not None:
+                lines.append('estimated duration of the next snapshot: [{0:.1f}] seconds (recorded: [{1:.1f}] seconds)'.format(
+                    self.duration, self.recorded_duration))
+            else:
+                lines.append('estimated duration of the next snapshot: unknown, no durations recorded yet')
+        return lines
@@ -0,0 +1,232 @@
+"""Content pool shared by the timelines of a device
+
+Timelines of related distributions (EL8/EL9, Debian/Ubuntu) take their
+snapshots from different sources, so identical package files end up as
+separate inodes. With ``pool_path`` set, the package files of every new
+snapshot (``pool_patterns``) are deduplicated against a pool directory on the
+same device which is shared by all timelines:
+
+- a file whose inode is already in the pool is left alone
+- files are compared by size first, only files with the size of a pooled
+  file are hashed (sha256, cached by dev, inode, size and mtime)
+- a file with the content of a pooled file is replaced by a hard link to the
+  pooled inode, other files are added to the pool (hard-linked, not copied)
+
+Every pooled inode has one link in the pool, an entry whose inode has no
+other links (st_nlink == 1) is garbage: it is removed when the snapshots
+holding the inode are deleted, or by a full collection (``mrepo pool --gc``).
+A pooled file whose size or mtime changed (rewritten in place through the
+source) is dropped from the pool instead of being linked to.
+"""
+
+import fnmatch
+import logging
+import os
+import sqlite3
+import time
+
+from timeline import checksums
+
+logger = logging.getLogger('Timeline.pool')
+
+DEFAULT_PATTERNS = ['*.rpm', '*.drpm', '*.deb', '*.udeb']
+
+_DB_FILE = '.pool.sqlite'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS pool (
+    id INTEGER PRIMARY KEY,
+    size INTEGER NOT NULL,
+    digest TEXT,
+    ino INTEGER NOT NULL,
+    mtime INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pool_size ON pool (size, digest);
+CREATE INDEX IF NOT EXISTS pool_ino ON pool (ino);
+CREATE TABLE IF NOT EXISTS hashes (
+    dev INTEGER, ino INTEGER, size INTEGER, mtime INTEGER,
+    digest TEXT NOT NULL, used TEXT NOT NULL,
+    PRIMARY KEY (dev, ino, size, mtime)
+) WITHOUT ROWID;
+'''
+
+# seconds between two commits, so concurrent builds of other timelines are not blocked for long
+_COMMIT_INTERVAL = 1.0
+
+# hash cache entries not used for this many days are pruned by a full collection
+_CACHE_DAYS = 30
+
+
+class PoolStats:
+    """counts of a ContentPool.add() run"""
+
+    def __init__(self):
+        self.files = 0          # files matching the patterns
+        self.pooled = 0         # already linked to the pool
+        self.linked = 0         # replaced by a link to a pooled inode
+        self.added = 0          # added to the pool
+        self.hashed = 0
+        self.hashed_bytes = 0
+        self.linked_bytes = 0   # space of the replaced files, freed once the source drops them
+        self.seconds = 0.0
+
+
+class ContentPool:
+    """the content pool in path, which must be on the device of the timelines using it"""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.dev = os.stat(path).st_dev
+        db_path = os.path.join(path, _DB_FILE)
+        self._db = sqlite3.connect(db_path, timeout=300)
+        self._db.executescript(_SCHEMA)
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+    def _file(self, entry_id):
+        return os.path.join(self.path, '{0:02x}'.format(entry_id % 256), str(entry_id))
+
+    def _digest(self, path, st, stats):
+        key = checksums.file_key(st)
+        row = self._db.execute('SELECT digest FROM hashes WHERE dev=? AND ino=? AND size=? AND mtime=?', key).fetchone()
+        if row:
+            digest = row[0]
+        else:
+            digest = checksums.hash_file(path)
+            if digest is None:
+                return None
+            stats.hashed += 1
+            stats.hashed_bytes += st.st_size
+        self._db.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)', (*key, digest, time.strftime('%Y.%m.%d')))
+        return digest
+
+    def _current(self, entry_id, ino, mtime):
+        """stat result of a pooled file, None (and the entry is dropped) if it is gone or was modified"""
+
+        try:
+            st = os.lstat(self._file(entry_id))
+        except FileNotFoundError:
+            st = None
+        if st is not None and st.st_ino == ino and st.st_mtime_ns == mtime:
+            return st
+        logger.warning('pooled file [%s] is gone or was modified in place, dropped from the pool', self._file(entry_id))
+        self._drop(entry_id)
+        return None
+
+    def _drop(self, entry_id):
+        try:
+            os.remove(self._file(entry_id))
+        except FileNotFoundError:
+            pass
+        self._db.execute('DELETE FROM pool WHERE id = ?', (entry_id,))
+
+    def _insert(self, path, st, digest):
+        cur = self._db.execute('INSERT INTO pool (size, digest, ino, mtime) VALUES (?, ?, ?, ?)',
+                               (st.st_size, digest, st.st_ino, st.st_mtime_ns))
+        target = self._file(cur.lastrowid)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.link(path, target)
+
+    def add(self, root, patterns):
+        """deduplicate the files below root whose names match patterns against the pool, returns PoolStats"""
+
+        start = committed = time.time()
+        stats = PoolStats()
+        for relpath, st in checksums.walk_files(root):
+            if not any(fnmatch.fnmatch(os.path.basename(relpath), p) for p in patterns):
+                continue
+            if st.st_dev != self.dev:
+                raise Exception(f'pool [{self.path}] is not on the device of [{root}]')
+            stats.files += 1
+            self._add_file(os.path.join(root, relpath), st, stats)
+            if time.time() - committed > _COMMIT_INTERVAL:
+                self._db.commit()
+                committed = time.time()
+        self._db.commit()
+        stats.seconds = time.time() - start
+        return stats
+
+    def _add_file(self, path, st, stats):
+        db = self._db
+        if db.execute('SELECT 1 FROM pool WHERE ino = ? AND size = ?', (st.st_ino, st.st_size)).fetchone():
+            stats.pooled += 1
+            return
+
+        # no file of this size in the pool: no need to hash it (yet)
+        if not db.execute('SELECT 1 FROM pool WHERE size = ?', (st.st_size,)).fetchone():
+            self._insert(path, st, None)
+            stats.added += 1
+            return
+
+        digest = self._digest(path, st, stats)
+        if digest is None:
+            return
+        # pooled files of this size which were added unhashed
+        for entry_id, ino, mtime in db.execute('SELECT id, ino, mtime FROM pool WHERE size = ? AND digest IS NULL',
+                                               (st.st_size,)).fetchall():
+            pooled = self._current(entry_id, ino, mtime)
+            if pooled is not None:
+                db.execute('UPDATE pool SET digest = ? WHERE id = ?', (self._digest(self._file(entry_id), pooled, stats), entry_id))
+
+        for entry_id, ino, mtime in db.execute('SELECT id, ino, mtime FROM pool WHERE size = ? AND digest = ?',
+                                               (st.st_size, digest)).fetchall():
+            pooled = self._current(entry_id, ino, mtime)
+            if pooled is None or (pooled.st_mode, pooled.st_uid, pooled.st_gid) != (st.st_mode, st.st_uid, st.st_gid):
+                continue
+            tmp = f'{path}.pool{os.getpid()}'
+            os.link(self._file(entry_id), tmp)
+            os.replace(tmp, path)
+            stats.linked += 1
+            stats.linked_bytes += st.st_blocks * 512
+            return
+
+        self._insert(path, st, digest)
+        stats.added += 1
+
+    def collect(self, inodes=None):
+        """remove the pooled files which are not linked from anywhere else, returns (files, bytes) removed
+
+                inodes: only check the entries of these inodes (e.g. of a deleted snapshot), all if None
+        """
+
+        if inodes is None:
+            rows = self._db.execute('SELECT id, ino FROM pool').fetchall()
+        else:
+            self._db.execute('CREATE TEMP TABLE IF NOT EXISTS deleted (ino INTEGER PRIMARY KEY)')
+            self._db.execute('DELETE FROM deleted')
+            self._db.executemany('INSERT OR IGNORE INTO deleted VALUES (?)', ((i,) for i in inodes))
+            rows = self._db.execute('SELECT id, ino FROM pool WHERE ino IN (SELECT ino FROM deleted)').fetchall()
+
+        removed = removed_bytes = 0
+        for entry_id, ino in rows:
+            try:
+                st = os.lstat(self._file(entry_id))
+            except FileNotFoundError:
+                self._db.execute('DELETE FROM pool WHERE id = ?', (entry_id,))
+                continue
+            if st.st_nlink == 1 or st.st_ino != ino:
+                self._drop(entry_id)
+                removed += 1
+                removed_bytes += st.st_blocks * 512
+        if inodes is None:
+            cutoff = time.strftime('%Y.%m.%d', time.localtime(time.time() - _CACHE_DAYS * 86400))
+            self._db.execute('DELETE FROM hashes WHERE used < ?', (cutoff,))
+        self._db.commit()
+        return removed, removed_bytes
+
+    def summary(self):
+        """return (entries, bytes, entries shared by more than one other link)"""
+
+        entries = size = shared = 0
+        for entry_id, in self._db.execute('SELECT id FROM pool'):
+            try:
+                st = os.lstat(self._file(entry_id))
+            except FileNotFoundError:
+                continue
+            entries += 1
+            size += st.st_blocks * 512
+            shared += st.st_nlink > 2
+        return entries, size, shared
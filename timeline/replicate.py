@@ -0,0 +1,264 @@
+"""Delta replication of timelines
+
+``mrepo export --since BASE`` writes the snapshots newer than BASE as a
+streaming tar archive, ``mrepo import`` rebuilds them in the timeline of a
+secondary server which already has BASE, without walking hundreds of
+millions of hard links like ``rsync -H`` does.
+
+Every snapshot is described relative to its predecessor (BASE for the first
+one): a snapshot starts as a hard-linked copy of the predecessor, then the
+removed paths are deleted and the new directories, symbolic links and files
+are created. Files are identified by their inode, so the contents of a file
+are sent once, however many paths and snapshots link to it; files which were
+only renamed are linked from the predecessor. The archive::
+
+    manifest.json                   format, base, snapshots (metadata) and links
+    <snapshot>/changes.json         removed paths, new directories, symlinks and files
+    <snapshot>/data/<id>            contents of the new files (mode, owner, mtime)
+    ...                             repeated for every snapshot, oldest first
+"""
+
+import io
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tarfile
+import time
+
+logger = logging.getLogger('Timeline.replicate')
+
+FORMAT = 1
+
+_DIR, _FILE, _SYMLINK = 'd', 'f', 'l'
+
+
+def scan(root):
+    """return {relative path: (type, (st_dev, st_ino), mode)} of everything below root"""
+
+    entries = {}
+    if root is None:
+        return entries
+    stack = ['']
+    while stack:
+        rel = stack.pop()
+        with os.scandir(os.path.join(root, rel)) as it:
+            for entry in it:
+                path = os.path.join(rel, entry.name)
+                st = entry.stat(follow_symlinks=False)
+                if entry.is_symlink():
+                    kind = _SYMLINK
+                elif entry.is_dir(follow_symlinks=False):
+                    kind = _DIR
+                    stack.append(path)
+                else:
+                    kind = _FILE
+                entries[path] = (kind, (st.st_dev, st.st_ino), st.st_mode & 0o7777)
+    return entries
+
+
+def _changes(previous, current, root, emitted, next_id):
+    """describe current relative to previous (scan() results), returns (changes, files to send, next id)
+
+            emitted: {inode: id} of the files the importer already knows, updated
+    """
+
+    previous_inodes = {key: path for path, (kind, key, _) in previous.items() if kind == _FILE}
+    removed = []
+    dirs = {}
+    symlinks = {}
+    files = {}
+    sources = {}
+    send = []
+
+    gone = set()
+    # sorted, so directories are seen before their contents
+    for path in sorted(previous):
+        entry = current.get(path)
+        if entry is None or entry[0] != previous[path][0] or (entry[0] != _DIR and entry[1] != previous[path][1]):
+            # removing a directory removes everything below it
+            if not _ancestors(path, gone):
+                removed.append(path)
+                gone.add(path)
+
+    for path in sorted(current):
+        kind, key, mode = current[path]
+        old = previous.get(path)
+        if old is not None and not _ancestors(path, gone) and old[0] == kind and (kind == _DIR or old[1] == key):
+            continue
+        if kind == _DIR:
+            dirs[path] = mode
+        elif kind == _SYMLINK:
+            symlinks[path] = os.readlink(os.path.join(root, path))
+        else:
+            if key not in emitted:
+                emitted[key] = next_id
+                if key in previous_inodes:
+                    sources[next_id] = previous_inodes[key]
+                else:
+                    send.append((next_id, path))
+                next_id += 1
+            files[path] = emitted[key]
+
+    changes = {'removed': removed, 'dirs': dirs, 'symlinks': symlinks, 'files': files, 'sources': sources}
+    return changes, send, next_id
+
+
+def _ancestors(path, candidates):
+    """the entries of candidates which are path or one of its parent directories"""
+
+    found = []
+    while path:
+        if path in candidates:
+            found.append(path)
+        path = os.path.dirname(path)
+    return found
+
+
+def _add_json(tar, name, document):
+    data = json.dumps(document, separators=(',', ':'), default=str).encode()
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = time.time()
+    tar.addfile(info, io.BytesIO(data))
+
+
+def write_stream(fileobj, manifest, base_path, snapshots, compress=False):
+    """write the archive of snapshots ([(name, path)], oldest first) relative to base_path (None for all files)
+
+            manifest: document stored as manifest.json (base, snapshot metadata, links)
+            returns (files sent, bytes sent)
+    """
+
+    tar = tarfile.open(fileobj=fileobj, mode='w|gz' if compress else 'w|', format=tarfile.PAX_FORMAT)
+    sent = sent_bytes = 0
+    try:
+        _add_json(tar, 'manifest.json', dict(manifest, format=FORMAT))
+
+        previous = scan(base_path)
+        emitted = {}
+        next_id = 0
+        for name, path in snapshots:
+            current = scan(path)
+            changes, send, next_id = _changes(previous, current, path, emitted, next_id)
+            _add_json(tar, f'{name}/changes.json', changes)
+            logger.info('exporting snapshot [%s]: [%s] removed, [%s] new files ([%s] sent), [%s] new dirs',
+                        name, len(changes['removed']), len(changes['files']), len(send), len(changes['dirs']))
+            for file_id, rel in send:
+                source = os.path.join(path, rel)
+                info = tar.gettarinfo(source, arcname=f'{name}/data/{file_id}')
+                with open(source, 'rb') as fh:
+                    tar.addfile(info, fh)
+                sent += 1
+                sent_bytes += info.size
+            # forget the files which are gone, they are sent again should they ever come back
+            inodes = {entry[1] for entry in current.values()}
+            emitted = {key: i for key, i in emitted.items() if key in inodes}
+            previous = current
+    finally:
+        tar.close()
+    return sent, sent_bytes
+
+
+class StreamReader:
+    """reads an archive written by write_stream(), the manifest is available right away"""
+
+    def __init__(self, fileobj):
+        self._tar = tarfile.open(fileobj=fileobj, mode='r|*')
+        self._member = self._next()
+        if self._member is None or self._member.name != 'manifest.json':
+            raise Exception('not a timeline export stream (no manifest.json)')
+        self.manifest = json.load(self._tar.extractfile(self._member))
+        if self.manifest.get('format') != FORMAT:
+            raise Exception(f'unsupported export format [{self.manifest.get("format")}]')
+        self._member = self._next()
+
+    def _next(self):
+        return self._tar.next()
+
+    def close(self):
+        self._tar.close()
+
+    def snapshots(self, base_path, path_of):
+        """rebuild the snapshots of the stream, yields (name, path) after each complete snapshot
+
+                base_path:  the base snapshot in the target timeline (None if the export has no base)
+                path_of:    function returning the path to build a snapshot (name) in
+        """
+
+        previous_path = base_path
+        known = {}
+        while self._member is not None:
+            member = self._member
+            name, _, leaf = member.name.partition('/')
+            if leaf != 'changes.json':
+                raise Exception(f'unexpected archive member [{member.name}]')
+            changes = json.load(self._tar.extractfile(member))
+            path = path_of(name)
+            pending = self._prepare(previous_path, path, changes, known)
+
+            self._member = self._next()
+            while self._member is not None and self._member.name.startswith(f'{name}/data/'):
+                file_id = int(self._member.name.rsplit('/', 1)[1])
+                paths = pending.pop(file_id)
+                target = os.path.join(path, paths[0])
+                with open(target, 'wb') as fh:
+                    shutil.copyfileobj(self._tar.extractfile(self._member), fh, 1024 * 1024)
+                _set_attributes(target, self._member)
+                for other in paths[1:]:
+                    os.link(target, os.path.join(path, other))
+                known[file_id] = target
+                self._member = self._next()
+
+            if pending:
+                raise Exception(f'incomplete export stream, [{len(pending)}] files of snapshot [{name}] are missing')
+            yield name, path
+            previous_path = path
+
+    def _prepare(self, previous_path, path, changes, known):
+        """build the snapshot from its predecessor as far as possible, returns {id: [paths]} waiting for data"""
+
+        for rel in [*changes['removed'], *changes['dirs'], *changes['symlinks'], *changes['files'],
+                    *changes['sources'].values()]:
+            if os.path.isabs(rel) or '..' in rel.split('/'):
+                raise Exception(f'invalid path [{rel}] in export stream')
+        if os.path.exists(path):
+            raise Exception(f'[{path}] already exists')
+        if previous_path:
+            subprocess.check_call(['cp', '-al', previous_path, path])
+        else:
+            os.makedirs(path)
+
+        for rel in changes['removed']:
+            target = os.path.join(path, rel)
+            if os.path.isdir(target) and not os.path.islink(target):
+                shutil.rmtree(target)
+            else:
+                os.remove(target)
+        for rel, mode in sorted(changes['dirs'].items()):
+            target = os.path.join(path, rel)
+            os.mkdir(target)
+            os.chmod(target, mode)
+        for rel, destination in changes['symlinks'].items():
+            os.symlink(destination, os.path.join(path, rel))
+
+        for file_id, rel in changes['sources'].items():
+            known[int(file_id)] = os.path.join(previous_path, rel)
+        pending = {}
+        for rel, file_id in sorted(changes['files'].items()):
+            if file_id in known:
+                os.link(known[file_id], os.path.join(path, rel))
+            else:
+                pending.setdefault(file_id, []).append(rel)
+        return pending
+
+
+def _set_attributes(path, member):
+    if os.geteuid() == 0:
+        try:
+            os.chown(path, member.uid, member.gid)
+        except OSError as e:
+            logger.debug('cannot change owner of [%s]: %s', path, e)
+    os.chmod(path, member.mode)
+    os.utime(path, (member.mtime, member.mtime))
@@ -0,0 +1,222 @@
+"""Repository metadata handling
+
+Parsers for the top-level metadata of RPM (``repodata/repomd.xml``) and Debian
+(``dists/*/Release``, ``dists/*/InRelease``) repositories and a validation of
+a snapshot against it: every metadata file referenced with a size and checksum
+must match, otherwise the snapshot was most probably taken while the mirror
+was being synchronized.
+"""
+
+import logging
+import os
+import time
+import xml.etree.ElementTree as ElementTree
+
+from timeline import checksums
+
+logger = logging.getLogger('Timeline.repository')
+
+# directories which never contain repository metadata, not descended into while searching
+_PRUNE_DIRS = frozenset(('Packages', 'pool', 'by-hash'))
+
+# Release file checksum fields, strongest first
+_RELEASE_HASHES = (('SHA512', 'sha512'), ('SHA256', 'sha256'), ('SHA1', 'sha1'), ('MD5Sum', 'md5'))
+
+# repomd.xml checksum type -> hashlib name
+_REPOMD_HASHES = {'sha': 'sha1', 'sha1': 'sha1', 'sha224': 'sha224', 'sha256': 'sha256',
+                  'sha384': 'sha384', 'sha512': 'sha512', 'md5': 'md5'}
+
+_REPOMD_NS = '{http://linux.duke.edu/metadata/repo}'
+
+
+class Check:
+    """a file referenced by repository metadata"""
+
+    __slots__ = ('path', 'size', 'algorithm', 'digest', 'required', 'origin')
+
+    def __init__(self, path, size, algorithm, digest, required, origin):
+        self.path = path
+        self.size = size
+        self.algorithm = algorithm
+        self.digest = digest
+        self.required = required
+        self.origin = origin
+
+    def key(self):
+        return (self.path, self.algorithm, self.digest, self.size)
+
+
+def find_metadata(root):
+    """return the paths of all repomd.xml and Release/InRelease files below root"""
+
+    found = []
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = list(it)
+        except OSError as e:
+            logger.warning('cannot scan [%s]: %s', directory, e)
+            continue
+        in_dists = 'dists' in os.path.relpath(directory, root).split(os.sep)
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name not in _PRUNE_DIRS:
+                    stack.append(entry.path)
+            elif entry.name == 'repomd.xml' and os.path.basename(directory) == 'repodata':
+                found.append(entry.path)
+            elif entry.name in ('Release', 'InRelease') and in_dists:
+                found.append(entry.path)
+    return sorted(found)
+
+
+def parse_repomd(path):
+    """return the list of Checks for the files referenced by a repomd.xml"""
+
+    base = os.path.dirname(os.path.dirname(path))
+    checks = []
+    for data in ElementTree.parse(path).getroot().iter(_REPOMD_NS + 'data'):
+        location = data.find(_REPOMD_NS + 'location')
+        checksum = data.find(_REPOMD_NS + 'checksum')
+        size = data.find(_REPOMD_NS + 'size')
+        if location is None or checksum is None:
+            continue
+        algorithm = _REPOMD_HASHES.get(checksum.get('type', '').lower())
+        if not algorithm:
+            logger.warning('unknown checksum type [%s] in [%s]', checksum.get('type'), path)
+            continue
+        checks.append(Check(
+            os.path.normpath(os.path.join(base, location.get('href'))),
+            int(size.text) if size is not None else None,
+            algorithm, checksum.text.strip(), True, path))
+    return checks
+
+
+def _release_text(path):
+    """return the contents of a Release file, strip the signature from an InRelease file"""
+
+    with open(path, encoding='utf-8', errors='replace') as fh:
+        text = fh.read()
+
+    if not text.startswith('-----BEGIN PGP SIGNED MESSAGE-----'):
+        return text
+
+    # clearsigned: armor headers, empty line, dash-escaped body, signature
+    body = text.split('\n\n', 1)[1] if '\n\n' in text else ''
+    body = body.split('\n-----BEGIN PGP SIGNATURE-----', 1)[0]
+    return '\n'.join(line[2:] if line.startswith('- ') else line for line in body.split('\n'))
+
+
+def parse_release(path):
+    """return the list of Checks for the files listed in a Release/InRelease file
+
+            only the strongest checksum available is used, files listed in a Release file are
+            optional (mirrors often do not carry the uncompressed indices)
+    """
+
+    fields = {}
+    current = None
+    for line in _release_text(path).split('\n'):
+        if line.startswith((' ', '\t')) and current:
+            fields[current].append(line.strip())
+        elif ':' in line:
+            current, value = line.split(':', 1)
+            fields[current] = [value.strip()] if value.strip() else []
+        else:
+            current = None
+
+    base = os.path.dirname(path)
+    for field, algorithm in _RELEASE_HASHES:
+        if field in fields:
+            break
+    else:
+        return []
+
+    checks = []
+    for line in fields[field]:
+        parts = line.split()
+        if len(parts) != 3:
+            continue
+        digest, size, relpath = parts
+        checks.append(Check(os.path.normpath(os.path.join(base, relpath)), int(size),
+                            algorithm, digest.lower(), False, path))
+    return checks
+
+
+class ValidationResult:
+    """outcome of validate()"""
+
+    def __init__(self):
+        self.metadata_files = []
+        self.checked = 0
+        self.checked_bytes = 0
+        self.errors = []
+        self.seconds = 0.0
+
+    @property
+    def valid(self):
+        return not self.errors
+
+    def as_dict(self):
+        return {
+            'metadata_files': len(self.metadata_files),
+            'checked': self.checked,
+            'checked_bytes': self.checked_bytes,
+            'errors': len(self.errors),
+            'seconds': round(self.seconds, 3),
+        }
+
+
+def validate(root, metadata_files=None, jobs=None):
+    """validate the repository metadata below root
+
+            metadata_files: repomd.xml/Release/InRelease files to use, searched below root if None
+            jobs:           number of hashing threads
+    """
+
+    start = time.time()
+    result = ValidationResult()
+
+    if metadata_files is None:
+        metadata_files = find_metadata(root)
+    result.metadata_files = metadata_files
+
+    checks = {}
+    for path in metadata_files:
+        try:
+            parsed = parse_repomd(path) if path.endswith('repomd.xml') else parse_release(path)
+        except (OSError, ElementTree.ParseError, ValueError) as e:
+            result.errors.append(f'cannot parse [{path}]: {e}')
+            continue
+        for check in parsed:
+            checks.setdefault(check.key(), check)
+
+    to_hash = []
+    for check in checks.values():
+        try:
+            st = os.stat(check.path)
+        except OSError:
+            if check.required:
+                result.errors.append(f'[{check.path}] referenced by [{check.origin}] is missing')
+            continue
+        if check.size is not None and st.st_size != check.size:
+            result.errors.append(
+                f'[{check.path}] has size {st.st_size}, [{check.origin}] expects {check.size}')
+            continue
+        to_hash.append(check)
+        result.checked_bytes += st.st_size
+
+    by_algorithm = {}
+    for check in to_hash:
+        by_algorithm.setdefault(check.algorithm, []).append(check)
+    for algorithm, group in by_algorithm.items():
+        digests = checksums.hash_files([c.path for c in group], jobs, algorithm, threads=True)
+        for check, digest in zip(group, digests):
+            if digest != check.digest:
+                result.errors.append(
+                    f'[{check.path}] has {algorithm} {digest}, [{check.origin}] expects {check.digest}')
+
+    result.checked = len(to_hash)
+    result.seconds = time.time() - start
+    return result
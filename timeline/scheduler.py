@@ -0,0 +1,272 @@
+"""Snapshot scheduler
+
+Replaces one cron line (plus --random-sleep) per timeline. Every timeline
+carries its schedule in timeline.cfg::
+
+    schedule_interval = 1d          # take a snapshot every day
+    schedule_window = 01:00-05:00   # ... between 1 and 5 am (optional)
+    schedule_catch_up = True        # missed runs are caught up outside of the window
+
+The scheduler periodically collects the timelines which are due and starts
+them longest job first, using the durations recorded for the previous
+snapshots, so the long builds do not end up at the end of the window. Jobs
+which are not expected to finish before their window closes are postponed.
+The number of concurrent builds is limited per device (and in total), and a
+timeline is never built twice at the same time: the scheduler takes the same
+lock file as ``mrepo create-snapshot --lock``.
+"""
+
+import concurrent.futures
+import logging
+import os
+import re
+import statistics
+import threading
+import time
+from datetime import datetime, timedelta
+
+import lockfile
+
+from timeline import timeline
+from timeline.daemon import TimelineCache
+
+logger = logging.getLogger('Timeline.scheduler')
+
+_INTERVAL_RE = re.compile(r'^\s*(\d+)\s*([smhd]?)\s*$')
+_INTERVAL_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+_WINDOW_RE = re.compile(r'^\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*$')
+
+# number of recorded durations used to estimate the next one
+_DURATION_HISTORY = 5
+
+# seconds before a failed build is retried
+_RETRY_DELAY = 900
+
+# seconds a timeline may be due before its interval has passed (start time jitter), at most a tenth of the interval
+_TOLERANCE = 300
+
+
+def parse_interval(value):
+    """'1d', '12h', '30m' or plain seconds -> seconds, None for an empty value"""
+
+    if not value:
+        return None
+    match = _INTERVAL_RE.match(str(value))
+    if not match or int(match.group(1)) == 0:
+        raise Exception(f'invalid schedule interval [{value}], expected e.g. 1d, 12h, 30m')
+    return int(match.group(1)) * _INTERVAL_UNITS[match.group(2)]
+
+
+def parse_window(value):
+    """'HH:MM-HH:MM' -> (start, end) in minutes after midnight, None for an empty value
+
+            the window may wrap around midnight (e.g. 22:00-04:00)
+    """
+
+    if not value:
+        return None
+    match = _WINDOW_RE.match(str(value))
+    if not match:
+        raise Exception(f'invalid schedule window [{value}], expected HH:MM-HH:MM')
+    h1, m1, h2, m2 = (int(g) for g in match.groups())
+    if h1 > 23 or h2 > 24 or m1 > 59 or m2 > 59 or (h1 * 60 + m1) == (h2 * 60 + m2):
+        raise Exception(f'invalid schedule window [{value}]')
+    return h1 * 60 + m1, h2 * 60 + m2
+
+
+def window_end(window, now):
+    """end of the window occurrence containing now, None if now is outside of the window"""
+
+    start, end = window
+    minute = now.hour * 60 + now.minute
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    if start < end:
+        if start <= minute < end:
+            return midnight + timedelta(minutes=end)
+        return None
+    # wraps around midnight
+    if minute >= start:
+        return midnight + timedelta(days=1, minutes=end)
+    if minute < end:
+        return midnight + timedelta(minutes=end)
+    return None
+
+
+def window_start(window, now):
+    """start of the last window occurrence which started at or before now (now may be outside of the window)"""
+
+    start = now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(minutes=window[0])
+    return start if start <= now else start - timedelta(days=1)
+
+
+def window_length(window):
+    start, end = window
+    return ((end - start) % 1440) * 60
+
+
+def expected_duration(t, default):
+    """median of the last recorded snapshot durations of a timeline, default if none are known"""
+
+    durations = [t._snapshots[s].duration for s in t._lsnapshots[-_DURATION_HISTORY:]
+                 if t._snapshots[s].duration is not None]
+    return statistics.median(durations) if durations else default
+
+
+class Job:
+    """a due snapshot build"""
+
+    __slots__ = ('path', 'name', 'device', 'expected', 'missed', 'deadline')
+
+    def __init__(self, path, name, device, expected, missed, deadline):
+        self.path = path
+        self.name = name
+        self.device = device
+        self.expected = expected
+        self.missed = missed
+        self.deadline = deadline
+
+    def sort_key(self):
+        # missed runs first, then longest job first
+        return (-self.missed, -self.expected, self.path)
+
+
+class Scheduler:
+    """runs create_snapshot() for due timelines
+
+            paths:          timeline destinations or directories containing timelines (searched recursively)
+            max_per_device: concurrent builds per device (st_dev of the destination)
+            max_jobs:       concurrent builds in total
+            default_duration: expected duration (seconds) of timelines without recorded durations
+    """
+
+    def __init__(self, paths, max_per_device=1, max_jobs=4, default_duration=600):
+        self._paths = paths
+        self._max_per_device = max_per_device
+        self._max_jobs = max_jobs
+        self._default_duration = default_duration
+        self._cache = TimelineCache()
+        self._running = {}
+        self._failed = {}
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_jobs)
+        self._stop = threading.Event()
+
+    def due_jobs(self, now=None):
+        """return the list of due jobs (not running ones), in start order"""
+
+        now = now or datetime.now()
+        jobs = []
+        for path in timeline.find_timelines(self._paths):
+            if path in self._running or self._failed.get(path, 0) > time.time():
+                continue
+            try:
+                t = self._cache.load(path)
+                interval = parse_interval(t._schedule_interval)
+                window = parse_window(t._schedule_window)
+            except Exception as e:
+                logger.error('skipping timeline [%s]: %s', path, e)
+                continue
+            if not interval or t._frozen:
+                continue
+
+            last = t._snapshots[t._lsnapshots[-1]].created if t._lsnapshots else None
+            age = (now - last).total_seconds() if last else None
+            tolerance = min(_TOLERANCE, interval // 10)
+            if window and interval >= window_length(window) and window_end(window, now):
+                # a run anywhere within a window occurrence (or a catch-up run after it) counts for the whole
+                # occurrence, the interval is measured between the starts of the occurrences
+                start = window_start(window, now)
+                if last and (last >= start or
+                             (start - window_start(window, last)).total_seconds() < interval - tolerance):
+                    continue
+            elif age is not None and age < interval - tolerance:
+                continue
+            missed = int(age // interval) - 1 if age is not None else 0
+
+            deadline = None
+            if window:
+                deadline = window_end(window, now)
+                if deadline is None and not (missed > 0 and t._schedule_catch_up):
+                    continue
+
+            jobs.append(Job(path, t._name, os.stat(path).st_dev,
+                            expected_duration(t, self._default_duration), max(0, missed), deadline))
+
+        jobs.sort(key=Job.sort_key)
+        return jobs
+
+    def _pack(self, jobs, now):
+        """choose the jobs to start now within the concurrency limits"""
+
+        per_device = {}
+        for device, _ in self._running.values():
+            per_device[device] = per_device.get(device, 0) + 1
+        slots = self._max_jobs - len(self._running)
+
+        start = []
+        for job in jobs:
+            if slots <= 0:
+                break
+            if per_device.get(job.device, 0) >= self._max_per_device:
+                continue
+            if job.deadline and now + timedelta(seconds=job.expected) > job.deadline and not job.missed:
+                logger.info('postponing [%s]: expected duration %ds does not fit into the window',
+                            job.path, job.expected)
+                continue
+            per_device[job.device] = per_device.get(job.device, 0) + 1
+            slots -= 1
+            start.append(job)
+        return start
+
+    def _build(self, job):
+        """take a snapshot of a single timeline, holding the timeline lock"""
+
+        lock = lockfile.FileLock(os.path.join(job.path, '.lock'))
+        try:
+            lock.acquire(timeout=0)
+        except lockfile.LockError:
+            logger.warning('timeline [%s] is locked, skipping this run', job.path)
+            return False
+
+        try:
+            logger.info('starting snapshot of [%s] (expected duration %ds)', job.path, job.expected)
+            t = timeline.Timeline.load(job.path)
+            t.create_snapshot()
+        except Exception as e:
+            logger.error('snapshot of [%s] failed: %s', job.path, e)
+            return False
+        finally:
+            lock.release()
+        return True
+
+    def _reap(self):
+        """forget finished jobs, failed ones are retried after a delay"""
+
+        for path, (_, future) in list(self._running.items()):
+            if future.done():
+                del self._running[path]
+                if not future.result():
+                    self._failed[path] = time.time() + _RETRY_DELAY
+
+    def tick(self, now=None):
+        """start all due jobs which fit, returns the started jobs"""
+
+        self._reap()
+        now = now or datetime.now()
+        started = self._pack(self.due_jobs(now), now)
+        for job in started:
+            self._running[job.path] = (job.device, self._executor.submit(self._build, job))
+        return started
+
+    def run(self, poll=60, once=False):
+        """schedule until stop() is called, with once=True until nothing is due anymore"""
+
+        while not self._stop.is_set():
+            started = self.tick()
+            if once and not started and not self._running:
+                break
+            self._stop.wait(poll if not once else 1)
+        self._executor.shutdown(wait=True)
+        self._reap()
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,277 @@
+"""Read-only HTTP status server
+
+``mrepo http`` serves the state of all timelines below a root directory as
+JSON, for dashboards and provisioning systems which need to know where links
+point to::
+
+    /timelines                          summary of all timelines
+    /timelines/<timeline>               full state of a timeline
+    /timelines/<timeline>/snapshots     snapshots, oldest first
+    /timelines/<timeline>/links         links with their target, offset and max_offset
+    /metrics                            last run, counts and link offsets of all timelines
+
+<timeline> is the path of the timeline relative to the root directory.
+
+The metadata files are read directly (no Timeline instance is created, so
+nothing is ever written). All responses are serialized once and kept in
+memory; the metadata files are checked for changes (mtime) at most once per
+revalidation interval and the root directory is searched for new timelines
+at most once per rescan interval, so requests in between do not touch the
+disk. Timestamps are absolute (ISO 8601 and seconds since the epoch) so
+cached responses do not go stale.
+"""
+
+import configparser
+import hashlib
+import http.server
+import json
+import logging
+import os
+import threading
+import time
+
+from timeline import timeline
+
+logger = logging.getLogger('Timeline.status')
+
+
+def _timestamp(value):
+    if value is None:
+        return None, None
+    return value.isoformat(timespec='seconds'), round(value.timestamp(), 3)
+
+
+def _signature(path):
+    sig = []
+    for name in (timeline.Timeline._datafile_ext, timeline.Timeline._cfgfile_ext):
+        try:
+            st = os.stat(os.path.join(path, name))
+        except OSError:
+            sig.append(None)
+            continue
+        sig.append((st.st_ino, st.st_size, st.st_mtime_ns))
+    return tuple(sig)
+
+
+def timeline_status(path):
+    """return the JSON-serializable state of the timeline in path"""
+
+    state = timeline.Timeline.read_metadata(path)
+    snapshots = state.get('_snapshots', {})
+    lsnapshots = state.get('_lsnapshots', [])
+    max_snapshots = state.get('_max_snapshots')
+
+    cfg = configparser.ConfigParser()
+    if cfg.read(os.path.join(path, timeline.Timeline._cfgfile_ext)):
+        max_snapshots = cfg.getint('MAIN', 'max_snapshots', fallback=max_snapshots)
+
+    snapshot_list = []
+    for name in lsnapshots:
+        s = snapshots.get(name, {})
+        created, created_ts = _timestamp(s.get('created'))
+        snapshot_list.append({
+            'name': name,
+            'created': created,
+            'created_ts': created_ts,
+            'duration': s.get('duration'),
+            'links': list(s.get('links', [])),
+        })
+
+    # positions counted from the newest snapshot, plus the snapshots thinned out by the retention policy since
+    thinned = state.get('_thinned', [])
+    positions = {name: len(lsnapshots) - n for n, name in enumerate(lsnapshots)}
+    links = {}
+    for name, link in sorted(state.get('_links', {}).items()):
+        target = link.get('snapshot')
+        # same convention as Timeline._get_snapshot_offset(): the newest snapshot has offset 1
+        offset = (positions[target] + sum(1 for seq in thinned if seq > snapshots[target].get('seq', 0))
+                  if target in positions else None)
+        created, created_ts = _timestamp(snapshots.get(target, {}).get('created'))
+        links[name] = {
+            'snapshot': target,
+            'snapshot_created': created,
+            'snapshot_created_ts': created_ts,
+            'offset': offset,
+            'max_offset': link.get('max_offset', 0),
+            'past_max_offset': bool(link.get('max_offset')) and offset is not None and offset > link['max_offset'],
+        }
+
+    last = snapshots.get(lsnapshots[-1], {}) if lsnapshots else {}
+    last_created, last_created_ts = _timestamp(last.get('created'))
+    return {
+        'name': state.get('_name'),
+        'source': state.get('_source'),
+        'destination': state.get('_destination'),
+        'frozen': state.get('_frozen') or False,
+        'max_snapshots': max_snapshots,
+        'snapshots': snapshot_list,
+        'links': links,
+        'last_run': {
+            'snapshot': lsnapshots[-1] if lsnapshots else None,
+            'created': last_created,
+            'created_ts': last_created_ts,
+            'duration': last.get('duration'),
+            'validation': last.get('validation'),
+            'changes': last.get('metrics'),
+        },
+    }
+
+
+def _summary(status):
+    return {
+        'name': status['name'],
+        'destination': status['destination'],
+        'frozen': status['frozen'],
+        'snapshots': len(status['snapshots']),
+        'max_snapshots': status['max_snapshots'],
+        'links': {name: link['snapshot'] for name, link in status['links'].items()},
+        'last_run': status['last_run']['created'],
+    }
+
+
+def _metrics(status):
+    return {
+        'snapshots': len(status['snapshots']),
+        'max_snapshots': status['max_snapshots'],
+        'frozen': bool(status['frozen']),
+        'last_run_ts': status['last_run']['created_ts'],
+        'last_run_duration': status['last_run']['duration'],
+        'last_run_changes': status['last_run']['changes'],
+        'link_offsets': {name: link['offset'] for name, link in status['links'].items()},
+        'links_past_max_offset': sorted(name for name, link in status['links'].items() if link['past_max_offset']),
+    }
+
+
+def _encode(document):
+    body = json.dumps(document, indent=1, sort_keys=True, default=str).encode()
+    return body, '"{0}"'.format(hashlib.sha1(body).hexdigest())
+
+
+class StatusCache:
+    """pre-serialized responses for all timelines below root
+
+            revalidate: seconds between checks of the metadata files for changes
+            rescan:     seconds between searches for new/removed timelines
+    """
+
+    def __init__(self, root, revalidate=1.0, rescan=60.0):
+        self._root = os.path.normpath(os.path.abspath(root))
+        self._revalidate = revalidate
+        self._rescan = rescan
+        self._mutex = threading.Lock()
+        self._timelines = {}        # relative path -> (signature, status, {url suffix: (body, etag)})
+        self._responses = {}        # url path -> (body, etag)
+        self._checked = 0.0
+        self._scanned = 0.0
+
+    def _refresh(self):
+        now = time.monotonic()
+        if now - self._scanned >= self._rescan:
+            paths = {os.path.relpath(p, self._root): p for p in timeline.find_timelines([self._root])}
+            self._scanned = now
+        else:
+            paths = {rel: os.path.join(self._root, rel) for rel in self._timelines}
+
+        changed = set(self._timelines) - set(paths)
+        for rel in changed:
+            del self._timelines[rel]
+        for rel, path in paths.items():
+            sig = _signature(path)
+            cached = self._timelines.get(rel)
+            if cached and cached[0] == sig:
+                continue
+            try:
+                status = timeline_status(path)
+                self._timelines[rel] = (sig, status, {
+                    '': _encode(status),
+                    '/snapshots': _encode(status['snapshots']),
+                    '/links': _encode(status['links']),
+                })
+            except Exception as e:
+                logger.warning('cannot read timeline [%s]: %s', path, e)
+                self._timelines.pop(rel, None)
+            changed.add(rel)
+
+        if changed or not self._responses:
+            self._build()
+        self._checked = now
+
+    def _build(self):
+        responses = {}
+        summaries = {}
+        metrics = {}
+        for rel, (_, status, encoded) in sorted(self._timelines.items()):
+            for suffix, response in encoded.items():
+                responses[f'/timelines/{rel}{suffix}'] = response
+            summaries[rel] = _summary(status)
+            metrics[rel] = _metrics(status)
+        responses['/timelines'] = _encode(summaries)
+        responses['/metrics'] = _encode({
+            'timelines': len(metrics),
+            'snapshots': sum(m['snapshots'] for m in metrics.values()),
+            'frozen': sum(m['frozen'] for m in metrics.values()),
+            'per_timeline': metrics,
+        })
+        # replaced as a whole, readers never see a half-built dict
+        self._responses = responses
+
+    def get(self, path):
+        """return (body, etag) for the given url path, None if unknown"""
+
+        if time.monotonic() - self._checked >= self._revalidate:
+            with self._mutex:
+                if time.monotonic() - self._checked >= self._revalidate:
+                    self._refresh()
+        return self._responses.get(path.rstrip('/') or '/timelines')
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    cache = None
+    server_version = 'mrepo'
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        response = self.cache.get(self.path.split('?', 1)[0])
+        if response is None:
+            body, _ = _encode({'error': f'not found: {self.path}'})
+            self._send(404, body)
+            return
+        body, etag = response
+        if self.headers.get('If-None-Match') == etag:
+            self._send(304, b'', etag)
+        else:
+            self._send(200, body, etag)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def _send(self, code, body, etag=None):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if etag:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s', self.address_string(), format % args)
+
+
+def serve(root, address='127.0.0.1', port=8080, revalidate=1.0, rescan=60.0):
+    """serve the status of the timelines below root until interrupted"""
+
+    handler = type('Handler', (_Handler,), {'cache': StatusCache(root, revalidate, rescan)})
+    handler.cache.get('/timelines')
+    server = http.server.ThreadingHTTPServer((address, port), handler)
+    server.daemon_threads = True
+    logger.info('serving status of timelines below [%s] on http://%s:%s/', root, address, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
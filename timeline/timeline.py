@@ -2,18 +2,43 @@
 
 # Author: Jan Engels, DESY - IT
 
+import concurrent.futures
 import configparser
+import contextlib
+import copy
+import fcntl
+import fnmatch
+import functools
 import logging
 import logging.config
 import os
 import pickle
 import pprint
 import random
+import re
 import subprocess
 import sys
+import threading
 import time
 from datetime import datetime
 
+from timeline import catalog
+from timeline import checksums
+from timeline import filesystem
+from timeline import history
+from timeline import immutable
+from timeline import learn
+from timeline import listing
+from timeline import merkle
+from timeline import packages
+from timeline import pipeline
+from timeline import planner
+from timeline import pool
+from timeline import replicate
+from timeline import repository
+from timeline import usage
+from timeline import watch
+
 if __name__ != '__main__':
     try:
         logging.config.fileConfig('/etc/timeline-logging.cfg')
@@ -30,15 +55,261 @@ def isalnum( string, allowed_extra_chars='' ):
     return stripped_name.isalnum()
 
 
+def find_timelines( paths ):
+    """ return the timeline directories (containing a metadata file) in or below the given paths
+
+            timeline directories are not descended into
+    """
+
+    found = set()
+    stack = [ os.path.normpath( os.path.abspath( p )) for p in paths ]
+    while stack:
+        path = stack.pop()
+        if os.path.exists( os.path.join( path, Timeline._datafile_ext )):
+            found.add( path )
+            continue
+        try:
+            with os.scandir( path ) as it:
+                stack.extend( e.path for e in it if e.is_dir( follow_symlinks=False ) and not e.name.startswith('.') )
+        except OSError as e:
+            logging.getLogger('Timeline').warning('cannot scan [%s]: %s', path, e)
+    return sorted( found )
+
+
+class _Record:
+    """ base class of the snapshot and link records
+
+            the records are stored in the metadata file as plain dicts, see from_dict() and as_dict().
+            fields which are not set are None and only the required fields are stored when they are None,
+            keys of the stored dict which are not fields (written by another version) are kept as they are
+    """
+
+    __slots__ = ( '_extra', )
+    _required = ()
+
+    def __init__( self, **fields ):
+        self._extra = None
+        for name in self.__slots__:
+            setattr( self, name, None )
+        for name, value in fields.items():
+            setattr( self, name, value )
+
+    @classmethod
+    def from_dict( cls, values ):
+        """ create a record from a dict of the metadata file """
+        record = cls()
+        for key, value in values.items():
+            if key in cls.__slots__:
+                setattr( record, key, value )
+            else:
+                if record._extra is None:
+                    record._extra = {}
+                record._extra[ key ] = value
+        return record
+
+    def as_dict( self ):
+        """ plain dict, as stored in the metadata file """
+        d = { name : getattr( self, name ) for name in self.__slots__
+              if name in self._required or getattr( self, name ) is not None }
+        if self._extra:
+            d.update( self._extra )
+        return d
+
+    def copy( self ):
+        return type( self ).from_dict( self.as_dict() )
+
+    def __eq__( self, other ):
+        if type( other ) is not type( self ):
+            return NotImplemented
+        return self.as_dict() == other.as_dict()
+
+    # records are mutable
+    __hash__ = None
+
+    def __repr__( self ):
+        return '{0}({1!r})'.format( type( self ).__name__, self.as_dict() )
+
+
+class Snapshot( _Record ):
+    """ a snapshot of the timeline """
+
+    __slots__ = ( 'created', 'path', 'links', 'seq', 'duration', 'validation', 'diff_log_file', 'metrics' )
+    _required = ( 'created', 'path', 'links' )
+
+    def copy( self ):
+        # the copy has its own list of links
+        record = super().copy()
+        record.links = list( self.links )
+        return record
+
+
+class Link( _Record ):
+    """ a link of the timeline """
+
+    __slots__ = ( 'created', 'snapshot', 'path', 'max_offset', 'warn_before_max_offset' )
+    _required = __slots__
+
+
+class SnapshotList( list ):
+    """ the ordered list of snapshot names, with a name -> position index for index() and 'in'
+
+            append() keeps the index up to date, every other change drops it and it is rebuilt on the next
+            lookup
+    """
+
+    def __init__( self, *args ):
+        super().__init__( *args )
+        self._positions = None
+
+    def _index( self ):
+        if self._positions is None:
+            self._positions = { name : i for i, name in enumerate( self ) }
+        return self._positions
+
+    def index( self, name, *args ):
+        if args:
+            return super().index( name, *args )
+        try:
+            return self._index()[ name ]
+        except KeyError:
+            raise ValueError( '{0!r} is not in list'.format( name )) from None
+
+    def __contains__( self, name ):
+        return name in self._index()
+
+    def append( self, name ):
+        super().append( name )
+        if self._positions is not None:
+            self._positions[ name ] = len( self ) - 1
+
+    def remove( self, name ):
+        self._positions = None
+        super().remove( name )
+
+    def insert( self, i, name ):
+        self._positions = None
+        super().insert( i, name )
+
+    def pop( self, i=-1 ):
+        self._positions = None
+        return super().pop( i )
+
+    def extend( self, names ):
+        self._positions = None
+        super().extend( names )
+
+    def sort( self, **kwargs ):
+        self._positions = None
+        super().sort( **kwargs )
+
+    def reverse( self ):
+        self._positions = None
+        super().reverse()
+
+    def clear( self ):
+        self._positions = None
+        super().clear()
+
+    def __setitem__( self, i, value ):
+        self._positions = None
+        super().__setitem__( i, value )
+
+    def __delitem__( self, i ):
+        self._positions = None
+        super().__delitem__( i )
+
+    def __iadd__( self, names ):
+        self._positions = None
+        return super().__iadd__( names )
+
+    def __reduce_ex__( self, protocol ):
+        # pickled as a plain list
+        return ( list, ( list( self ), ))
+
+
+def _operation( method ):
+    """ decorator for the public methods of Timeline: during the outermost call, the paths validated by
+        _valid_snapshot()/_valid_link() are stat'ed only once and the catalog is updated once at the end
+        instead of by every save()
+    """
+
+    @functools.wraps( method )
+    def wrapper( self, *args, **kwargs ):
+        if self._stat_cache is not None:
+            return method( self, *args, **kwargs )
+        self._stat_cache = {}
+        self._catalog_pending = False
+        try:
+            return method( self, *args, **kwargs )
+        finally:
+            self._stat_cache = None
+            pending, self._catalog_pending = self._catalog_pending, None
+            if pending:
+                self._update_catalog()
+    return wrapper
+
+
+class RepairPlan:
+    """ repair actions computed by Timeline.consistency_check() """
+
+    def __init__( self ):
+
+        # metadata changes
+        self.drop_snapshots = []    # snapshots missing on disk
+        self.relink = {}            # link -> new snapshot, for links pointing to dropped snapshots
+        self.drop_links = []        # links which are missing or broken on disk or have no snapshot left
+
+        # file system changes
+        self.remove_paths = []      # orphan snapshot directories, stale diff logs, checksum manifests and digest indexes
+
+        # reported only
+        self.unknown = []           # objects in the destination which are not managed by the timeline
+
+
+    def __bool__( self ):
+
+        return bool( self.drop_snapshots or self.relink or self.drop_links or self.remove_paths )
+
+
+    def describe( self ):
+        """ human readable list of the planned actions """
+
+        lines = [ 'drop missing snapshot [{0}]'.format( s ) for s in self.drop_snapshots ]
+        lines += [ 'move link [{0}] to snapshot [{1}]'.format( l, s ) for l, s in sorted( self.relink.items() ) ]
+        lines += [ 'drop link [{0}]'.format( l ) for l in self.drop_links ]
+        lines += [ 'remove [{0}]'.format( p ) for p in self.remove_paths ]
+        lines += [ 'ignoring unmanaged object [{0}]'.format( p ) for p in self.unknown ]
+        return lines
+
+
 class Timeline:
 
     logger = logging.getLogger('Timeline')
     _datafile_ext = '.timeline'
+    _statelock_ext = '.timeline.lock'
     _cfgfile_ext = 'timeline.cfg'
     _cfgfile_diff_ext = '.timeline.diff.exclude'
     _difflog_ext = '.diff.log'
+    _checksums_dir = '.checksums'
+    _checksums_ext = '.sha256.gz'
+    _digests_dir = '.digests'
+    _digests_ext = '.merkle.gz'
+    _index_file = '.index.sqlite'
+
+    # snapshot fields stored by pipeline runners working alongside other mrepo commands, see _locked_update()
+    _pipeline_fields = ( 'diff_log_file', 'metrics' )
 
-    def __init__( self, name, source, destination ):
+    # seconds between saves of the progress of removing the paths of deleted snapshots
+    _pending_save_interval = 5
+
+    # paths stat'ed during the current operation and whether it saved the timeline, see _operation()
+    _stat_cache = None
+    _catalog_pending = None
+
+    # names of snapshots created by create_snapshot()
+    _snapshot_name_re = re.compile( r'^\d{4}\.\d{2}\.\d{2}-\d{6}(\.\d{6})?$' )
+
+    def __init__( self, name, source, destination, backend=None ):
         """ create a new timeline instance for a given source directory
 
                 ARGUMENTS:
@@ -46,6 +317,8 @@ class Timeline:
                     name:           the name of the timeline instance
                     source:         the timeline source directory (from where snapshots are taken)
                     destination:    the timeline destination directory (where snapshots are written into)
+                    backend:        file system backend for the snapshots and links (see timeline.filesystem),
+                                    the one configured in the configuration file if None
         """
 
         self.logger.info(
@@ -55,11 +328,17 @@ class Timeline:
         if not isalnum( name, '-_.' ):
             raise Exception( 'name string must only consist of alpha-numeric characters, dots, underscores and dashes' )
 
-        if not os.path.isdir( source ):
+        # file system backend, replaced by the configured one once the configuration file has been loaded
+        self._fs = backend if backend is not None else filesystem.SubprocessFileSystem()
+
+        if not self._fs.isdir( source ):
             raise Exception( 'source is not a valid directory' )
 
+        # the metadata files are on disk with every backend
         if not os.path.exists( destination ):
             os.makedirs( destination )
+        if not self._fs.on_disk:
+            self._fs.makedirs( destination, exist_ok=True )
 
         # create a logger for the current instance
         self.logger = logging.getLogger('Timeline.{0}'.format( name ))
@@ -83,7 +362,17 @@ class Timeline:
 
         # snapshots "timeline" (used for snapshot rotation)
         # new snapshots appended to the end, old snapshots removed from the beginning
-        self._lsnapshots = []
+        self._lsnapshots = SnapshotList()
+
+        # generation counter, every snapshot stores its generation as 'seq' (used by the pipeline and the indexes)
+        self._seq = 0
+
+        # generations of the snapshots thinned out by the retention policy, they still count for the offsets
+        # of the older snapshots. snapshots deleted otherwise do not count, as before the retention policy
+        self._thinned = []
+
+        # paths of deleted snapshots (and their diff logs/manifests) which have not been removed yet
+        self._pending_deletions = []
 
         # contains all links
         self._links = {}
@@ -100,6 +389,57 @@ class Timeline:
         # path for storing diff log files (disabled by default)
         self._diff_log_path = ''
 
+        # record content checksums of new snapshots (disabled by default)
+        self._record_checksums = False
+
+        # validate repository metadata of new snapshots before links are rotated
+        self._validate_metadata = True
+
+        # index packages listed by the repository metadata of new snapshots (disabled by default)
+        self._package_index = False
+
+        # sqlite catalog of all timelines, updated on every save (disabled by default)
+        self._catalog_path = ''
+
+        # write static index.html/index.json listings into every directory of new snapshots (disabled by default)
+        self._render_listings = False
+
+        # record merkle digests of the directories of new snapshots, see compare() (disabled by default)
+        self._directory_digests = False
+
+        # content pool shared by the timelines of the device, package files are deduplicated against it
+        # (disabled by default)
+        self._pool_path = ''
+        self._pool_patterns = list( pool.DEFAULT_PATTERNS )
+
+        # file system backend for snapshots and links, see timeline.filesystem
+        self._filesystem = 'subprocess'
+
+        # post-snapshot pipeline: run by create_snapshot itself or by a background process
+        self._pipeline = 'inline'
+        self._pipeline_jobs = 2
+
+        # learn the copy rules from the source over the next <n> snapshots (disabled by default)
+        self._learn_copy_rules = 0
+        self._learn_copy_rules_apply = False
+
+        # retention policy: number of days/weeks/months for which the newest snapshot is kept
+        # (all disabled by default, i.e. the last <max_snapshots> snapshots are kept)
+        self._keep_daily = 0
+        self._keep_weekly = 0
+        self._keep_monthly = 0
+
+        # snapshot schedule used by 'mrepo schedule' (disabled by default)
+        self._schedule_interval = ''
+        self._schedule_window = ''
+        self._schedule_catch_up = True
+
+        # directory for checksum manifests and the checksum cache
+        self._checksums_path = os.path.join( self._destination, self._checksums_dir )
+
+        # directory for the directory digest indexes of the snapshots
+        self._digests_path = os.path.join( self._destination, self._digests_dir )
+
         # load class state from metadata file in case one exists
         if os.path.exists( self._datafile ):
             self._load_state()
@@ -107,6 +447,7 @@ class Timeline:
                 or os.path.normpath( source) != self._source
                 or os.path.normpath( destination ) != self._destination ):
                 raise Exception( 'inconsistencies found loading class state from metadata file' )
+            self._migrate_generations()
 
         # initialize options required for repositories
         self._initialize_repository_options()
@@ -117,22 +458,51 @@ class Timeline:
         else:
             self._load_cfgfile()
 
+        if backend is None and self._filesystem != 'subprocess':
+            self._fs = filesystem.create( self._filesystem )
+
+
+    def _migrate_generations( self ):
+        """ assigns generations to snapshots created before generations were introduced """
+
+        if all( self._snapshots[s].seq is not None for s in self._lsnapshots ):
+            return
+        # without thinning the generations of all snapshots are consecutive
+        for n, snapshot in enumerate( self._lsnapshots, 1 ):
+            self._snapshots[ snapshot ].seq = n
+        self._seq = max( self._seq, len( self._lsnapshots ))
+        self.logger.info('assigned generations to [%s] snapshots', len( self._lsnapshots ))
+
 
     @classmethod
-    def load( cls, path ):
-        """ create a new timeline instance with parameters read from a metadata file in the given path """
+    def load( cls, path, backend=None ):
+        """ create a new timeline instance with parameters read from a metadata file in the given path
+
+                backend: see __init__()
+        """
 
         metadata_file = os.path.join( path, Timeline._datafile_ext )
 
         Timeline.logger.info('loading timeline instance from [%s]', metadata_file)
-        fh = open( metadata_file, 'rb' )
-        try:
-            pickle_data = pickle.load( fh )
-        except UnicodeDecodeError:
-            pickle_data = pickle.load(fh, encoding='latin1')
+        pickle_data = cls.read_metadata( path )
 
         # this calls __init__ with the given arguments loaded from the metadata file
-        return cls( pickle_data['_name'], pickle_data['_source'], pickle_data['_destination'] )
+        return cls( pickle_data['_name'], pickle_data['_source'], pickle_data['_destination'], backend=backend )
+
+
+    @staticmethod
+    def read_metadata( path ):
+        """ return the raw state stored in the metadata file in the given path, without creating an instance
+
+                nothing is written, so this can be used by read-only consumers (status server, catalog)
+        """
+
+        with open( os.path.join( path, Timeline._datafile_ext ), 'rb' ) as fh:
+            try:
+                return pickle.load( fh )
+            except UnicodeDecodeError:
+                fh.seek( 0 )
+                return pickle.load( fh, encoding='latin1' )
 
 
     def __str__( self ):
@@ -201,7 +571,7 @@ class Timeline:
             if i[0] == '/' or i[:1] == '..' or i == '.' or i == '*':
                 raise Exception( 'excludes value must only contain relative paths' )
             exclude_path = os.path.join( self._source, i )
-            if not os.path.exists( exclude_path ):
+            if not self._fs.exists( exclude_path ):
                 raise Exception( 'invalid exclude path [{0}]'.format( exclude_path ))
 
         self._excludes = excludes_clean
@@ -251,20 +621,90 @@ class Timeline:
 
         self._save_state()
         self._save_cfgfile()
+        if self._catalog_path:
+            if self._catalog_pending is None:
+                self._update_catalog()
+            else:
+                # within an operation, see _operation()
+                self._catalog_pending = True
+
+
+    def _update_catalog( self ):
+        """ updates the entry of this timeline in the catalog, failures do not affect the timeline itself """
+
+        try:
+            catalog.update( self._catalog_path, self._state() )
+        except Exception as e:
+            self.logger.warning('cannot update catalog [%s]: %s', self._catalog_path, e)
+
+
+    def _state( self ):
+        """ returns the timeline state as stored in the metadata file: plain dicts and lists, as read by
+            read_metadata()
+        """
+
+        d = self.__dict__.copy() # copy the dict since we will change it
+        del d['logger'] # need to delete self.logger due to file object
+        d.pop( '_stat_cache', None )
+        d.pop( '_catalog_pending', None )
+        d.pop( '_fs', None )
+
+        d['_snapshots'] = { k : v.as_dict() for k, v in self._snapshots.items() }
+        d['_links'] = { k : v.as_dict() for k, v in self._links.items() }
+        d['_lsnapshots'] = list( self._lsnapshots )
+        return d
 
 
     def _save_state( self ):
         """ saves current timeline state into file """
 
         self.logger.info( 'saving current timeline state...')
-        fh = open( self._datafile, 'wb' )
-        #pickle.dump( self, fh )
-        d = self.__dict__.copy() # copy the dict since we will change it
-        del d['logger'] # need to delete self.logger due to file object
-        pickle.dump( d, fh )
+        d = self._state()
+        with self._state_lock():
+            self._merge_pipeline_fields( d )
+            self._write_state( d )
         self.logger.debug('current state saved into [%s]', self._datafile)
 
 
+    @contextlib.contextmanager
+    def _state_lock( self ):
+        """ helper context manager holding the lock of the metadata file, every write of the state happens under it """
+
+        with open( os.path.join( self._destination, self._statelock_ext ), 'a' ) as fh:
+            fcntl.flock( fh, fcntl.LOCK_EX )
+            yield
+
+
+    def _write_state( self, d ):
+        """ helper method which writes the state <d> into the metadata file, holding the state lock """
+
+        # write to a temporary file and rename it, so the metadata file is always complete
+        tmp_datafile = '{0}.tmp'.format( self._datafile )
+        with open( tmp_datafile, 'wb' ) as fh:
+            pickle.dump( d, fh )
+            fh.flush()
+            os.fsync( fh.fileno() )
+        os.replace( tmp_datafile, self._datafile )
+
+
+    def _merge_pipeline_fields( self, d ):
+        """ helper method which keeps the pipeline results stored by _locked_update() since this instance loaded
+            the state: they are taken over into <d> and the snapshots of this instance instead of being overwritten
+        """
+
+        if not os.path.exists( self._datafile ):
+            return
+        stored = self.read_metadata( self._destination )[ '_snapshots' ]
+        for name, fields in d[ '_snapshots' ].items():
+            other = stored.get( name )
+            if not other or other.get( 'seq' ) != fields.get( 'seq' ):
+                continue
+            for key in self._pipeline_fields:
+                if fields.get( key ) is None and other.get( key ) is not None:
+                    fields[ key ] = other[ key ]
+                    setattr( self._snapshots[ name ], key, other[ key ] )
+
+
     def _load_state( self ):
         """ loads timeline state from file """
 
@@ -274,6 +714,10 @@ class Timeline:
             self.__dict__.update(pickle.load( fh ))
         except UnicodeDecodeError:
             self.__dict__.update(pickle.load( fh, encoding='latin1' ))
+        fh.close()
+        self._snapshots = { k : Snapshot.from_dict( v ) for k, v in self._snapshots.items() }
+        self._links = { k : Link.from_dict( v ) for k, v in self._links.items() }
+        self._lsnapshots = SnapshotList( self._lsnapshots )
         self.logger.info('timeline state loaded from [%s]', self._datafile)
 
 
@@ -289,6 +733,41 @@ class Timeline:
         cfg.set( 'MAIN', """\
 # ============================================================================================================================= =
 # warning: this file is constantly auto-generated! do not be surprised if any comments get lost
+# options description:
+#    record_checksums: record the sha256 checksum of every file when creating snapshots. these are used by
+#       'mrepo verify' to detect files which have been modified in place (and thus in all snapshots sharing them)
+#    validate_metadata: check sizes and checksums of the files referenced by repodata/repomd.xml and dists/*/Release
+#       before links are moved to a new snapshot. snapshots failing the validation are deleted again.
+#       on by default for new timelines, off for timelines whose configuration does not have the option
+#    keep_daily, keep_weekly, keep_monthly: retention policy. if any of these is set, snapshots are thinned out: only the
+#       newest snapshot of each of the last <keep_daily> days, <keep_weekly> weeks and <keep_monthly> months is kept,
+#       plus the newest snapshot, all link targets and the snapshots max_offset links move to next. the thinned out
+#       snapshots still count for the link offsets. <max_snapshots> still limits the number of snapshots
+#    package_index: record which snapshots contain which packages (parsed from repodata/*primary.xml.gz and
+#       dists/*/binary-*/Packages.gz) when creating snapshots, see 'mrepo which-snapshot'
+#    catalog_path: sqlite catalog (shared by all timelines of a server) which is updated whenever a command changed
+#       the timeline, see 'mrepo catalog'. empty: disabled
+#    render_listings: write static index.html and index.json directory listings into every directory of new
+#       snapshots, so the web server does not need to generate them. listings of directories which did not change
+#       are hard-linked from the previous snapshot
+#    directory_digests: record a merkle digest of every directory of new snapshots, so 'mrepo compare' only reads
+#       the directories which changed
+#    pool_path: content pool on the same device, shared by several timelines. files of new snapshots matching
+#       pool_patterns (colon-separated) which have the same content as a pooled file are replaced by hard links to
+#       it, see 'mrepo pool'. empty: disabled
+#    filesystem: how snapshots and links are created and removed. subprocess: cp, rm, ln and find processes,
+#       native: os calls in the mrepo process
+#    pipeline: where the post-snapshot pipeline (directory digests, content pool, diff report, checksums, package
+#       index, metrics) runs once the links have been rotated. inline: in create-snapshot itself, background: in a
+#       background process started by create-snapshot. see 'mrepo pipeline status'
+#    pipeline_jobs: number of pipeline jobs run in parallel by the background process
+#    learn_copy_rules: observe which files of the source are modified in place over the next <n> snapshots and
+#       compute the minimal copy_dirs_recursive/copy_files_recursive covering them, see 'mrepo learn'. 0: disabled
+#    learn_copy_rules_apply: write the learned copy rules into this file once the observation is complete
+#    schedule_interval: take a new snapshot every <interval> when running 'mrepo schedule', e.g. 1d, 12h, 30m
+#       (plain numbers are seconds). empty: the timeline is not scheduled
+#    schedule_window: only start scheduled snapshots within this time of day, e.g. 01:00-05:00. empty: any time
+#    schedule_catch_up: start a snapshot outside of the window when at least one scheduled run has been missed
 # =============================================================================================================================""", '' )
         cfg.set( 'ADVANCED', """\
 # ============================================================================================================================= =
@@ -302,12 +781,35 @@ class Timeline:
 #    copy_files_recursive: colon-separated list of file names to be copied (i.e. not hard-linked) when creating snapshots
 #    copy_dirs_recursive:  colon-separated list of directory names to be copied (i.e. not hard-linked) when creating snapshots
 #       warning: the previous copy options perform a _recursive_ find in the source directory and _copy_ any found objects!
+#    immutable_files_recursive: colon-separated list of patterns of files whose name encodes their content (e.g. by-hash
+#       files, checksum-named repodata files). these are hard-linked even inside copied directories. the patterns are
+#       matched against the path relative to the source directory with a leading '/', '*' also matches '/'
 # =============================================================================================================================""", '' )
         cfg.set( 'MAIN', 'max_snapshots', self.get_max_snapshots() )
         cfg.set( 'MAIN', 'diff_log_path', self._diff_log_path  )
+        cfg.set( 'MAIN', 'record_checksums', self._record_checksums )
+        cfg.set( 'MAIN', 'validate_metadata', self._validate_metadata )
+        cfg.set( 'MAIN', 'keep_daily', self._keep_daily )
+        cfg.set( 'MAIN', 'keep_weekly', self._keep_weekly )
+        cfg.set( 'MAIN', 'keep_monthly', self._keep_monthly )
+        cfg.set( 'MAIN', 'package_index', self._package_index )
+        cfg.set( 'MAIN', 'catalog_path', self._catalog_path )
+        cfg.set( 'MAIN', 'render_listings', self._render_listings )
+        cfg.set( 'MAIN', 'directory_digests', self._directory_digests )
+        cfg.set( 'MAIN', 'pool_path', self._pool_path )
+        cfg.set( 'MAIN', 'pool_patterns', ':'.join( self._pool_patterns ))
+        cfg.set( 'MAIN', 'filesystem', self._filesystem )
+        cfg.set( 'MAIN', 'pipeline', self._pipeline )
+        cfg.set( 'MAIN', 'pipeline_jobs', self._pipeline_jobs )
+        cfg.set( 'MAIN', 'learn_copy_rules', self._learn_copy_rules )
+        cfg.set( 'MAIN', 'learn_copy_rules_apply', self._learn_copy_rules_apply )
+        cfg.set( 'MAIN', 'schedule_interval', self._schedule_interval )
+        cfg.set( 'MAIN', 'schedule_window', self._schedule_window )
+        cfg.set( 'MAIN', 'schedule_catch_up', self._schedule_catch_up )
         cfg.set( 'ADVANCED', 'excludes', self.get_excludes() )
         cfg.set( 'ADVANCED', 'copy_files_recursive', ':'.join(self._copy_files_recursive) )
         cfg.set( 'ADVANCED', 'copy_dirs_recursive', ':'.join(self._copy_dirs_recursive) )
+        cfg.set( 'ADVANCED', 'immutable_files_recursive', ':'.join(self._immutable_files_recursive) )
 
         # write configuration file
         with open( self._cfgfile, 'w' ) as cfgfile:
@@ -337,9 +839,30 @@ class Timeline:
         self.set_excludes( cfg.get( 'ADVANCED', 'excludes' ))
         if cfg.has_option( 'MAIN', 'diff_log_path' ):
             self._diff_log_path = cfg.get( 'MAIN', 'diff_log_path' )
+        self._record_checksums = cfg.getboolean( 'MAIN', 'record_checksums', fallback=False )
+        self._validate_metadata = cfg.getboolean( 'MAIN', 'validate_metadata', fallback=False )
+        self._keep_daily = cfg.getint( 'MAIN', 'keep_daily', fallback=0 )
+        self._keep_weekly = cfg.getint( 'MAIN', 'keep_weekly', fallback=0 )
+        self._keep_monthly = cfg.getint( 'MAIN', 'keep_monthly', fallback=0 )
+        self._package_index = cfg.getboolean( 'MAIN', 'package_index', fallback=False )
+        self._catalog_path = cfg.get( 'MAIN', 'catalog_path', fallback='' ).strip()
+        self._render_listings = cfg.getboolean( 'MAIN', 'render_listings', fallback=False )
+        self._directory_digests = cfg.getboolean( 'MAIN', 'directory_digests', fallback=False )
+        self._pool_path = cfg.get( 'MAIN', 'pool_path', fallback='' ).strip()
+        self._pool_patterns = [ i.strip() for i in cfg.get( 'MAIN', 'pool_patterns', fallback=':'.join( pool.DEFAULT_PATTERNS )).split(':') if i.strip() ]
+        self._filesystem = cfg.get( 'MAIN', 'filesystem', fallback='subprocess' ).strip()
+        self._pipeline = cfg.get( 'MAIN', 'pipeline', fallback='inline' ).strip()
+        self._pipeline_jobs = cfg.getint( 'MAIN', 'pipeline_jobs', fallback=2 )
+        self._learn_copy_rules = cfg.getint( 'MAIN', 'learn_copy_rules', fallback=0 )
+        self._learn_copy_rules_apply = cfg.getboolean( 'MAIN', 'learn_copy_rules_apply', fallback=False )
+        self._schedule_interval = cfg.get( 'MAIN', 'schedule_interval', fallback='' ).strip()
+        self._schedule_window = cfg.get( 'MAIN', 'schedule_window', fallback='' ).strip()
+        self._schedule_catch_up = cfg.getboolean( 'MAIN', 'schedule_catch_up', fallback=True )
         # FIXME ugly hack...
         self._copy_files_recursive = [ i.strip() for i in cfg.get( 'ADVANCED', 'copy_files_recursive', fallback='' ).split(':') if i ]
         self._copy_dirs_recursive = [ i.strip() for i in cfg.get( 'ADVANCED', 'copy_dirs_recursive', fallback='' ).split(':') if i ]
+        self._immutable_files_recursive = [ i.strip() for i in cfg.get(
+            'ADVANCED', 'immutable_files_recursive', fallback=':'.join( self._immutable_files_recursive )).split(':') if i.strip() ]
 
 
     def _initialize_repository_options( self ):
@@ -347,18 +870,21 @@ class Timeline:
 
         # FIXME poor man's code to figure out which type of repository...
         distro = 'redhat'
-        if os.path.exists( os.path.join( self._source, 'dists' )):
+        if self._fs.exists( os.path.join( self._source, 'dists' )):
             distro = 'debian'
-            if os.path.exists( os.path.join( self._source, 'ubuntu' )):
+            if self._fs.exists( os.path.join( self._source, 'ubuntu' )):
                 distro = 'ubuntu'
 
         if distro == 'redhat':
             # list of directories which will be copied instead of hard-linked
             self._copy_dirs_recursive = ['repodata'] # 'repoview' left out due to size
             self._copy_files_recursive = []
+            # content-addressed files which are hard-linked even inside copied directories
+            self._immutable_files_recursive = list( immutable.REDHAT_RULES )
         else:
             self._copy_dirs_recursive = ['binary-*', 'source'] # 'i18n' left out due to size
             self._copy_files_recursive = ['Release', 'Release.gpg', 'InRelease', 'Contents-*.gz', 'Index' ]
+            self._immutable_files_recursive = list( immutable.DEBIAN_RULES )
 
 
     def _snapshot_copy_by_hardlink( self, source_path, snapshot_path ):
@@ -366,9 +892,9 @@ class Timeline:
 
         #subprocess.check_call(['cp', '-al', source_path, snapshot_path ])
 
-        os.makedirs( snapshot_path )
+        self._fs.makedirs( snapshot_path )
 
-        for i in os.listdir( source_path ):
+        for i in self._fs.entries( source_path ):
             source_obj = os.path.normpath( os.path.join( source_path, i ))
             for e in self._excludes:
                 exclude_obj = os.path.normpath( os.path.join( source_path, e ))
@@ -376,15 +902,15 @@ class Timeline:
                     self.logger.debug('excluding (skipping) object [%s]', exclude_obj)
                     break
             else:
-                subprocess.check_call(['cp', '-al', source_obj, snapshot_path ])
+                self._fs.link_tree( source_obj, snapshot_path )
 
         # cleanup excludes which are defined as 'subdirectories'
         for e in self._excludes:
             if '/' in e:
                 exclude_obj = os.path.normpath( os.path.join( snapshot_path, e ))
-                if os.path.exists( exclude_obj ) or os.path.islink( exclude_obj ):
+                if self._fs.exists( exclude_obj ) or self._fs.islink( exclude_obj ):
                     self.logger.debug('excluding (deleting) object [%s]', exclude_obj)
-                    subprocess.check_call(['rm', '-rf', exclude_obj ])
+                    self._fs.remove_tree( exclude_obj )
                 else:
                     self.logger.warning(
                         'trying to exclude (delete) unexisting object [%s]', exclude_obj)
@@ -393,50 +919,144 @@ class Timeline:
     def _snapshot_find_and_copy_objects( self, source_path, snapshot_path ):
         """ helper method which first removes and afterwards copies
             (instead of just hard-linking) a list of files/directories
+
+            files matching immutable_files_recursive stay hard-linked
         """
 
+        is_immutable = immutable.compile_rules( self._immutable_files_recursive )
+
         if self._copy_dirs_recursive:
-            # generate a find cmd with list of dirs to be copied
-            # e.g. find /tmp/foo -type d -name repodata -o -name repoview -o -name bar
-            find_cmd = ['find', snapshot_path, '-type', 'd', '-name', self._copy_dirs_recursive[0]]
-            for i in self._copy_dirs_recursive[1:]:
-                find_cmd.extend( ['-o', '-name', i] )
-
-            # FIXME cannot use this because python version is too old...
-            #cdirs = subprocess.check_output( find_cmd ).split()
-            cdirs = subprocess.Popen( find_cmd, stdout=subprocess.PIPE, encoding='utf-8').communicate()[0].split()
+            cdirs = self._fs.find( snapshot_path, self._copy_dirs_recursive, filesystem.DIR )
+            copied = kept = 0
             for cdir in cdirs:
-                subprocess.check_call(['rm', '-rf', cdir ])
                 rel_path = os.path.relpath( cdir, snapshot_path)
+                if is_immutable:
+                    # nested matches have been handled with the enclosing directory
+                    if any( cdir.startswith( d + os.sep ) for d in cdirs ):
+                        continue
+                    self.logger.debug(
+                        'copying mutable files of directory [%s] to [%s]', os.path.join(source_path, rel_path), cdir)
+                    c, k = immutable.copy_mutable_files(
+                        self._fs, os.path.join(source_path, rel_path), cdir, rel_path, is_immutable )
+                    copied += c
+                    kept += k
+                    continue
+                self._fs.remove_tree( cdir )
                 self.logger.debug(
                     'copying directory [%s] to [%s]', os.path.join(source_path, rel_path), cdir)
-                subprocess.check_call(['cp', '-a', os.path.join(source_path, rel_path), cdir ])
+                self._fs.copy_tree( os.path.join(source_path, rel_path), cdir )
+            if is_immutable:
+                self.logger.info(
+                    'copied directories: [%s] files copied, [%s] content-addressed files left hard-linked', copied, kept)
 
         if self._copy_files_recursive:
-            # generate a find cmd with list of files to be copied
-            # e.g. find /tmp/foo -type f -name Release -o -name Release.gpg ...
-            find_cmd = ['find', snapshot_path, '-type', 'f', '-name', self._copy_files_recursive[0]]
-            for i in self._copy_files_recursive[1:]:
-                find_cmd.extend( ['-o', '-name', i] )
-
-            # FIXME cannot use this because python version is too old...
-            #cfiles = subprocess.check_output( find_cmd ).split()
-            cfiles = subprocess.Popen( find_cmd, stdout=subprocess.PIPE, encoding='utf-8').communicate()[0].split()
+            cfiles = self._fs.find( snapshot_path, self._copy_files_recursive, filesystem.FILE )
             for cfile in cfiles:
-                subprocess.check_call(['rm', '-f', cfile ])
                 rel_path = os.path.relpath( cfile, snapshot_path)
+                if is_immutable and is_immutable( rel_path ):
+                    continue
+                self._fs.remove( cfile )
                 self.logger.debug('copying file [%s] to [%s]', os.path.join(source_path, rel_path), cfile)
-                subprocess.check_call(['cp', '-a', os.path.join(source_path, rel_path), cfile ])
+                self._fs.copy_tree( os.path.join(source_path, rel_path), cfile )
+
+
+    def _snapshot_pool( self, snapshot ):
+        """ helper method which deduplicates the files of a new snapshot against the content pool """
+
+        self.logger.info('deduplicating snapshot [%s] against the content pool [%s]', snapshot, self._pool_path)
+        content_pool = pool.ContentPool( self._pool_path )
+        try:
+            stats = content_pool.add( self._snapshots[ snapshot ].path, self._pool_patterns )
+        finally:
+            content_pool.close()
+        self.logger.info(
+            'content pool: [%s] files, [%s] already pooled, [%s] linked to pooled files ([%s] bytes), [%s] added, '
+            '[%s] hashed ([%s] bytes) in [%.1f] seconds', stats.files, stats.pooled, stats.linked, stats.linked_bytes,
+            stats.added, stats.hashed, stats.hashed_bytes, stats.seconds)
+        return stats
+
+
+    def _snapshot_digests( self, snapshot ):
+        """ helper method which records the directory digests of a new snapshot """
+
+        start = time.time()
+        tree = merkle.digests( self._snapshots[ snapshot ].path, self._copied_file_matcher(), self._digests_skip() )
+        merkle.write_index( self._digests_index( snapshot ), tree )
+        self.logger.info('recorded the digests of [%s] directories of snapshot [%s] in [%.1f] seconds',
+                         len( tree ), snapshot, time.time() - start)
+
+
+    def _snapshot_render_listings( self, snapshot, previous ):
+        """ helper method which writes the directory listings of a new snapshot, reusing those of the previous one """
+
+        previous_path = self._snapshots[ previous ].path if previous in self._snapshots else None
+        stats = listing.write_listings( self._snapshots[ snapshot ].path, previous_path )
+        self.logger.info(
+            'directory listings of snapshot [%s]: [%s] directories, [%s] rendered, [%s] reused, [%s] skipped in [%.1f] seconds',
+            snapshot, stats.dirs, stats.rendered, stats.reused, stats.skipped, stats.seconds)
+        return stats
+
+
+    def collect_pool( self, inodes=None ):
+        """ removes the files of the content pool which are not linked from any snapshot or source anymore
+
+                inodes: only check the pooled files with these inode numbers (e.g. of deleted snapshots),
+                all pooled files if None. failures are logged but do not affect the timeline
+
+                returns (files, bytes) removed
+        """
+
+        if not self._pool_path:
+            raise Exception( 'no content pool configured, set pool_path in [{0}]'.format( self._cfgfile ))
+        try:
+            content_pool = pool.ContentPool( self._pool_path )
+            try:
+                removed, removed_bytes = content_pool.collect( inodes )
+            finally:
+                content_pool.close()
+        except Exception as e:
+            self.logger.warning('cannot collect the garbage of the content pool [%s]: %s', self._pool_path, e)
+            return 0, 0
+        if removed:
+            self.logger.info('removed [%s] files ([%s] bytes) from the content pool', removed, removed_bytes)
+        return removed, removed_bytes
+
+
+    def _snapshot_validate( self, snapshot ):
+        """ helper method which validates the repository metadata of the given snapshot
+
+                the snapshot is deleted again if the validation fails, i.e. links never move to it
+        """
+
+        self.logger.info('validating repository metadata of snapshot [%s]', snapshot)
+
+        result = repository.validate( self._snapshots[ snapshot ].path )
+        self._snapshots[ snapshot ].validation = result.as_dict()
+
+        self.logger.info(
+            'validated [%s] files ([%s] bytes) referenced by [%s] metadata files in [%.1f] seconds',
+            result.checked, result.checked_bytes, len( result.metadata_files ), result.seconds)
+
+        if not result.valid:
+            for error in result.errors:
+                self.logger.error( error )
+            seq = self._snapshots[ snapshot ].seq
+            self.delete_snapshot( snapshot )
+            # the rejected snapshot does not consume a generation
+            if seq == self._seq:
+                self._seq -= 1
+                self.save()
+            raise Exception( 'snapshot [{0}] failed the repository metadata validation ({1} errors), links have not been updated'.format( snapshot, len( result.errors )))
+
+        self.save()
 
 
-    def _snapshot_generate_diff_report( self ):
+    def _snapshot_generate_diff_report( self, current_snapshot, previous_snapshot ):
         """ helper method for generating a diff report from the current snapshot
-            to the previous snapshot
+            to the previous snapshot, returns the report file (None if diff reports are disabled)
         """
 
-        if len( self._lsnapshots ) > 1 and self._diff_log_path :
-            current_snapshot = self._lsnapshots[-1]
-            previous_snapshot = self._lsnapshots[-2]
+        if self._diff_log_path :
             self.logger.info(
                 'generating diff report from snapshots [%s] -> [%s]',
                 current_snapshot, previous_snapshot)
@@ -447,16 +1067,33 @@ class Timeline:
             if not os.path.exists( self._diff_log_path ):
                 os.makedirs( self._diff_log_path )
 
-            cmd = ['diff', '-r', '-q', '-X', self._cfgfile_diff, self._snapshots[ current_snapshot ][ 'path' ], self._snapshots[ previous_snapshot ][ 'path' ] ]
+            cmd = ['diff', '-r', '-q', '-X', self._cfgfile_diff, self._snapshots[ current_snapshot ].path, self._snapshots[ previous_snapshot ].path ]
+            if self._render_listings:
+                # the listings follow the directory contents
+                cmd[3:3] = [ arg for name in listing.NAMES for arg in ( '-x', name ) ]
             stdout_file = '{0}__{1}__{2}{3}'.format(os.path.join(self._diff_log_path, self._name), current_snapshot, previous_snapshot, self._difflog_ext)
             with open(stdout_file, "w") as outfile:
                 subprocess.call( cmd, stdout=outfile, stderr=subprocess.STDOUT )
 
-            self._snapshots[current_snapshot]['diff_log_file'] = stdout_file
+            self._snapshots[current_snapshot].diff_log_file = stdout_file
 
             self.logger.debug('generated diff log file [%s]', stdout_file)
 
+            index = history.HistoryIndex( os.path.join( self._destination, self._index_file ))
+            try:
+                count = index.add_report(
+                    stdout_file, self._snapshots[ current_snapshot ].seq, current_snapshot, previous_snapshot,
+                    self._snapshots[ current_snapshot ].path, self._snapshots[ previous_snapshot ].path )
+                self.logger.info('added [%s] changes of snapshot [%s] to the path history', count, current_snapshot)
+            except Exception as e:
+                self.logger.warning('cannot add diff report [%s] to the path history: %s', stdout_file, e)
+            finally:
+                index.close()
 
+            return stdout_file
+
+
+    @_operation
     def create_named_snapshot( self, snapshot, source_snapshot=None ):
         """ creates a named snapshot from the source directory
 
@@ -473,7 +1110,7 @@ class Timeline:
         if source_snapshot:
             self.logger.info('using source snapshot [%s]', source_snapshot)
             self._valid_snapshot( source_snapshot )
-            source_path = self._snapshots[source_snapshot]['path']
+            source_path = self._snapshots[source_snapshot].path
         else:
             source_path = self._source
 
@@ -492,12 +1129,44 @@ class Timeline:
         self.logger.debug('created new snapshot [%s]', snapshot)
 
 
-    def create_snapshot( self, random_sleep_before_snapshot=None, sleep_after_snapshot=None ):
+    def wait_for_sync( self, marker=None, quiet_period=60, timeout=None ):
+        """ waits until the source directory has been synchronized since the last snapshot
+
+                marker:         file (relative to the source directory) which is updated by the sync job when
+                                it is done. without marker the sync is considered complete when the repository
+                                metadata (copy_dirs_recursive/copy_files_recursive) changed and has not changed
+                                for <quiet_period> seconds
+
+                returns False if no sync completed within <timeout> seconds
+        """
+
+        since = 0.0
+        if self._lsnapshots:
+            since = self._snapshots[ self._lsnapshots[-1] ].created.timestamp()
+
+        if marker:
+            marker = os.path.join( self._source, marker )
+            self.logger.info('waiting for sync marker [%s]', marker)
+        else:
+            self.logger.info('waiting for the repository metadata in [%s] to settle for [%s] seconds', self._source, quiet_period)
+
+        return watch.wait_for_sync(
+            self._source, self._copy_dirs_recursive, self._copy_files_recursive, since,
+            marker=marker, quiet_period=quiet_period, timeout=timeout )
+
+
+    @_operation
+    def create_snapshot( self, random_sleep_before_snapshot=None, sleep_after_snapshot=None,
+                         wait_for_sync=False, sync_marker=None, quiet_period=60, sync_timeout=None ):
         """ creates a new snapshot from the source directory
 
                 no action is taken if the timeline has been frozen!
 
                 the oldest snapshot is removed when <max_snapshots> is reached
+
+                with <wait_for_sync> the snapshot is taken as soon as the source has been synchronized,
+                see wait_for_sync(). returns None without taking a snapshot if the sync did not complete
+                within <sync_timeout> seconds
         """
 
         if random_sleep_before_snapshot:
@@ -505,6 +1174,12 @@ class Timeline:
             self.logger.info('sleeping [%s] seconds before taking a new snapshot', sleep_time)
             time.sleep( sleep_time )
 
+        if wait_for_sync or sync_marker:
+            self._check_frozen()
+            if not self.wait_for_sync( sync_marker, quiet_period, sync_timeout ):
+                self.logger.warning('source has not been synchronized, no snapshot taken')
+                return None
+
         now = datetime.now()
 
         snapshot = now.strftime("%Y.%m.%d-%H%M%S")
@@ -516,31 +1191,234 @@ class Timeline:
         self.logger.info('creating new snapshot [%s]', snapshot)
 
         self._check_frozen()
+        start = time.time()
 
         if snapshot in self._lsnapshots:
             raise Exception( 'snapshot [{0}] already exists!'.format( snapshot ))
 
         # create new snapshot
         snapshot_path = os.path.join( self._destination, snapshot )
-        self._snapshots[snapshot] = { 'created' : now, 'path': snapshot_path, 'links' : [] }
+        self._seq += 1
+        self._snapshots[snapshot] = Snapshot( created=now, path=snapshot_path, links=[], seq=self._seq )
         self._lsnapshots.append( snapshot )
         self.save()
 
+        previous = self._lsnapshots[-2] if len( self._lsnapshots ) > 1 else None
+
         # make changes in the file system
         self._snapshot_copy_by_hardlink( self._source, snapshot_path )
         self._snapshot_find_and_copy_objects( self._source, snapshot_path )
-        self._snapshot_generate_diff_report()
+        # the following steps read the content of the snapshot, they need a backend on disk.
+        # the listings are part of the published snapshot and a snapshot failing the validation is never
+        # published, everything else runs in the pipeline
+        content = self._fs.on_disk
+        if content and self._render_listings:
+            self._snapshot_render_listings( snapshot, previous )
+        if content and self._validate_metadata:
+            self._snapshot_validate( snapshot )
 
         # delete old snapshots and handle links...
         self.rotate_snapshots()
 
+        # build time, used by the scheduler to plan the next runs
+        if snapshot in self._snapshots:
+            self._snapshots[ snapshot ].duration = round( time.time() - start, 3 )
+            self.save()
+
+            # digests, content pool, diff report, checksums and indexes once the links are published
+            if content:
+                self._queue_pipeline( snapshot, previous )
+
         self.logger.debug('created new snapshot [%s]', snapshot)
 
         if sleep_after_snapshot:
             self.logger.info('sleeping for [%s] seconds', sleep_after_snapshot)
             time.sleep( sleep_after_snapshot )
 
+        return snapshot
+
+
+    def _queue_pipeline( self, snapshot, previous ):
+        """ helper method to queue the post-snapshot pipeline of a new snapshot and to start running it """
+
+        stages = []
+        if self._directory_digests:
+            stages.append( 'digests' )
+        if self._pool_path:
+            stages.append( 'pool' )
+        if self._diff_log_path and previous:
+            stages += [ 'diff', 'metrics' ]
+        if self._record_checksums:
+            stages.append( 'checksums' )
+        if self._package_index:
+            stages.append( 'index' )
+        if self._learn_copy_rules:
+            learner = learn.Learner( self._destination )
+            try:
+                if learner.observations < self._learn_copy_rules:
+                    stages.append( 'learn' )
+            finally:
+                learner.close()
+        if not stages:
+            return
+
+        pipeline.Queue( self._destination ).enqueue( snapshot, self._snapshots[ snapshot ].seq, stages, previous=previous )
+        if self._pipeline == 'inline':
+            self.run_pipeline( wait=False )
+        else:
+            try:
+                pipeline.spawn( self._destination, self._pipeline_jobs )
+            except OSError as e:
+                self.logger.warning('cannot start the pipeline runner, run \'mrepo pipeline run\': %s', e)
+
+
+    def run_pipeline( self, jobs=None, wait=True ):
+        """ runs the queued post-snapshot pipeline jobs of this timeline until the queue is empty
+
+                this instance runs the jobs one by one. otherwise (<jobs> given, used by 'mrepo pipeline run')
+                every job runs with a freshly loaded timeline in a pool of <jobs> threads and its results are
+                stored with _locked_update(), so the runner can work alongside other mrepo commands.
+                with <wait> failed jobs are retried after their delay, otherwise they are left in the queue
+
+                returns (jobs done, jobs failed)
+        """
 
+        if jobs is None:
+            def commit( snapshot, updates ):
+                for key, value in updates.items():
+                    setattr( self._snapshots[ snapshot ], key, value )
+                self.save()
+            runner = pipeline.Runner( self._destination, lambda: self, commit, jobs=1 )
+        else:
+            commit_lock = threading.Lock()
+            def commit( snapshot, updates ):
+                with commit_lock:
+                    self._locked_update( snapshot, updates )
+            runner = pipeline.Runner( self._destination, lambda: Timeline.load( self._destination ), commit, jobs=jobs )
+
+        done = failed = 0
+        while True:
+            with pipeline.runner_lock( self._destination ) as acquired:
+                if not acquired:
+                    self.logger.info('the pipeline of [%s] is run by another process', self._destination)
+                    break
+                d, f = runner.run( wait=wait )
+                done, failed = done + d, failed + f
+            # jobs queued while this runner was finishing are not picked up by another one
+            if runner.queue.next_attempt() != 0:
+                break
+        return done, failed
+
+
+    def _locked_update( self, snapshot, updates ):
+        """ helper method to store fields of a snapshot in the metadata file while other mrepo commands may be
+            working on the timeline
+
+                the stored state is read and written under the state lock, which every save() takes as well.
+                instances which loaded the state before keep these fields when they save (see _pipeline_fields)
+        """
+
+        with self._state_lock():
+            d = self.read_metadata( self._destination )
+            if snapshot not in d[ '_snapshots' ]:
+                self.logger.info('snapshot [%s] has been deleted, results are dropped', snapshot)
+                return
+            d[ '_snapshots' ][ snapshot ].update( updates )
+            self._write_state( d )
+
+
+    def run_pipeline_stage( self, stage, snapshot, previous=None ):
+        """ runs a single stage of the post-snapshot pipeline (see timeline.pipeline) for a snapshot
+
+                returns the fields of the snapshot to store (None if there are none)
+        """
+
+        self._valid_snapshot( snapshot )
+
+        if stage == 'digests':
+            self._snapshot_digests( snapshot )
+            return None
+
+        if stage == 'pool':
+            self._snapshot_pool( snapshot )
+            return None
+
+        if stage == 'diff':
+            if previous not in self._snapshots:
+                self.logger.warning('previous snapshot [%s] has been deleted, no diff report for [%s]', previous, snapshot)
+                return None
+            report = self._snapshot_generate_diff_report( snapshot, previous )
+            return { 'diff_log_file' : report } if report else None
+
+        if stage == 'checksums':
+            self.record_checksums( snapshot )
+            return None
+
+        if stage == 'index':
+            self.index_packages( [ snapshot ] )
+            return None
+
+        if stage == 'metrics':
+            report = self._snapshots[ snapshot ].diff_log_file
+            if not report or not os.path.exists( report ):
+                return None
+            metrics = { history.ADDED : 0, history.REMOVED : 0, history.MODIFIED : 0 }
+            with open( report, errors='replace' ) as fh:
+                for _, change in history.parse_diff_report(
+                        fh, self._snapshots[ snapshot ].path, os.path.join( self._destination, previous )):
+                    metrics[ change ] += 1
+            self.logger.info('snapshot [%s]: [%s] added, [%s] removed, [%s] modified', snapshot,
+                             metrics[ history.ADDED ], metrics[ history.REMOVED ], metrics[ history.MODIFIED ])
+            return { 'metrics' : metrics }
+
+        if stage == 'learn':
+            learner = learn.Learner( self._destination )
+            try:
+                if learner.observations >= self._learn_copy_rules:
+                    return None
+                learner.observe( self._source, self._excludes )
+                if learner.observations < self._learn_copy_rules:
+                    return None
+            finally:
+                learner.close()
+            suggestion = self.learn_copy_rules( apply=self._learn_copy_rules_apply )
+            for line in suggestion.describe():
+                self.logger.info('learned copy rules: %s', line)
+            return None
+
+        raise Exception( 'unknown pipeline stage [{0}]'.format( stage ))
+
+
+    def learn_copy_rules( self, apply=False, reset=False ):
+        """ returns the copy rules learned from the observations of the source as a learn.Suggestion
+
+                apply:  write the learned rules into the configuration file (once enough snapshots were observed)
+                reset:  drop the observations and start learning again
+        """
+
+        learner = learn.Learner( self._destination )
+        try:
+            if reset:
+                learner.reset()
+            suggestion = learner.suggest( self._copy_dirs_recursive, self._copy_files_recursive,
+                                          immutable.compile_rules( self._immutable_files_recursive ))
+            if apply:
+                if suggestion.observations < 2:
+                    raise Exception( 'the source has to be observed at least twice before copy rules can be learned' )
+                self.logger.info('applying the learned copy rules, copy_dirs_recursive = [%s], copy_files_recursive = [%s]',
+                                 ':'.join( suggestion.copy_dirs ), ':'.join( suggestion.copy_files ))
+                self._copy_dirs_recursive = list( suggestion.copy_dirs )
+                self._copy_files_recursive = list( suggestion.copy_files )
+                # the excludes of the diff cmd are generated from the copy rules
+                if os.path.exists( self._cfgfile_diff ):
+                    os.remove( self._cfgfile_diff )
+                self._save_cfgfile()
+        finally:
+            learner.close()
+        return suggestion
+
+
+    @_operation
     def delete_snapshot( self, snapshot ):
         """ deletes the given snapshot and handles links appropriately
 
@@ -553,7 +1431,7 @@ class Timeline:
         self._valid_snapshot( snapshot, fail_on_disk_check=False )
 
         # handle links
-        snapshot_links = self._snapshots[ snapshot ][ 'links' ][:]
+        snapshot_links = self._snapshots[ snapshot ].links[:]
         for link in snapshot_links:
             # if we are deleting the last snapshot we should also delete the links
             if len( self._lsnapshots ) == 1:
@@ -566,16 +1444,25 @@ class Timeline:
         self.save()
 
         # make changes in the file system
-        subprocess.check_call(['rm', '-rf', deleted_snapshot['path'] ])
-        if 'diff_log_file' in deleted_snapshot:
-            self.logger.debug('deleting diff log file [%s]', deleted_snapshot['diff_log_file'])
-            subprocess.check_call(['rm', '-f', deleted_snapshot['diff_log_file'] ])
+        # inodes of the removed files, pooled ones may only be held by the pool afterwards
+        pooled = set() if self._pool_path else None
+        self._remove_path( deleted_snapshot.path, pooled )
+        if pooled:
+            self.collect_pool( pooled )
+        if deleted_snapshot.diff_log_file:
+            self.logger.debug('deleting diff log file [%s]', deleted_snapshot.diff_log_file)
+            self._remove_path( deleted_snapshot.diff_log_file )
+        for path in ( self._checksums_manifest( snapshot ), self._digests_index( snapshot )):
+            if os.path.exists( path ):
+                self.logger.debug('deleting [%s]', path)
+                self._remove_path( path )
 
         self.logger.debug( 'deleted snapshot [{0}] [{1}]'.format( snapshot, deleted_snapshot ))
 
         return deleted_snapshot
 
 
+    @_operation
     def create_link( self, link, snapshot=None, max_offset=0, warn_before_max_offset=0 ):
         """ creates a new symbolic link to the given snapshot into the destination directory
 
@@ -612,16 +1499,17 @@ class Timeline:
                     self._get_snapshot_offset( snapshot ), max_offset)
 
         link_path = os.path.join( self._destination, link )
-        self._links[ link ] = { 'created' : datetime.now(), 'snapshot' : snapshot, 'path' : link_path, 'max_offset' : max_offset, 'warn_before_max_offset' : warn_before_max_offset }
-        self._snapshots[ snapshot ][ 'links' ].append(link)
+        self._links[ link ] = Link( created=datetime.now(), snapshot=snapshot, path=link_path, max_offset=max_offset, warn_before_max_offset=warn_before_max_offset )
+        self._snapshots[ snapshot ].links.append(link)
         self.save()
 
         # make changes in the file system
-        subprocess.check_call(['ln', '-s', snapshot, link_path ])
+        self._fs.symlink( snapshot, link_path )
 
         self.logger.debug('created new link [%s] to snapshot [%s]', link, snapshot)
 
 
+    @_operation
     def delete_link( self, link ):
         """ deletes the given link
 
@@ -634,20 +1522,22 @@ class Timeline:
         self._valid_link( link, fail_on_disk_check=False )
 
         # remove link from snapshot
-        snapshot = self._links[ link ][ 'snapshot' ]
-        self._snapshots[ snapshot ][ 'links' ].remove( link )
+        snapshot = self._links[ link ].snapshot
+        self._snapshots[ snapshot ].links.remove( link )
 
         deleted_link = self._links.pop(link)
         self.save()
 
         # make changes in the file system
-        subprocess.check_call(['rm', '-f', deleted_link['path'] ])
+        self._fs.remove( deleted_link.path )
+        self._forget( deleted_link.path )
 
         self.logger.debug('deleted link [%s] [%s]', link, deleted_link)
 
         return deleted_link
 
 
+    @_operation
     def update_link( self, link, snapshot=None ):
         """ updates link to point to the given snapshot
 
@@ -665,66 +1555,801 @@ class Timeline:
         self._valid_link( link )
         self._valid_snapshot( snapshot )
 
-        if snapshot == self._links[ link ][ 'snapshot' ]:
+        if snapshot == self._links[ link ].snapshot:
             self.logger.warning('link [%s] already points to snapshot [%s]!', link, snapshot)
 
-        if self._links[ link ][ 'max_offset' ]:
-            if self._get_snapshot_offset( snapshot ) > self._links[ link ][ 'max_offset' ]:
+        if self._links[ link ].max_offset:
+            if self._get_snapshot_offset( snapshot ) > self._links[ link ].max_offset:
                 self.logger.warning(
                     'updating link to snapshot with offset [%s] which lies beyond specified max_offset [%s]!',
-                    self._get_snapshot_offset( snapshot ), self._links[ link ][ 'max_offset' ])
+                    self._get_snapshot_offset( snapshot ), self._links[ link ].max_offset)
 
         # remove link from old snapshot
-        old_snapshot = self._links[ link ][ 'snapshot' ]
-        self._snapshots[ old_snapshot ][ 'links' ].remove( link )
+        old_snapshot = self._links[ link ].snapshot
+        self._snapshots[ old_snapshot ].links.remove( link )
 
         # add link to new snapshot
-        self._snapshots[ snapshot ][ 'links' ].append(link)
+        self._snapshots[ snapshot ].links.append(link)
 
         # finally update link to point to the new snapshot
-        self._links[ link ][ 'snapshot' ] = snapshot
+        self._links[ link ].snapshot = snapshot
 
         self.save()
 
         # make changes in the file system
-        subprocess.check_call(['ln', '-snf', snapshot, self._links[ link ][ 'path' ] ])
+        self._fs.symlink( snapshot, self._links[ link ].path, replace=True )
 
         self.logger.info('updated link [%s] to snapshot [%s]', link, snapshot)
 
 
-    def rotate_snapshots( self ):
-        """ rotate snapshots, i.e. delete old snapshots until max_snapshots are reached
+    @_operation
+    def rotate_snapshots( self, jobs=8 ):
+        """ rotate snapshots, i.e. delete old snapshots until max_snapshots are reached, move links pinned
+            beyond their <max_offset> and thin out snapshots according to the retention policy
+
+                the final state is computed in one step (see _plan_rotation()) and committed by a single save,
+                links are moved to their final snapshot once and the deleted snapshots are removed by <jobs>
+                parallel workers. paths which have not been removed yet are kept in the metadata, an
+                interrupted removal is resumed by the next rotation
+
+                returns the planner.RunPlan
+        """
+
+        self._remove_pending_deletions( jobs )
+
+        plan = planner.RunPlan()
+        self._copy_state()._plan_rotation( plan )
+        if not ( plan.delete_snapshots or plan.move_links or plan.drop_links ):
+            return plan
+
+        self._check_frozen()
+
+        # metadata: the final state, committed by a single save
+        for snapshot in plan.delete_snapshots:
+            self.logger.info( 'deleting snapshot [%s]', snapshot)
+            self._lsnapshots.remove( snapshot )
+            deleted_snapshot = self._snapshots.pop( snapshot )
+            if snapshot in plan.thinned_snapshots:
+                self._thinned.append( deleted_snapshot.seq )
+            self._pending_deletions.append( deleted_snapshot.path )
+            if deleted_snapshot.diff_log_file:
+                self._pending_deletions.append( deleted_snapshot.diff_log_file )
+            manifest = self._checksums_manifest( snapshot )
+            if os.path.exists( manifest ):
+                self._pending_deletions.append( manifest )
+            index = self._digests_index( snapshot )
+            if os.path.exists( index ):
+                self._pending_deletions.append( index )
+
+        for link in plan.drop_links:
+            self.logger.info('deleting link [%s]', link)
+            self._pending_deletions.append( self._links.pop( link ).path )
+
+        # thinned out snapshots older than the oldest snapshot do not count for any offset
+        if self._lsnapshots:
+            oldest = self._snapshots[ self._lsnapshots[0] ].seq
+            self._thinned = [ s for s in self._thinned if s > oldest ]
+
+        for link, ( old_snapshot, snapshot ) in sorted( plan.move_links.items() ):
+            self.logger.info('updating link [%s] to snapshot [%s]', link, snapshot)
+            if old_snapshot in self._snapshots:
+                self._snapshots[ old_snapshot ].links.remove( link )
+            self._snapshots[ snapshot ].links.append( link )
+            self._links[ link ].snapshot = snapshot
+
+        self.save()
+
+        # file system: atomically replace the moved links, remove the deleted snapshots in parallel
+        for link in sorted( plan.move_links ):
+            l = self._links[ link ]
+            self._fs.symlink( l.snapshot, l.path, replace=True )
+
+        self._remove_pending_deletions( jobs )
+
+        return plan
+
+
+    def _remove_pending_deletions( self, jobs=8 ):
+        """ helper method which removes the paths of deleted snapshots with <jobs> parallel workers
 
-                links are handled appropriately
+                removed paths are dropped from the metadata, which is saved every <_pending_save_interval>
+                seconds and at the end, so an interrupted removal is resumed from the last save (paths
+                removed since then are removed again, i.e. nothing is done for them)
         """
 
-        # remove oldest snapshot(s)
-        while len(self._lsnapshots) > self._max_snapshots:
-            self.delete_snapshot( self._lsnapshots[0] )
+        if not self._pending_deletions:
+            return
+
+        total = len( self._pending_deletions )
+        start = time.time()
+        self.logger.info('removing [%s] paths of deleted snapshots', total)
+
+        # inodes of the removed files, pooled ones may only be held by the pool afterwards
+        pooled = set() if self._pool_path else None
+
+        def remove( path ):
+            self._remove_path( path, pooled )
+            return path
+
+        saved, unsaved = time.time(), 0
+        try:
+            with concurrent.futures.ThreadPoolExecutor( max_workers=jobs ) as executor:
+                futures = [ executor.submit( remove, path ) for path in list( self._pending_deletions ) ]
+                for n, future in enumerate( concurrent.futures.as_completed( futures ), 1 ):
+                    path = future.result()
+                    self._pending_deletions.remove( path )
+                    unsaved += 1
+                    self.logger.info('removed [%s] (%s/%s, %.1f seconds)', path, n, total, time.time() - start)
+                    if time.time() - saved >= self._pending_save_interval:
+                        self._save_state()
+                        saved, unsaved = time.time(), 0
+        finally:
+            if unsaved:
+                self._save_state()
+
+        if pooled:
+            self.collect_pool( pooled )
+
+
+    def _copy_state( self ):
+        """ helper method which returns a copy of the timeline whose snapshots and links can be changed freely """
+
+        sim = copy.copy( self )
+        sim._snapshots = { s : v.copy() for s, v in self._snapshots.items() }
+        sim._lsnapshots = SnapshotList( self._lsnapshots )
+        sim._links = { lk : v.copy() for lk, v in self._links.items() }
+        sim._thinned = list( self._thinned )
+        return sim
+
+
+    @_operation
+    def plan( self, create_snapshot=False, max_snapshots=None, excludes=None ):
+        """ returns a planner.RunPlan with the operations and costs of creating a snapshot and/or changing
+            max_snapshots or the excludes, without changing anything
+
+                the source is scanned when a snapshot is created or the excludes change, the rotation is
+                simulated on a copy of the timeline state
+        """
+
+        plan = planner.RunPlan()
+        plan.create_snapshot = create_snapshot
+
+        # validate the planned values with the setters, on a copy
+        sim = self._copy_state()
+        if max_snapshots is not None:
+            sim.set_max_snapshots( max_snapshots )
+            plan.max_snapshots = max_snapshots
+        if excludes is not None:
+            sim.set_excludes( excludes )
+            plan.changes_excludes = sim._excludes != self._excludes
+
+        if create_snapshot or plan.changes_excludes:
+            plan.scan = planner.scan_source(
+                self._source, self._excludes, sim._excludes, self._copy_dirs_recursive, self._copy_files_recursive,
+                self._immutable_files_recursive )
+            i = 1 if plan.changes_excludes else 0
+            plan.space = plan.scan.copy_bytes[ i ] + plan.scan.dir_bytes[ i ]
+            plan.recorded_duration = planner.recorded_duration(
+                self._snapshots[ s ].duration for s in self._lsnapshots )
+            if plan.recorded_duration is not None:
+                plan.duration = plan.recorded_duration
+                if plan.changes_excludes and plan.scan.entries[0]:
+                    plan.duration *= plan.scan.entries[1] / plan.scan.entries[0]
+
+        if create_snapshot:
+            sim._seq += 1
+            snapshot = datetime.now().strftime("%Y.%m.%d-%H%M%S")
+            sim._snapshots[ snapshot ] = Snapshot( created=datetime.now(), path=None, links=[], seq=sim._seq )
+            sim._lsnapshots.append( snapshot )
+
+        sim._plan_rotation( plan )
+
+        plan.freed_bytes, plan.freed_inodes = planner.freed_space(
+            [ self._snapshots[ s ].path for s in plan.delete_snapshots ] )
+
+        return plan
+
+
+    def _plan_rotation( self, plan ):
+        """ simulates rotate_snapshots() on the (copied) state, recording the changes in plan
+
+                the planned snapshot does not exist on disk, so the helpers validating snapshots are not used
+        """
+
+        def neighbour( snapshot ):
+            i = self._lsnapshots.index( snapshot )
+            return self._lsnapshots[ i + 1 if i < len( self._lsnapshots ) - 1 else max( 0, i - 1 ) ]
+
+        def move( lk, snapshot ):
+            current = self._links[ lk ].snapshot
+            self._snapshots[ current ].links.remove( lk )
+            self._snapshots[ snapshot ].links.append( lk )
+            self._links[ lk ].snapshot = snapshot
+            plan.move_links[ lk ] = ( plan.move_links.get( lk, ( current, ))[0], snapshot )
+
+        def delete( snapshot, thinned=False ):
+            for lk in list( self._snapshots[ snapshot ].links ):
+                if len( self._lsnapshots ) == 1:
+                    self._links.pop( lk )
+                    plan.move_links.pop( lk, None )
+                    plan.drop_links.append( lk )
+                else:
+                    move( lk, neighbour( snapshot ))
+            self._lsnapshots.remove( snapshot )
+            seq = self._snapshots.pop( snapshot ).seq
+            plan.delete_snapshots.append( snapshot )
+            if thinned:
+                self._thinned.append( seq )
+                plan.thinned_snapshots.append( snapshot )
+
+        while len( self._lsnapshots ) > self._max_snapshots:
+            delete( self._lsnapshots[0] )
 
-        # update all links to be kept pinned within their <max_offset>
         for lk, link in self._links.items():
-            if link[ 'max_offset' ]:
-                if self._get_snapshot_offset(link[ 'snapshot' ]) > link[ 'max_offset' ]:
-                    #self.update_link( lk, self._get_neighbour_snapshot( link[ 'snapshot' ] ))
-                    self.update_link( lk, self._lsnapshots[-link[ 'max_offset' ]] )
+            if link.max_offset and self._offset( link.snapshot ) > link.max_offset:
+                move( lk, self._get_oldest_snapshot_within( link.max_offset ))
 
+        if self._keep_daily or self._keep_weekly or self._keep_monthly:
+            keep = self._retention_keep()
+            for snapshot in [ s for s in self._lsnapshots if s not in keep ]:
+                delete( snapshot, thinned=True )
 
-    def consistency_check( self ):
-        """ looks for missing snapshots and missing links and fixes metadata appropriately """
+        for lk, ( current, snapshot ) in list( plan.move_links.items() ):
+            if current == snapshot:
+                del plan.move_links[ lk ]
 
-        self.logger.info( 'checking links...' )
-        for link in self._links.keys():
-            if not self._valid_link( link, fail_on_disk_check=False ):
-                self.logger.warning('deleting invalid link [%s]', self._links[link]['path'])
-                self.delete_link( link )
 
-        self.logger.info( 'checking snapshots...' )
-        for snapshot in self._lsnapshots:
-            if not self._valid_snapshot( snapshot, fail_on_disk_check=False ):
-                self.logger.warning(
-                    'deleting invalid snapshot [%s]', self._snapshots[snapshot]['path'])
-                self.delete_snapshot( snapshot )
+    def _retention_keep( self ):
+        """ returns the set of snapshots to keep according to the retention policy """
+
+        keep = set( self._lsnapshots[-1:] )
+
+        periods = (
+            ( self._keep_daily, lambda created: created.date() ),
+            ( self._keep_weekly, lambda created: created.isocalendar()[:2] ),
+            ( self._keep_monthly, lambda created: ( created.year, created.month )),
+        )
+        for count, period in periods:
+            seen = set()
+            for snapshot in reversed( self._lsnapshots ):
+                if len( seen ) >= count:
+                    break
+                key = period( self._snapshots[ snapshot ].created )
+                if key not in seen:
+                    # newest snapshot of the period
+                    seen.add( key )
+                    keep.add( snapshot )
+
+        for link in self._links.values():
+            keep.add( link.snapshot )
+            # the snapshot a max_offset link moves to when the next snapshot is created
+            if link.max_offset > 1:
+                keep.add( self._get_oldest_snapshot_within( link.max_offset - 1 ))
+
+        return keep
+
+
+    @_operation
+    def consistency_check( self, dry_run=False, jobs=8 ):
+        """ looks for missing snapshots, missing/broken links, orphan snapshot directories and stale
+            diff logs and fixes metadata and file system appropriately
+
+                the check runs in two phases: the destination is scanned once and a repair plan is
+                computed, afterwards the plan is applied in one go (single metadata commit, orphans are
+                removed by <jobs> parallel workers). with <dry_run> the plan is only computed.
+
+                returns the RepairPlan
+        """
+
+        self.logger.info( 'checking snapshots and links...' )
+        plan = self._consistency_plan()
+
+        for line in plan.describe():
+            self.logger.warning( '%s%s', '[dry-run] ' if dry_run else '', line )
+
+        if plan and not dry_run:
+            self._apply_repair_plan( plan, jobs )
+
+        return plan
+
+
+    def _consistency_plan( self ):
+        """ helper method which scans the destination and computes the repair plan """
+
+        plan = RepairPlan()
+
+        entries = self._fs.entries( self._destination )
+
+        def on_disk( path, want_dir ):
+            """ check an object in the destination against the scan, fall back to the backend for others """
+            if os.path.dirname( path ) == self._destination:
+                kind = entries.get( os.path.basename( path ))
+                return kind == ( filesystem.DIR if want_dir else filesystem.SYMLINK )
+            return self._fs.isdir( path ) if want_dir else self._fs.islink( path )
+
+        # snapshots
+        plan.drop_snapshots = [ s for s in self._lsnapshots if not on_disk( self._snapshots[ s ].path, True ) ]
+        remaining = [ s for s in self._lsnapshots if s not in plan.drop_snapshots ]
+
+        # links, computed against the final list of snapshots. as in _valid_link(), links whose symbolic link
+        # is missing or broken are deleted, links pointing to another existing target are left alone
+        for link, l in self._links.items():
+            if not on_disk( l.path, False ):
+                if self._fs.exists( l.path ):
+                    plan.unknown.append( l.path )
+                    self.logger.error('link path [%s] exists but is not a symbolic link', l.path)
+                plan.drop_links.append( link )
+                continue
+            if not self._fs.exists( l.path ):
+                plan.drop_links.append( link )
+                continue
+
+            snapshot = l.snapshot
+            if snapshot in plan.drop_snapshots:
+                if not remaining:
+                    plan.drop_links.append( link )
+                    continue
+                # moved to the neighbour snapshot, as by delete_snapshot()
+                index = self._lsnapshots.index( snapshot )
+                newer = [ s for s in self._lsnapshots[ index+1: ] if s in remaining ]
+                older = [ s for s in self._lsnapshots[ :index ] if s in remaining ]
+                plan.relink[ link ] = newer[0] if newer else older[-1]
+
+        # orphans and unmanaged objects in the destination
+        snapshot_names = set( os.path.basename( self._snapshots[ s ].path ) for s in self._snapshots )
+        link_names = set( os.path.basename( l.path ) for l in self._links.values() )
+        building = self._snapshots_being_built()
+        for name, kind in sorted( entries.items() ):
+            if name.startswith( '.' ) or name == self._cfgfile_ext or name in snapshot_names or name in link_names:
+                continue
+            if name in building:
+                self.logger.info('skipping [%s], the snapshot is being built', name)
+                continue
+            if kind == filesystem.DIR and self._snapshot_name_re.match( name ):
+                plan.remove_paths.append( os.path.join( self._destination, name ))
+            else:
+                plan.unknown.append( os.path.join( self._destination, name ))
+
+        # stale diff logs
+        diff_logs = set( self._snapshots[ s ].diff_log_file for s in remaining )
+        if self._diff_log_path and os.path.isdir( self._diff_log_path ):
+            prefix = '{0}__'.format( self._name )
+            with os.scandir( self._diff_log_path ) as it:
+                for e in it:
+                    if e.name.startswith( prefix ) and e.name.endswith( self._difflog_ext ) and e.path not in diff_logs:
+                        plan.remove_paths.append( e.path )
+
+        # stale checksum manifests
+        if os.path.isdir( self._checksums_path ):
+            with os.scandir( self._checksums_path ) as it:
+                for e in it:
+                    if e.name.endswith( self._checksums_ext ) and e.name[:-len( self._checksums_ext )] not in remaining:
+                        plan.remove_paths.append( e.path )
+
+        # stale directory digest indexes
+        if os.path.isdir( self._digests_path ):
+            with os.scandir( self._digests_path ) as it:
+                for e in it:
+                    if e.name.endswith( self._digests_ext ) and e.name[:-len( self._digests_ext )] not in remaining:
+                        plan.remove_paths.append( e.path )
+
+        return plan
+
+
+    def _snapshots_being_built( self ):
+        """ helper method to return the names of the snapshots other processes are building right now
+
+                create_snapshot() saves the new snapshot in the metadata file before building it,
+                import_snapshots() only once it is complete, so directories changed after the metadata
+                file was written are not orphans yet
+        """
+
+        if not self._fs.on_disk or not os.path.exists( self._datafile ):
+            return set()
+
+        saved = self.read_metadata( self._destination )
+        names = set( os.path.basename( s[ 'path' ] ) for s in saved[ '_snapshots' ].values() )
+
+        saved_at = os.stat( self._datafile ).st_mtime
+        with os.scandir( self._destination ) as it:
+            for e in it:
+                if self._snapshot_name_re.match( e.name ) and e.stat( follow_symlinks=False ).st_ctime >= saved_at:
+                    names.add( e.name )
+
+        return names
+
+
+    def _apply_repair_plan( self, plan, jobs=8 ):
+        """ helper method which applies a repair plan computed by _consistency_plan()
+
+                no action is taken if the timeline has been frozen!
+        """
+
+        self._check_frozen()
+
+        # metadata: one transaction, committed by a single save
+        for snapshot in plan.drop_snapshots:
+            dropped = self._snapshots.pop( snapshot )
+            self._lsnapshots.remove( snapshot )
+            if dropped.diff_log_file and dropped.diff_log_file not in plan.remove_paths:
+                plan.remove_paths.append( dropped.diff_log_file )
+
+        for link in plan.drop_links:
+            dropped = self._links.pop( link )
+            if self._fs.islink( dropped.path ):
+                plan.remove_paths.append( dropped.path )
+
+        for link, snapshot in plan.relink.items():
+            self._links[ link ].snapshot = snapshot
+
+        for snapshot in self._snapshots.values():
+            snapshot.links = []
+        for link in sorted( self._links ):
+            self._snapshots[ self._links[ link ].snapshot ].links.append( link )
+
+        self.save()
+
+        # file system: atomically replace symlinks, remove everything else in parallel
+        for link in plan.relink:
+            l = self._links[ link ]
+            self._fs.symlink( l.snapshot, l.path, replace=True )
+            self.logger.info('moved link [%s] to snapshot [%s]', link, l.snapshot)
+
+        def remove( path ):
+            self._remove_path( path )
+            return path
+
+        with concurrent.futures.ThreadPoolExecutor( max_workers=jobs ) as executor:
+            for path in executor.map( remove, plan.remove_paths ):
+                self.logger.info('removed [%s]', path)
+
+
+    def _checksums_manifest( self, snapshot ):
+        """ helper method to return the checksum manifest path of a snapshot """
+
+        return os.path.join( self._checksums_path, snapshot + self._checksums_ext )
+
+
+    def _digests_index( self, snapshot ):
+        """ helper method to return the directory digest index path of a snapshot """
+
+        return os.path.join( self._digests_path, snapshot + self._digests_ext )
+
+
+    def _digests_skip( self ):
+        """ helper method to return the entry names left out of the directory digests """
+
+        return listing.NAMES if self._render_listings else ()
+
+
+    def _copied_file_matcher( self ):
+        """ helper method to return a function telling whether a relative path is copied into every snapshot
+            (copy_dirs_recursive/copy_files_recursive without immutable_files_recursive), None without copy rules
+        """
+
+        if not self._copy_dirs_recursive and not self._copy_files_recursive:
+            return None
+        dirs = re.compile( '|'.join( fnmatch.translate( p ) for p in self._copy_dirs_recursive ) or '(?!)' )
+        files = re.compile( '|'.join( fnmatch.translate( p ) for p in self._copy_files_recursive ) or '(?!)' )
+        is_immutable = immutable.compile_rules( self._immutable_files_recursive )
+
+        def copied( relpath ):
+            parts = relpath.split( '/' )
+            if not files.match( parts[-1] ) and not any( dirs.match( d ) for d in parts[:-1] ):
+                return False
+            return not ( is_immutable and is_immutable( relpath ))
+        return copied
+
+
+    def _snapshot_tree_digests( self, snapshot ):
+        """ helper method to return the directory digests of a snapshot, computed if none were recorded """
+
+        index = self._digests_index( snapshot )
+        if os.path.exists( index ):
+            return merkle.read_index( index )
+        self.logger.info('no directory digests recorded for snapshot [%s], computing them', snapshot)
+        return merkle.digests( self._snapshots[ snapshot ].path, self._copied_file_matcher(), self._digests_skip() )
+
+
+    @_operation
+    def compare( self, snapshot, other=None ):
+        """ compares a snapshot with another snapshot or (<other> is None) with the source directory
+
+                only directories whose merkle digests differ are read (see directory_digests). the digests of
+                the source are computed on the fly, the excludes are left out
+
+                returns a sorted list of (relative path, change) from <snapshot> to <other>, where change is
+                history.ADDED, history.REMOVED or history.MODIFIED
+        """
+
+        self._valid_snapshot( snapshot )
+        start = time.time()
+        tree_a = self._snapshot_tree_digests( snapshot )
+        if other is None:
+            root_b = self._source
+            excludes = set( self._excludes )
+            tree_b = merkle.digests( self._source, self._copied_file_matcher(), self._digests_skip(), excludes )
+        else:
+            self._valid_snapshot( other )
+            root_b = self._snapshots[ other ].path
+            excludes = ()
+            tree_b = self._snapshot_tree_digests( other )
+        changes = sorted( merkle.compare( self._snapshots[ snapshot ].path, tree_a, root_b, tree_b,
+                                          self._digests_skip(), excludes ))
+        self.logger.info('compared snapshot [%s] with [%s] in [%.1f] seconds, [%s] changes',
+                         snapshot, other or self._source, time.time() - start, len( changes ))
+        return changes
+
+
+    @_operation
+    def record_checksums( self, snapshot=None, jobs=None ):
+        """ records the content checksums of all files in the given snapshot (default: latest)
+
+                files are hashed in a process pool with <jobs> workers (default: number of cpus), inodes
+                which were already hashed for a previous snapshot are taken from the checksum cache
+        """
+
+        if snapshot is None:
+            snapshot = self._get_latest_snapshot()
+
+        self._valid_snapshot( snapshot )
+
+        if not os.path.exists( self._checksums_path ):
+            os.makedirs( self._checksums_path )
+
+        self.logger.info('recording checksums of snapshot [%s]', snapshot)
+        start = time.time()
+
+        cache = checksums.ChecksumCache( os.path.join( self._checksums_path, 'cache.sqlite' ))
+        try:
+            files, hashed, hashed_bytes = checksums.record(
+                self._snapshots[ snapshot ].path, self._checksums_manifest( snapshot ), cache, snapshot, jobs )
+            if self._lsnapshots:
+                cache.prune( self._lsnapshots[0] )
+        finally:
+            cache.close()
+
+        self.logger.info(
+            'recorded checksums of [%s] files in snapshot [%s], hashed [%s] files ([%s] bytes) in [%.1f] seconds',
+            files, snapshot, hashed, hashed_bytes, time.time() - start)
+
+
+    @_operation
+    def export_snapshots( self, fileobj, since=None, compress=False ):
+        """ writes the snapshots newer than <since> (all snapshots without <since>) and the links to fileobj,
+            as a stream which only contains the files which are new compared to <since>, see replicate
+
+                returns the list of exported snapshots
+        """
+
+        if since:
+            self._valid_snapshot( since )
+            snapshots = self._lsnapshots[ self._lsnapshots.index( since ) + 1: ]
+            base_path = self._snapshots[ since ].path
+        else:
+            snapshots = self._lsnapshots[:]
+            base_path = None
+
+        self.logger.info('exporting [%s] snapshots since [%s]', len( snapshots ), since)
+
+        manifest = {
+            'timeline' : self._name,
+            'base' : since,
+            'snapshots' : [ {
+                'name' : s,
+                'created' : self._snapshots[ s ].created.isoformat(),
+                'duration' : self._snapshots[ s ].duration,
+                'validation' : self._snapshots[ s ].validation,
+            } for s in snapshots ],
+            'links' : { lk : {
+                'snapshot' : link.snapshot,
+                'max_offset' : link.max_offset,
+                'warn_before_max_offset' : link.warn_before_max_offset or 0,
+            } for lk, link in self._links.items() },
+        }
+        sent, sent_bytes = replicate.write_stream(
+            fileobj, manifest, base_path, [ ( s, self._snapshots[ s ].path ) for s in snapshots ], compress )
+
+        self.logger.info('exported [%s] snapshots, [%s] files ([%s] bytes) sent', len( snapshots ), sent, sent_bytes)
+
+        return snapshots
+
+
+    @_operation
+    def import_snapshots( self, fileobj ):
+        """ rebuilds the snapshots of an export stream (see export_snapshots()) by hard-linking from the base
+            snapshot of the stream, which must be the latest snapshot of this timeline, and updates the links
+
+                no action is taken if the timeline has been frozen!
+
+                returns the list of imported snapshots
+        """
+
+        self._check_frozen()
+
+        reader = replicate.StreamReader( fileobj )
+        try:
+            manifest = reader.manifest
+            base = manifest[ 'base' ]
+            metadata = { s[ 'name' ] : s for s in manifest[ 'snapshots' ] }
+            self.logger.info('importing [%s] snapshots of timeline [%s] since [%s]', len( metadata ), manifest[ 'timeline' ], base)
+
+            latest = self._lsnapshots[-1] if self._lsnapshots else None
+            if base != latest:
+                raise Exception( 'export stream is based on snapshot [{0}], but the latest snapshot is [{1}]'.format( base, latest ))
+            for snapshot in metadata:
+                if not isalnum( snapshot, '-_.' ) or snapshot in self._snapshots:
+                    raise Exception( 'cannot import snapshot [{0}]: invalid name or snapshot already exists'.format( snapshot ))
+
+            building = []
+            def path_of( snapshot ):
+                building[:] = [ os.path.join( self._destination, snapshot ) ]
+                return building[0]
+
+            imported = []
+            try:
+                for snapshot, snapshot_path in reader.snapshots( self._snapshots[ base ].path if base else None, path_of ):
+                    self._seq += 1
+                    self._snapshots[ snapshot ] = Snapshot(
+                        created=datetime.fromisoformat( metadata[ snapshot ][ 'created' ] ),
+                        path=snapshot_path, links=[], seq=self._seq )
+                    for key in ( 'duration', 'validation' ):
+                        if metadata[ snapshot ].get( key ) is not None:
+                            setattr( self._snapshots[ snapshot ], key, metadata[ snapshot ][ key ] )
+                    self._lsnapshots.append( snapshot )
+                    self.save()
+                    imported.append( snapshot )
+                    self.logger.info('imported snapshot [%s]', snapshot)
+            except:
+                # remove the partially built snapshot
+                if building and os.path.basename( building[0] ) not in self._snapshots and self._fs.exists( building[0] ):
+                    self._fs.remove_tree( building[0] )
+                raise
+        finally:
+            reader.close()
+
+        for lk, link in manifest[ 'links' ].items():
+            if link[ 'snapshot' ] not in self._snapshots:
+                self.logger.warning('skipping link [%s], snapshot [%s] does not exist', lk, link[ 'snapshot' ])
+            elif lk not in self._links:
+                self.create_link( lk, link[ 'snapshot' ], link[ 'max_offset' ], link[ 'warn_before_max_offset' ] )
+            elif self._links[ lk ].snapshot != link[ 'snapshot' ]:
+                self.update_link( lk, link[ 'snapshot' ] )
+
+        if self._package_index and imported:
+            self.index_packages( imported )
+
+        self.rotate_snapshots()
+
+        return imported
+
+
+    def index_packages( self, snapshots=None ):
+        """ adds the packages listed by the repository metadata of the given snapshots to the package index
+
+                without <snapshots> all snapshots which are not in the index yet are added. snapshots are
+                added oldest first, snapshots older than the newest one in the index cannot be added.
+                failures are logged but do not affect the snapshots
+        """
+
+        index = packages.PackageIndex( os.path.join( self._destination, self._index_file ))
+        try:
+            if snapshots is None:
+                indexed = index.indexed()
+                snapshots = [ s for s in self._lsnapshots if self._snapshots[ s ].seq not in indexed ]
+            for snapshot in sorted( snapshots, key=lambda s: self._snapshots[ s ].seq ):
+                self.logger.info('indexing packages of snapshot [%s]', snapshot)
+                try:
+                    index.update( self._snapshots[ snapshot ].path, self._snapshots[ snapshot ].seq, snapshot )
+                except Exception as e:
+                    self.logger.warning('cannot index packages of snapshot [%s]: %s', snapshot, e)
+        finally:
+            index.close()
+
+
+    def index_diff_reports( self, snapshots=None ):
+        """ adds the diff reports of the given snapshots to the path history index
+
+                without <snapshots> all snapshots with a diff report which is not in the index yet are added,
+                failures are logged but do not affect the snapshots
+        """
+
+        index = history.HistoryIndex( os.path.join( self._destination, self._index_file ))
+        try:
+            if snapshots is None:
+                indexed = index.indexed()
+                snapshots = [ s for s in self._lsnapshots if self._snapshots[ s ].seq not in indexed ]
+            for snapshot in snapshots:
+                report = self._snapshots[ snapshot ].diff_log_file
+                position = self._lsnapshots.index( snapshot )
+                if not report or not position or not os.path.exists( report ):
+                    continue
+                previous = self._lsnapshots[ position - 1 ]
+                try:
+                    count = index.add_report(
+                        report, self._snapshots[ snapshot ].seq, snapshot, previous,
+                        self._snapshots[ snapshot ].path, self._snapshots[ previous ].path )
+                    self.logger.info('added [%s] changes of snapshot [%s] to the path history', count, snapshot)
+                except Exception as e:
+                    self.logger.warning('cannot add diff report [%s] to the path history: %s', report, e)
+        finally:
+            index.close()
+
+
+    def path_history( self, path, recursive=True ):
+        """ returns (path, snapshot, previous snapshot, change) of the recorded changes of path (relative
+            to the snapshot root), oldest first, see history.HistoryIndex.lookup()
+        """
+
+        index_path = os.path.join( self._destination, self._index_file )
+        if not os.path.exists( index_path ):
+            raise Exception( 'no path history found, diff reports are needed (diff_log_path in [{0}])'.format( self._cfgfile ))
+
+        index = history.HistoryIndex( index_path )
+        try:
+            return index.lookup( path, recursive )
+        finally:
+            index.close()
+
+
+    def find_package( self, name, version=None ):
+        """ returns (name, version, arch, first snapshot, last snapshot) of the matching packages in the package index """
+
+        path = os.path.join( self._destination, self._index_file )
+        if not os.path.exists( path ):
+            raise Exception( 'no package index found, enable package_index in [{0}]'.format( self._cfgfile ))
+
+        index = packages.PackageIndex( path )
+        try:
+            return index.lookup( name, version )
+        finally:
+            index.close()
+
+
+    @_operation
+    def verify_snapshots( self, snapshots=None, jobs=None ):
+        """ verifies snapshots against their recorded checksums (default: all snapshots)
+
+                returns a dict snapshot -> list of (path, expected digest, actual digest) of drifted files.
+                snapshots without recorded checksums are skipped.
+        """
+
+        if snapshots is None:
+            snapshots = self._lsnapshots
+
+        # shared between snapshots, every inode is hashed only once
+        digests = {}
+        drifted = {}
+
+        for snapshot in snapshots:
+            self._valid_snapshot( snapshot )
+            manifest = self._checksums_manifest( snapshot )
+            if not os.path.exists( manifest ):
+                self.logger.warning('no checksums recorded for snapshot [%s], skipping', snapshot)
+                continue
+
+            self.logger.info('verifying snapshot [%s]', snapshot)
+            files, hashed = checksums.verify( self._snapshots[ snapshot ].path, manifest, digests, jobs )
+            self.logger.debug('hashed [%s] new inodes for snapshot [%s]', hashed, snapshot)
+
+            if files:
+                self.logger.warning('snapshot [%s] has [%s] drifted files!', snapshot, len(files))
+                drifted[ snapshot ] = files
+
+        return drifted
+
+
+    def get_usage( self ):
+        """ computes exclusive/shared space and inodes per snapshot in a single pass
+
+                see timeline.usage for details, the result is a usage.Usage instance
+        """
+
+        self.logger.info( 'computing snapshot usage...' )
+
+        snapshots = [ ( s, self._snapshots[ s ].path ) for s in self._lsnapshots ]
+
+        return usage.scan_usage( self._source, snapshots )
 
 
     def _get_latest_snapshot( self ):
@@ -744,6 +2369,7 @@ class Timeline:
 
         self._valid_snapshot( snapshot )
 
+        # O(1), see SnapshotList
         snapshot_index = self._lsnapshots.index( snapshot )
 
         # if we only have a single snapshot left we return it as it's neighbour...
@@ -762,11 +2388,39 @@ class Timeline:
 
 
     def _get_snapshot_offset( self, snapshot ):
-        """ helper method to return the offset of a given snapshot to the "upstream" snapshot """
+        """ helper method to return the offset of a given snapshot to the "upstream" snapshot
+
+                snapshots thinned out by the retention policy still count, see _offset()
+        """
 
         self._valid_snapshot( snapshot )
 
-        return len(self._lsnapshots) - self._lsnapshots.index( snapshot )
+        return self._offset( snapshot )
+
+
+    def _offset( self, snapshot ):
+        """ helper method to return the offset of a given snapshot without validating it
+
+                the position of the snapshot counted from the newest one, plus the snapshots thinned out by
+                the retention policy since the snapshot was created
+        """
+
+        seq = self._snapshots[ snapshot ].seq
+        return len( self._lsnapshots ) - self._lsnapshots.index( snapshot ) + sum( 1 for s in self._thinned if s > seq )
+
+
+    def _get_oldest_snapshot_within( self, max_offset ):
+        """ helper method to return the oldest snapshot with an offset <= max_offset """
+
+        # offsets decrease towards the newest snapshot, so the first one within max_offset is found by bisection
+        lo, hi = 0, len( self._lsnapshots ) - 1
+        while lo < hi:
+            mid = ( lo + hi ) // 2
+            if self._offset( self._lsnapshots[ mid ] ) <= max_offset:
+                hi = mid
+            else:
+                lo = mid + 1
+        return self._lsnapshots[ lo ]
 
 
     def _check_frozen( self ):
@@ -776,14 +2430,62 @@ class Timeline:
             raise Exception('timeline is frozen!')
 
 
+    def _exists( self, path, link=False ):
+        """ helper method for os.path.exists() (os.path.islink() if link is set)
+
+                during an operation (see _operation()) paths which were found are not stat'ed again
+        """
+
+        key = ( path, link )
+        if self._stat_cache is not None and key in self._stat_cache:
+            return True
+        found = self._fs.islink( path ) if link else self._fs.exists( path )
+        if found and self._stat_cache is not None:
+            self._stat_cache[ key ] = True
+        return found
+
+
+    def _bookkeeping_file( self, path ):
+        """ helper method telling whether path is a file of the host kept for a snapshot (diff log, checksum
+            manifest, digest index) rather than a snapshot tree or link handled by the file system backend
+        """
+
+        return ( path.endswith( self._difflog_ext )
+                 or os.path.dirname( path ) in ( self._checksums_path, self._digests_path ))
+
+
+    def _remove_path( self, path, inodes=None ):
+        """ helper method to remove a deleted object: snapshot trees and links through the file system backend
+            (adding the inodes of removed files to <inodes>, see FileSystem.remove_tree()), bookkeeping files
+            (see _bookkeeping_file()) with os.remove()
+        """
+
+        if self._bookkeeping_file( path ):
+            try:
+                os.remove( path )
+            except FileNotFoundError:
+                pass
+        else:
+            self._fs.remove_tree( path, inodes )
+        self._forget( path )
+
+
+    def _forget( self, path ):
+        """ helper method to drop a removed path from the stat cache """
+
+        if self._stat_cache is not None:
+            self._stat_cache.pop( ( path, False ), None )
+            self._stat_cache.pop( ( path, True ), None )
+
+
     def _valid_snapshot( self, snapshot, fail_on_disk_check=True ):
         """ helper method to check for a valid snapshot """
 
         if not snapshot in self._snapshots:
             raise Exception('snapshot [{0}] not found!'.format( snapshot ))
 
-        if not os.path.exists( self._snapshots[ snapshot ][ 'path' ] ):
-            msg = 'snapshot [{0}] not found!'.format( self._snapshots[ snapshot ][ 'path' ] )
+        if not self._exists( self._snapshots[ snapshot ].path ):
+            msg = 'snapshot [{0}] not found!'.format( self._snapshots[ snapshot ].path )
             if fail_on_disk_check:
                 raise Exception( msg )
             self.logger.warning( msg )
@@ -798,15 +2500,15 @@ class Timeline:
         if not link in self._links:
             raise Exception('link [{0}] not found!'.format( link ))
 
-        if not os.path.islink( self._links[ link ][ 'path' ] ):
-            msg = 'link [{0}] not found!'.format( self._links[ link ][ 'path' ] )
+        if not self._exists( self._links[ link ].path, link=True ):
+            msg = 'link [{0}] not found!'.format( self._links[ link ].path )
             if fail_on_disk_check:
                 raise Exception( msg )
             self.logger.warning( msg )
             return False
 
-        if not os.path.exists( self._links[ link ][ 'path' ] ):
-            msg = 'link [{0}] is broken!'.format( self._links[ link ][ 'path' ] )
+        if not self._exists( self._links[ link ].path ):
+            msg = 'link [{0}] is broken!'.format( self._links[ link ].path )
             if fail_on_disk_check:
                 raise Exception( msg )
             self.logger.warning( msg )
@@ -0,0 +1,220 @@
+"""Disk usage accounting for hard-linked snapshots
+
+Running du over a timeline double-counts (or arbitrarily attributes) inodes
+which are shared between snapshots. This module computes, in a single pass
+over the source and all snapshots, which inodes are held exclusively by a
+snapshot and how much space would be freed by deleting the oldest snapshots.
+
+An inode is accounted and dropped from the index as soon as all of its hard
+links (st_nlink) have been seen. The source is scanned first and the
+snapshots from newest to oldest, so long-lived files are retired at the
+oldest snapshot holding them. Memory is not bounded by a single snapshot:
+every file of the source stays in the index until the oldest snapshot
+holding it has been scanned, so the index grows with the number of files of
+the source (plus the files of the snapshots which are no longer in the
+source and are still held by older snapshots), about 250 bytes per file.
+"""
+
+import logging
+import os
+
+logger = logging.getLogger('Timeline.usage')
+
+# index record fields
+_NEWEST, _OLDEST, _SEEN, _NLINK, _BYTES, _IN_SOURCE = range(6)
+
+
+def _scan(path):
+    """yield (stat result, is_dir) for path and every object below it
+
+    symbolic links are not followed, unreadable directories are skipped
+    """
+
+    try:
+        yield os.lstat(path), True
+    except OSError as e:
+        logger.warning('cannot stat [%s]: %s', path, e)
+        return
+
+    stack = [path]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError as e:
+                        logger.warning('cannot stat [%s]: %s', entry.path, e)
+                        continue
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    if is_dir:
+                        stack.append(entry.path)
+                    yield st, is_dir
+        except OSError as e:
+            logger.warning('cannot scan [%s]: %s', directory, e)
+
+
+def _allocated(st):
+    """bytes allocated on disk for the given stat result"""
+
+    return st.st_blocks * 512
+
+
+class SnapshotUsage:
+    """usage figures of a single snapshot
+
+            exclusive_bytes/inodes: held only by this snapshot, freed when it is deleted
+            shared_bytes/inodes:    referenced by this snapshot and by the source, other snapshots or
+                                    anything outside of the timeline
+    """
+
+    __slots__ = ('name', 'path', 'exclusive_bytes', 'exclusive_inodes', 'shared_bytes', 'shared_inodes')
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.exclusive_bytes = 0
+        self.exclusive_inodes = 0
+        self.shared_bytes = 0
+        self.shared_inodes = 0
+
+    def as_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+class Usage:
+    """result of scan_usage()
+
+            snapshots:              list of SnapshotUsage, oldest first
+            source_bytes/inodes:    objects held by the source directory
+            external_bytes/inodes:  objects with hard links outside of the scanned trees
+                                    (e.g. named snapshots), these are never reclaimable
+            reclaimable:            list of (bytes, inodes), element N is what deleting the oldest N
+                                    snapshots would free
+    """
+
+    def __init__(self, snapshots):
+        self.snapshots = snapshots
+        self.source_bytes = 0
+        self.source_inodes = 0
+        self.external_bytes = 0
+        self.external_inodes = 0
+        self.reclaimable = [(0, 0)] * (len(snapshots) + 1)
+
+    def reclaimable_for(self, max_snapshots):
+        """(bytes, inodes) freed when the timeline is rotated down to max_snapshots"""
+
+        delete = max(0, len(self.snapshots) - max_snapshots)
+        return self.reclaimable[delete]
+
+    def as_dict(self):
+        return {
+            'snapshots': [s.as_dict() for s in self.snapshots],
+            'source_bytes': self.source_bytes,
+            'source_inodes': self.source_inodes,
+            'external_bytes': self.external_bytes,
+            'external_inodes': self.external_inodes,
+            'reclaimable': self.reclaimable,
+        }
+
+
+def scan_usage(source, snapshots):
+    """compute per-snapshot usage
+
+            source:     the timeline source directory
+            snapshots:  list of (name, path) tuples, oldest first
+    """
+
+    usage = Usage([SnapshotUsage(name, path) for name, path in snapshots])
+    # reclaim_*[i]: objects whose newest reference is snapshot i, dir_*[i]: directories of snapshot i
+    reclaim_bytes = [0] * len(snapshots)
+    reclaim_inodes = [0] * len(snapshots)
+    dir_bytes = [0] * len(snapshots)
+    dir_inodes = [0] * len(snapshots)
+    index = {}
+
+    def account(rec, complete):
+        """inode rec has been seen completely (or the scan ended), book it"""
+
+        nbytes = rec[_BYTES]
+        if rec[_IN_SOURCE]:
+            usage.source_bytes += nbytes
+            usage.source_inodes += 1
+        elif not complete:
+            usage.external_bytes += nbytes
+            usage.external_inodes += 1
+
+        if rec[_NEWEST] is None:
+            return
+
+        if complete and not rec[_IN_SOURCE]:
+            reclaim_bytes[rec[_NEWEST]] += nbytes
+            reclaim_inodes[rec[_NEWEST]] += 1
+            if rec[_NEWEST] == rec[_OLDEST]:
+                snap = usage.snapshots[rec[_NEWEST]]
+                snap.exclusive_bytes += nbytes
+                snap.exclusive_inodes += 1
+
+    def visit(key, st, pos, in_source):
+        rec = index.get(key)
+        if rec is None:
+            rec = [pos, pos, 0, st.st_nlink, _allocated(st), in_source]
+            index[key] = rec
+            referenced(pos, rec)
+        elif pos is not None and rec[_OLDEST] != pos:
+            if rec[_NEWEST] is None:
+                rec[_NEWEST] = pos
+            rec[_OLDEST] = pos
+            referenced(pos, rec)
+        rec[_SEEN] += 1
+        if rec[_SEEN] >= rec[_NLINK]:
+            del index[key]
+            account(rec, complete=True)
+
+    # bytes/inodes referenced by each snapshot, shared = referenced - exclusive
+    ref_bytes = [0] * len(snapshots)
+    ref_inodes = [0] * len(snapshots)
+
+    def referenced(pos, rec):
+        if pos is not None:
+            ref_bytes[pos] += rec[_BYTES]
+            ref_inodes[pos] += 1
+
+    logger.info('scanning source [%s]', source)
+    for st, is_dir in _scan(source):
+        if not is_dir:
+            visit((st.st_dev, st.st_ino), st, None, True)
+
+    for pos in range(len(snapshots) - 1, -1, -1):
+        name, path = snapshots[pos]
+        logger.info('scanning snapshot [%s]', name)
+        for st, is_dir in _scan(path):
+            if is_dir:
+                # directories are never hard-linked, they belong to the snapshot alone
+                dir_bytes[pos] += _allocated(st)
+                dir_inodes[pos] += 1
+            else:
+                visit((st.st_dev, st.st_ino), st, pos, False)
+
+    for rec in index.values():
+        account(rec, complete=False)
+    index.clear()
+
+    for pos, snap in enumerate(usage.snapshots):
+        snap.shared_bytes = ref_bytes[pos] - snap.exclusive_bytes
+        snap.shared_inodes = ref_inodes[pos] - snap.exclusive_inodes
+        snap.exclusive_bytes += dir_bytes[pos]
+        snap.exclusive_inodes += dir_inodes[pos]
+        reclaim_bytes[pos] += dir_bytes[pos]
+        reclaim_inodes[pos] += dir_inodes[pos]
+
+    total_bytes = total_inodes = 0
+    reclaimable = [(0, 0)]
+    for pos in range(len(snapshots)):
+        total_bytes += reclaim_bytes[pos]
+        total_inodes += reclaim_inodes[pos]
+        reclaimable.append((total_bytes, total_inodes))
+    usage.reclaimable = reclaimable
+
+    return usage
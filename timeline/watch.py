@@ -0,0 +1,258 @@
+"""Waiting for a mirror sync to complete
+
+A snapshot taken while the upstream mirror is being synchronized is broken,
+a snapshot taken at a fixed time long after the sync delays updates. This
+module waits until a sync has completed since the last snapshot, either
+
+- a marker file (written by the sync job when it is done) is newer than the
+  last snapshot, or
+- the repository metadata (the directories and files which are copied instead
+  of hard-linked, see copy_dirs_recursive/copy_files_recursive) changed since
+  the last snapshot and has not changed for a quiet period.
+
+Changes are detected with inotify (through ctypes, Linux only) and by
+polling if inotify is not available.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import logging
+import os
+import select
+import struct
+import time
+
+from timeline import repository
+
+logger = logging.getLogger('Timeline.watch')
+
+# inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# IN_ATTRIB is left out: hard-linking a file into a snapshot changes its link count
+_WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+               | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+_EVENT = struct.Struct('iIII')
+
+# seconds between scans when polling
+POLL_INTERVAL = 5
+
+
+class Inotify:
+    """minimal inotify wrapper, raises OSError if inotify is not available"""
+
+    _libc = None
+
+    def __init__(self):
+        if Inotify._libc is None:
+            Inotify._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            if not hasattr(Inotify._libc, 'inotify_init1'):
+                raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = Inotify._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.watches = {}
+
+    def add_watch(self, path, mask=_WATCH_MASK):
+        wd = Inotify._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, f'{os.strerror(e)}: {path}')
+        self.watches[wd] = path
+        return wd
+
+    def read(self, timeout):
+        """return the list of (path, mask, name) events, waiting at most timeout seconds"""
+
+        readable, _, _ = select.select([self.fd], [], [], max(0, timeout))
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0').decode(errors='replace')
+            offset += length
+            path = self.watches.get(wd)
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+            events.append((path, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def metadata_paths(source, copy_dirs, copy_files):
+    """return the directories holding repository metadata below source
+
+            these are the directories matching copy_dirs and the directories containing files
+            matching copy_files. package directories (Packages, pool) are not descended into
+    """
+
+    found = set()
+    stack = [source]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = list(it)
+        except OSError as e:
+            logger.warning('cannot scan [%s]: %s', directory, e)
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if any(fnmatch.fnmatch(entry.name, p) for p in copy_dirs):
+                    found.add(entry.path)
+                if entry.name not in repository._PRUNE_DIRS:
+                    stack.append(entry.path)
+            elif any(fnmatch.fnmatch(entry.name, p) for p in copy_files):
+                found.add(directory)
+    return sorted(found)
+
+
+def last_change(paths):
+    """time of the last change below the given metadata directories
+
+            directory ctimes change whenever entries are created, renamed or deleted (which is how
+            sync tools update files). file mtimes are used for files, their ctime also changes when
+            they are hard-linked into a snapshot
+    """
+
+    latest = 0.0
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        latest = max(latest, st.st_ctime)
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    latest = max(latest, st.st_ctime if entry.is_dir(follow_symlinks=False) else st.st_mtime)
+        except OSError:
+            continue
+    return latest
+
+
+def _marker_time(marker):
+    try:
+        return os.stat(marker).st_mtime
+    except OSError:
+        return None
+
+
+def _watch(paths):
+    """return an Inotify instance watching the given paths and their parents, None if not available"""
+
+    try:
+        inotify = Inotify()
+    except (OSError, AttributeError) as e:
+        logger.info('inotify not available (%s), polling every %ss', e, POLL_INTERVAL)
+        return None
+
+    watched = set()
+    for path in paths:
+        for p in (path, os.path.dirname(path)):
+            if p in watched or not os.path.isdir(p):
+                continue
+            try:
+                inotify.add_watch(p)
+            except OSError as e:
+                logger.info('cannot watch [%s] (%s), polling every %ss', p, e, POLL_INTERVAL)
+                inotify.close()
+                return None
+            watched.add(p)
+    return inotify
+
+
+def wait_for_sync(source, copy_dirs, copy_files, since, marker=None, quiet_period=60, timeout=None):
+    """block until a sync of source completed after the time since (seconds since the epoch)
+
+            copy_dirs/copy_files:   patterns of the metadata directories/files, see metadata_paths()
+            marker:                 marker file, the sync is complete once it is newer than since. if
+                                    not given, the sync is complete once the metadata changed after
+                                    since and has not changed for quiet_period seconds
+            timeout:                give up after this many seconds
+
+            returns True if the sync completed, False on timeout
+    """
+
+    deadline = time.time() + timeout if timeout else None
+
+    def watch_paths():
+        if marker:
+            return [], [os.path.dirname(marker)]
+        paths = metadata_paths(source, copy_dirs, copy_files)
+        if not paths:
+            raise Exception(f'no repository metadata found below [{source}]')
+        return paths, paths
+
+    paths, watched = watch_paths()
+    inotify = _watch(watched)
+    try:
+        changed = 0.0
+        while True:
+            now = time.time()
+            if marker:
+                mtime = _marker_time(marker)
+                if mtime is not None and mtime > since:
+                    logger.info('sync marker [%s] updated at %s', marker, time.ctime(mtime))
+                    return True
+                wait = POLL_INTERVAL
+            else:
+                changed = max(changed, last_change(paths))
+                if changed > since and now - changed >= quiet_period:
+                    logger.info('repository metadata unchanged for %ss, sync completed', int(now - changed))
+                    return True
+                wait = quiet_period - (now - changed) if changed > since else POLL_INTERVAL
+
+            if deadline is not None:
+                if now >= deadline:
+                    logger.warning('no completed sync of [%s] within %ss', source, timeout)
+                    return False
+                wait = min(wait, deadline - now)
+
+            if inotify is None:
+                time.sleep(min(wait, POLL_INTERVAL))
+                continue
+
+            # without marker, inotify only shortens the wait: every event restarts the quiet period
+            events = inotify.read(wait if marker is None else min(wait, POLL_INTERVAL))
+            if not events:
+                continue
+            logger.debug('%d change(s) below [%s]', len(events), source)
+            if not marker:
+                changed = time.time()
+            if any(mask & (IN_IGNORED | IN_ISDIR) for _, mask, _ in events):
+                # directories were created or replaced, watch the current ones
+                inotify.close()
+                paths, watched = watch_paths()
+                inotify = _watch(watched)
+    finally:
+        if inotify is not None:
+            inotify.close()